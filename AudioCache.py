@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of synthesized speech.
+
+Chat repeats itself a lot ("gg", emote spam, copypastas, the auto
+message), so rendered audio is kept in a least-recently-used cache
+keyed on the normalized text plus the voice and volume it was rendered
+with. The cache has a memory tier and an optional on-disk tier, both
+bounded in bytes.
+"""
+import collections
+import hashlib
+import os
+import threading
+
+
+def default_cache_dir():
+    """:return: per-user directory for the on-disk tier"""
+    base = os.environ.get('LOCALAPPDATA') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'TwitchChatReader', 'audio')
+
+
+def normalize(text):
+    """Case and whitespace do not change how text sounds."""
+    return ' '.join(text.lower().split())
+
+
+class AudioCache(object):
+    """
+    Content-addressed LRU cache of rendered audio.
+    :param max_memory_bytes: size bound of the memory tier
+    :type max_memory_bytes: int
+    :param directory: directory of the on-disk tier, None to keep the
+        cache in memory only
+    :type directory: string
+    :param max_disk_bytes: size bound of the on-disk tier
+    :type max_disk_bytes: int
+    """
+
+    def __init__(self, max_memory_bytes=16 * 1024 * 1024, directory=None,
+                 max_disk_bytes=256 * 1024 * 1024):
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.directory = directory
+        self.memory = collections.OrderedDict()
+        self.memory_bytes = 0
+        self.disk = collections.OrderedDict()
+        self.disk_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if directory is not None:
+            self._load_disk_index()
+
+    @staticmethod
+    def key(text, voice, volume):
+        """
+        Cache key of an utterance.
+        :param text: the text that is spoken
+        :param voice: name of the voice/backend rendering it
+        :param volume: volume it is rendered at
+        """
+        data = '%s\0%s\0%s' % (voice, int(volume), normalize(text))
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.audio')
+
+    def _load_disk_index(self):
+        """Pick up files from earlier runs, least recently used first."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.audio'):
+                stat = os.stat(os.path.join(self.directory, filename))
+                entries.append((stat.st_mtime, filename[:-6], stat.st_size))
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_bytes += size
+        self._evict_disk()
+
+    def get(self, key):
+        """
+        :return: the cached audio, or None on a miss
+        """
+        with self._lock:
+            audio = self.memory.get(key)
+            if audio is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return audio
+            if key in self.disk:
+                try:
+                    with open(self._path(key), 'rb') as f:
+                        audio = f.read()
+                    os.utime(self._path(key))
+                except (IOError, OSError):
+                    self.disk_bytes -= self.disk.pop(key)
+                else:
+                    self.disk.move_to_end(key)
+                    self.disk_hits += 1
+                    self._store_memory(key, audio)
+                    return audio
+            self.misses += 1
+            return None
+
+    def put(self, key, audio):
+        """Store freshly rendered audio in both tiers."""
+        with self._lock:
+            self._store_memory(key, audio)
+            if self.directory is not None and key not in self.disk \
+                    and len(audio) <= self.max_disk_bytes:
+                try:
+                    with open(self._path(key), 'wb') as f:
+                        f.write(audio)
+                except (IOError, OSError) as e:
+                    print ("Could not write audio cache: ", e)
+                else:
+                    self.disk[key] = len(audio)
+                    self.disk_bytes += len(audio)
+                    self._evict_disk()
+
+    def _store_memory(self, key, audio):
+        if len(audio) > self.max_memory_bytes:
+            return
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key))
+        self.memory[key] = audio
+        self.memory_bytes += len(audio)
+        while self.memory_bytes > self.max_memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def _evict_disk(self):
+        while self.disk_bytes > self.max_disk_bytes:
+            key, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    @property
+    def hits(self):
+        return self.memory_hits + self.disk_hits
+
+    def stats(self):
+        """:return: dict with the hit/miss counters and tier sizes"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / float(lookups) if lookups else 0.,
+            'memory_entries': len(self.memory),
+            'memory_bytes': self.memory_bytes,
+            'disk_entries': len(self.disk),
+            'disk_bytes': self.disk_bytes,
+        }
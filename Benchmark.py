@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+Offline micro-benchmarks for the chat reader hot paths.
+
+Usage:
+    python Benchmark.py parse [--corpus chat.log] [--lines 200000]
+    python Benchmark.py receive [--rate 2000] [--count 50000]
+    python Benchmark.py pipeline [--rate 2000] [--count 50000]
+    python Benchmark.py replay [--corpus chat.log] [--lines 200000]
+    python Benchmark.py workers [--corpus chat.log] [--max-workers 4]
+
+The corpus is a recorded chat log with one raw IRC line per line (as
+received from the server). Without --corpus a synthetic corpus that
+mimics a busy channel is generated.
+
+receive and pipeline run a MockTwitchServer in a separate process and
+measure the client end to end: receive covers twitch_receive_messages,
+pipeline the whole ChatReader loop (filter and speech queue, with the
+null speech backend). Both report throughput, latency percentiles from
+server send to client handling, and lines that never arrived.
+
+replay pushes the corpus through the ChatReader pipeline without a
+socket (see ChatReplay.py), at full speed and with the same seed every
+run, and reports the time spent per stage.
+
+workers compares decoding, parsing and filtering the corpus in this
+process with handing it to 1 to N ParseWorkers processes.
+"""
+import argparse
+import multiprocessing
+import random
+import re
+import select
+import time
+
+from ChatFilter import ChatFilter
+from ChatReader import ChatReader
+from ChatReplay import ChatReplay, ReplayStream, log_source
+from MockTwitchServer import MockTwitchServer
+from ParseWorkers import ParseWorkerPool, process_batch
+from Speech import NullBackend, SpeechQueue, SpeechWorker
+from TwitchChatStream import TwitchChatStream
+from TwitchIRC import IRCMessage, parse_line
+
+
+def legacy_parse(data):
+    """
+    The original regex cascade of TwitchChatStream._parse_message, kept
+    here as the baseline to compare against.
+    """
+    if re.match(r'^PING :tmi\.twitch\.tv$', data):
+        pass
+    channel_re = (r'^:[a-zA-Z0-9_]+\![a-zA-Z0-9_]+@[a-zA-Z0-9_]+'
+                  r'\.tmi\.twitch\.tv '
+                  r'JOIN #([a-zA-Z0-9_]+)$')
+    if re.findall(channel_re, data):
+        re.findall(channel_re, data)[0]
+    if re.match(r'^:[a-zA-Z0-9_]+\![a-zA-Z0-9_]+@[a-zA-Z0-9_]+'
+                r'\.tmi\.twitch\.tv '
+                r'PRIVMSG #[a-zA-Z0-9_]+ :.+$', data):
+        return {
+            'channel': re.findall(r'^:.+![a-zA-Z0-9_]+'
+                                  r'@[a-zA-Z0-9_]+'
+                                  r'.+ '
+                                  r'PRIVMSG (.*?) :',
+                                  data)[0],
+            'username': re.findall(r'^:([a-zA-Z0-9_]+)!', data)[0],
+            'message': re.findall(r'PRIVMSG #[a-zA-Z0-9_]+ :(.+)',
+                                  data)[0]
+        }
+    return None
+
+
+def synthetic_corpus(count, channels=('tsm_dyrus',), seed=0):
+    """
+    Build a list of raw IRC lines resembling a busy chat.
+    :param count: number of lines
+    :param channels: channel names (without #) to spread the lines over
+    :param seed: random seed, so runs are comparable
+    """
+    rng = random.Random(seed)
+    words = ['gg', 'LUL', 'Kappa', 'PogChamp', 'what', 'a', 'play', 'is',
+             'this', 'real', 'lol', 'nice', 'one', 'streamer', 'hello',
+             'chat', 'wow', '!uptime', 'KEKW', 'monkaS']
+    users = ['viewer%d' % i for i in range(500)]
+    lines = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.002:
+            lines.append('PING :tmi.twitch.tv')
+        elif roll < 0.004:
+            user = rng.choice(users)
+            lines.append(':%s!%s@%s.tmi.twitch.tv JOIN #%s'
+                         % (user, user, user, rng.choice(channels)))
+        else:
+            user = rng.choice(users)
+            text = ' '.join(rng.choice(words)
+                            for _ in range(rng.randint(1, 15)))
+            lines.append(':%s!%s@%s.tmi.twitch.tv PRIVMSG #%s :%s'
+                         % (user, user, user, rng.choice(channels), text))
+    return lines
+
+
+def load_corpus(path):
+    """Read a recorded chat log, one raw IRC line per line."""
+    with open(path, encoding='utf-8', errors='replace') as f:
+        return [line.rstrip('\r\n') for line in f if line.strip()]
+
+
+def _lines_per_second(parse, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            parse(line)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best
+
+
+def bench_parse(args):
+    if args.corpus:
+        lines = load_corpus(args.corpus)
+    else:
+        lines = synthetic_corpus(args.lines)
+    print("Parsing %d lines, best of %d runs" % (len(lines), args.repeat))
+    old = _lines_per_second(legacy_parse, lines, args.repeat)
+    new = _lines_per_second(parse_line, lines, args.repeat)
+    print("  regex cascade : %12.0f lines/s" % old)
+    print("  single pass   : %12.0f lines/s" % new)
+    print("  speedup       : %12.2fx" % (new / old))
+
+
+def _serve(ready, rate, count, line_size):
+    server = MockTwitchServer(rate=rate, count=count, line_size=line_size)
+    ready.put(server.port)
+    server.serve_forever()
+
+
+def start_mock_server(rate, count, line_size):
+    """
+    Run a MockTwitchServer in its own process, so it does not compete
+    with the client for the GIL.
+    :return: (process, port)
+    """
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve,
+                                      args=(ready, rate, count, line_size))
+    process.daemon = True
+    process.start()
+    return process, ready.get(timeout=10)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return float('nan')
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class LoadResult(object):
+    """Collects what the client saw of a flood."""
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.latencies = []
+        self.seen = set()
+        self.first = None
+        self.last = None
+
+    def record(self, message):
+        now = time.time()
+        seq, sent = message.message.split(' ', 2)[:2]
+        self.latencies.append(now - float(sent))
+        self.seen.add(int(seq))
+        if self.first is None:
+            self.first = now
+        self.last = now
+
+    def report(self, title):
+        latencies = sorted(self.latencies)
+        elapsed = (self.last - self.first) if self.first else 0.
+        print (title)
+        print ("  received      : %d of %d" % (len(self.seen), self.expected))
+        print ("  dropped lines : %d" % (self.expected - len(self.seen)))
+        if elapsed > 0:
+            print ("  throughput    : %.0f lines/s" % (len(latencies) / elapsed))
+        for name, fraction in (('p50', .5), ('p90', .9), ('p99', .99),
+                               ('max', 1.)):
+            print ("  latency %-5s : %8.2f ms"
+                   % (name, percentile(latencies, fraction) * 1000.))
+
+
+def _connect_to_mock(args):
+    process, port = start_mock_server(args.rate, args.count, args.line_size)
+    stream = TwitchChatStream('benchbot', 'oauth:benchmark',
+                              host='127.0.0.1', port=port)
+    stream.connect()
+    stream.join_channel('bench')
+    return process, stream
+
+
+def _until_done(result, step, idle):
+    """Call step() until everything arrived or nothing came for idle s."""
+    last_count = -1
+    last_change = time.time()
+    while len(result.seen) < result.expected:
+        step()
+        if len(result.seen) != last_count:
+            last_count = len(result.seen)
+            last_change = time.time()
+        elif time.time() - last_change > idle:
+            break
+
+
+def bench_receive(args):
+    process, stream = _connect_to_mock(args)
+    result = LoadResult(args.count)
+
+    def step():
+        select.select([stream.s], [], [], .5)
+        for message in stream.twitch_receive_messages():
+            result.record(message)
+
+    try:
+        _until_done(result, step, args.idle)
+    finally:
+        stream.close()
+        process.terminate()
+    result.report("twitch_receive_messages at %g lines/s offered, %d-char lines"
+                  % (args.rate, args.line_size))
+
+
+def bench_pipeline(args):
+    process, stream = _connect_to_mock(args)
+    result = LoadResult(args.count)
+    speech = SpeechWorker(NullBackend(),
+                          speech_queue=SpeechQueue(maxsize=args.queue_size))
+    reader = ChatReader(stream, speech, channels=['bench'])
+    handle = reader.handle
+
+    def timed_handle(message):
+        reason = handle(message)
+        result.record(message)
+        return reason
+    reader.handle = timed_handle
+
+    try:
+        _until_done(result, lambda: reader.poll(.5), args.idle)
+    finally:
+        stream.close()
+        process.terminate()
+        speech.stop()
+    result.report("ChatReader loop at %g lines/s offered, %d-char lines"
+                  % (args.rate, args.line_size))
+    stats = speech.queue.stats()
+    print ("  read / skipped: %d / %d" % (reader.read, reader.skipped))
+    print ("  speech drops  : %s" % stats['dropped'])
+
+
+def bench_replay(args):
+    if args.corpus:
+        source = log_source(args.corpus)
+    else:
+        source = ((None, line) for line in synthetic_corpus(args.lines))
+    speech = SpeechWorker(NullBackend(),
+                          speech_queue=SpeechQueue(maxsize=args.queue_size))
+    reader = ChatReader(ReplayStream(), speech)
+    replay = ChatReplay(reader)
+    try:
+        replay.run(source)
+    finally:
+        speech.stop()
+    replay.report()
+
+
+def bench_workers(args):
+    if args.corpus:
+        lines = load_corpus(args.corpus)
+    else:
+        lines = synthetic_corpus(args.lines)
+    batches = [('\r\n'.join(lines[i:i + args.batch]) + '\r\n').encode('utf-8')
+               for i in range(0, len(lines), args.batch)]
+    chat_filter = ChatFilter(muted_users=['viewer%d' % i for i in range(50)],
+                             max_length=100, blocked_words=['monkas'],
+                             skip_emote_only=True)
+    print ("Decode, parse and filter %d lines in batches of %d"
+           % (len(lines), args.batch))
+    start = time.perf_counter()
+    for data in batches:
+        for fields in process_batch(data, chat_filter.check)[0]:
+            IRCMessage(*fields)
+    single = len(lines) / (time.perf_counter() - start)
+    print ("  in process    : %10.0f lines/s" % single)
+    for workers in range(1, args.max_workers + 1):
+        pool = ParseWorkerPool(chat_filter, workers)
+        try:
+            start = time.perf_counter()
+            for data in batches:
+                pool.submit(data)
+            while pool.delivered < len(batches):
+                for _, passed, _, _ in pool.collect():
+                    for fields in passed:
+                        IRCMessage(*fields)
+            rate = len(lines) / (time.perf_counter() - start)
+        finally:
+            pool.close()
+        print ("  %d worker%s     : %10.0f lines/s  %5.2fx"
+               % (workers, ' ' if workers == 1 else 's', rate, rate / single))
+
+
+def _add_load_arguments(p):
+    p.add_argument('--rate', type=float, default=2000,
+                   help='lines per second offered by the mock server')
+    p.add_argument('--count', type=int, default=50000)
+    p.add_argument('--line-size', type=int, default=60)
+    p.add_argument('--idle', type=float, default=3.,
+                   help='give up after this many seconds without data')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    sub = parser.add_subparsers(dest='benchmark')
+    sub.required = True
+
+    p = sub.add_parser('parse', help='IRC line parser throughput')
+    p.add_argument('--corpus', help='recorded chat log, one raw line each')
+    p.add_argument('--lines', type=int, default=200000,
+                   help='size of the synthetic corpus')
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_parse)
+
+    p = sub.add_parser('receive', help='twitch_receive_messages under load')
+    _add_load_arguments(p)
+    p.set_defaults(func=bench_receive)
+
+    p = sub.add_parser('pipeline', help='ChatReader receive loop under load')
+    _add_load_arguments(p)
+    p.add_argument('--queue-size', type=int, default=10)
+    p.set_defaults(func=bench_pipeline)
+
+    p = sub.add_parser('replay', help='ChatReader pipeline without a socket')
+    p.add_argument('--corpus', help='recorded chat log, one raw line each')
+    p.add_argument('--lines', type=int, default=200000,
+                   help='size of the synthetic corpus')
+    p.add_argument('--queue-size', type=int, default=10)
+    p.set_defaults(func=bench_replay)
+
+    p = sub.add_parser('workers', help='parse/filter scaling over processes')
+    p.add_argument('--corpus', help='recorded chat log, one raw line each')
+    p.add_argument('--lines', type=int, default=400000,
+                   help='size of the synthetic corpus')
+    p.add_argument('--batch', type=int, default=500,
+                   help='lines per batch handed to a worker')
+    p.add_argument('--max-workers', type=int,
+                   default=multiprocessing.cpu_count())
+    p.set_defaults(func=bench_workers)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
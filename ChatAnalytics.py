@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+"""
+What is going on in the chat: rates, top chatters, emotes and words.
+
+ChatAnalytics looks at every chat message once, incrementally, and keeps
+only structures of a fixed size, so its memory does not grow however
+long the reader runs or however many chatters come by:
+
+    RateRing         messages per bucket (per second, per minute) in a
+                     ring that is overwritten as time goes on
+    SpaceSaving      the most frequent chatters, emotes and words; keeps
+                     capacity counters, each over-counted by at most its
+                     error
+    CountMinSketch   messages per chatter, for any chatter (never under-
+                     counted, over-counted by a bounded amount)
+
+snapshot() returns a plain dict for the GUI, or as JSON from the
+/analytics path of MetricsServer.
+"""
+import array
+import heapq
+import itertools
+import re
+import threading
+import time
+
+from ChatFilter import DEFAULT_EMOTES
+
+# words of three or more characters, starting with a letter
+_TOKEN = re.compile(r"\b[^\W\d_][\w']{2,}")
+
+# too common to tell anything
+STOPWORDS = frozenset([
+    'the', 'and', 'you', 'that', 'this', 'for', 'are', 'was', 'with',
+    'have', 'not', 'but', 'just', 'its', "it's", 'what', 'can', 'all',
+    'get', 'his', 'her', 'she', 'him', 'they', 'how', 'why', 'who', "i'm",
+    'your', 'from', 'like', 'out', 'one', 'now', 'yes', 'has', 'had',
+])
+
+
+class RateRing(object):
+    """
+    Counts per time bucket, for the last buckets * width seconds.
+    :param buckets: number of buckets kept
+    :param width: seconds per bucket
+    """
+
+    def __init__(self, buckets=60, width=1.):
+        self.width = width
+        self.counts = [0] * buckets
+        self.current = None
+        self.first = None
+
+    def _advance(self, now):
+        index = int(now // self.width)
+        current = self.current
+        if current is None or index - current >= len(self.counts):
+            self.counts = [0] * len(self.counts)
+        elif index > current:
+            size = len(self.counts)
+            for passed in range(current + 1, index + 1):
+                self.counts[passed % size] = 0
+        else:
+            # the same bucket, or a clock that went back: count it here
+            return current
+        self.current = index
+        return index
+
+    def add(self, now, amount=1):
+        index = self._advance(now)
+        if self.first is None:
+            self.first = index
+        self.counts[index % len(self.counts)] += amount
+
+    def series(self, now):
+        """:return: the counts of every bucket, oldest first"""
+        index = self._advance(now)
+        size = len(self.counts)
+        return [self.counts[(index + 1 + i) % size] for i in range(size)]
+
+    def rate(self, now, seconds):
+        """
+        Mean per second over the last seconds (whole buckets, counting
+        the current one in full), or since the first count when that was
+        more recent.
+        """
+        series = self.series(now)
+        if self.first is None:
+            return 0.
+        buckets = min(len(series), max(1, int(round(seconds / self.width))),
+                      self.current - self.first + 1)
+        return sum(series[-buckets:]) / (buckets * self.width)
+
+
+class CountMinSketch(object):
+    """
+    Approximate counts of any number of keys in depth * width counters.
+    :param width: counters per row; the over-count is about
+        total / width
+    :param depth: rows; more rows make a large over-count less likely
+    """
+
+    def __init__(self, width=4096, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array.array('L', bytes(array.array('L').itemsize *
+                                            width))
+                     for _ in range(depth)]
+        self.total = 0
+
+    def add(self, key, amount=1):
+        self.total += amount
+        # one column per row, by double hashing
+        h = hash(key)
+        step = (h >> 32) | 1
+        width = self.width
+        for row in self.rows:
+            row[h % width] += amount
+            h += step
+
+    def estimate(self, key):
+        h = hash(key)
+        step = (h >> 32) | 1
+        width = self.width
+        smallest = None
+        for row in self.rows:
+            count = row[h % width]
+            if smallest is None or count < smallest:
+                smallest = count
+            h += step
+        return smallest
+
+
+class SpaceSaving(object):
+    """
+    The heaviest hitters of a stream in capacity counters. A key that is
+    not counted takes over the smallest counter, and inherits its count
+    as the error bound.
+    :param capacity: number of keys counted
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # one (count, key) entry per key; the count may be stale (too
+        # low) and is only refreshed when the entry reaches the top
+        self._heap = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, amount=1):
+        counts = self.counts
+        count = counts.get(key)
+        if count is not None:
+            counts[key] = count + amount
+            return
+        heap = self._heap
+        if len(counts) < self.capacity:
+            counts[key] = amount
+            self.errors[key] = 0
+            heapq.heappush(heap, (amount, key))
+            return
+        while True:
+            low, victim = heap[0]
+            current = counts[victim]
+            if current == low:
+                break
+            heapq.heapreplace(heap, (current, victim))
+        heapq.heapreplace(heap, (low + amount, key))
+        del counts[victim]
+        del self.errors[victim]
+        counts[key] = low + amount
+        self.errors[key] = low
+
+    def update(self, keys):
+        """Count each of keys by one."""
+        counts = self.counts
+        add = self.add
+        for key in keys:
+            if key in counts:
+                counts[key] += 1
+            else:
+                add(key)
+
+    def top(self, n=10):
+        """:return: list of (key, count, error), largest count first"""
+        best = heapq.nlargest(n, self.counts.items(), key=lambda item: item[1])
+        return [(key, count, self.errors[key]) for key, count in best]
+
+
+class ChannelAnalytics(object):
+    """The counters of one channel."""
+
+    def __init__(self, capacity, sketch_width, sketch_depth):
+        self.messages = 0
+        self.characters = 0
+        self.last = None
+        self.per_second = RateRing(60, 1.)
+        self.per_minute = RateRing(60, 60.)
+        self.chatters = SpaceSaving(capacity)
+        self.emotes = SpaceSaving(capacity)
+        self.tokens = SpaceSaving(capacity)
+        self.users = CountMinSketch(sketch_width, sketch_depth)
+
+
+class ChatAnalytics(object):
+    """
+    Rolling statistics of the chat, per channel. observe() is called on
+    the reading thread, snapshot(), rates() and user() from any other.
+    :param capacity: chatters, emotes and words tracked per channel
+    :param emotes: emote names recognized in messages without emote tags
+    :param sketch_width: counters per row of the per-chatter sketch
+    :param sketch_depth: rows of the per-chatter sketch
+    :param max_tokens: words of one message that are counted
+    """
+
+    def __init__(self, capacity=200, emotes=DEFAULT_EMOTES, sketch_width=4096,
+                 sketch_depth=4, max_tokens=12):
+        self.capacity = capacity
+        self.emotes = frozenset(emotes)
+        # emotes are not words, in any case
+        self._not_words = STOPWORDS.union(emote.lower() for emote in emotes)
+        self.sketch_width = sketch_width
+        self.sketch_depth = sketch_depth
+        self.max_tokens = max_tokens
+        self.channels = {}
+        self._lock = threading.Lock()
+
+    def _channel(self, name):
+        channel = self.channels.get(name)
+        if channel is None:
+            channel = self.channels[name] = ChannelAnalytics(
+                self.capacity, self.sketch_width, self.sketch_depth)
+        return channel
+
+    def observe(self, message, now=None):
+        """
+        Count one chat message.
+        :param now: time.time(), passed in by replays and tests
+        """
+        if now is None:
+            now = time.time()
+        text = message.message
+        user = message.username.lower()
+        # emotes and words count once per message, so spamming one does
+        # not push everything else out of the top lists
+        words = text.split()
+        ranges = message.emote_ranges
+        if ranges is not None:
+            emotes = set(text[start:end] for start, end, _ in ranges)
+        else:
+            emotes = self.emotes.intersection(words)
+        tokens = ()
+        # an emote only line has no words worth counting
+        if len(emotes) < len(words):
+            tokens = set(_TOKEN.findall(text.lower()))
+            tokens -= self._not_words
+            if len(tokens) > self.max_tokens:
+                tokens = itertools.islice(tokens, self.max_tokens)
+        with self._lock:
+            channel = self._channel(message.channel[1:])
+            channel.messages += 1
+            channel.characters += len(text)
+            channel.last = now
+            channel.per_second.add(now)
+            channel.per_minute.add(now)
+            channel.chatters.add(user)
+            channel.users.add(user)
+            channel.emotes.update(emotes)
+            channel.tokens.update(tokens)
+
+    def user(self, name, channel):
+        """:return: estimated number of messages of a chatter in a channel"""
+        with self._lock:
+            stats = self.channels.get(channel)
+            return 0 if stats is None else stats.users.estimate(name.lower())
+
+    def _top_chatters(self, stats, top):
+        """
+        The Space-Saving counts are tightened with the sketch, which
+        over-counts less when many chatters write about as much.
+        """
+        chatters = []
+        for user, count, error in stats.chatters.top(len(stats.chatters)):
+            estimate = min(count, stats.users.estimate(user))
+            chatters.append((user, estimate,
+                             max(0, estimate - (count - error))))
+        chatters.sort(key=lambda chatter: -chatter[1])
+        return chatters[:top]
+
+    def snapshot(self, channel=None, top=10, now=None):
+        """
+        :param channel: channel name without '#', None for every channel
+        :param top: entries in the top lists
+        :return: dict of channel name to its statistics
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            names = sorted(self.channels) if channel is None else \
+                [channel] if channel in self.channels else []
+            result = {}
+            for name in names:
+                stats = self.channels[name]
+                result[name] = {
+                    'messages': stats.messages,
+                    'mean_length': stats.characters / float(stats.messages),
+                    'per_second_10s': stats.per_second.rate(now, 10.),
+                    'per_second_1m': stats.per_second.rate(now, 60.),
+                    'per_minute_1h': stats.per_minute.rate(now, 3600.) * 60.,
+                    'last_minute': stats.per_second.series(now),
+                    'last_hour': stats.per_minute.series(now),
+                    'top_chatters': self._top_chatters(stats, top),
+                    'top_emotes': stats.emotes.top(top),
+                    'top_words': stats.tokens.top(top),
+                    'seconds_since_last': now - stats.last,
+                }
+            return result
+
+    def rates(self, now=None):
+        """:return: dict of channel to messages per second, last 10 seconds"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            return dict((name, stats.per_second.rate(now, 10.))
+                        for name, stats in self.channels.items())
+
+
+def format_snapshot(snapshot):
+    """:return: a ChatAnalytics snapshot as lines of text for people"""
+    lines = []
+    for name, stats in sorted(snapshot.items()):
+        lines.append("#%s: %d messages, %.1f/s (10 s), %.1f/s (1 min), "
+                     "%.0f/min (1 h)" % (name, stats['messages'],
+                                         stats['per_second_10s'],
+                                         stats['per_second_1m'],
+                                         stats['per_minute_1h']))
+        for title, key in (("chatters", 'top_chatters'),
+                           ("emotes", 'top_emotes'),
+                           ("words", 'top_words')):
+            if stats[key]:
+                lines.append("  top %s: %s" % (title, ", ".join(
+                    "%s %d" % (item, count)
+                    for item, count, _ in stats[key])))
+    return lines
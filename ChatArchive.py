@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only archive of the chat, for moderation review and analytics.
+
+ChatArchive.append() only puts a message on an in-memory list; a
+background thread takes batches off that list and writes each batch as
+one compressed block to a segment file. Inside a block every field is
+stored as its own column (all timestamps, then all channels, all users,
+all tags, all texts), which compresses far better than whole lines.
+
+    <directory>/chat-20240101-120000-000000.seg   blocks, appended only
+    <directory>/chat-20240101-120000-000000.idx   one JSON line per block
+
+A block is a fixed header followed by the zlib-compressed columns:
+
+    magic 'TCA1', count, earliest time, latest time, 5 column lengths
+
+The index line of a block records its offset, size, time range and
+message count per channel, so ArchiveReader can skip whole blocks when
+looking for a time range or a channel. Segments are fsynced when they
+are rotated or closed, never per message. A block that was cut short by
+a crash is ignored when reading.
+"""
+import array
+import collections
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+MAGIC = b'TCA1'
+HEADER = struct.Struct('<4sIdd5I')
+COLUMNS = ('time', 'channel', 'user', 'tags', 'text')
+
+
+class ArchivedMessage(collections.namedtuple('ArchivedMessage', COLUMNS)):
+    """
+    One archived chat message.
+    time is in seconds since the epoch, channel includes the '#'.
+    """
+    __slots__ = ()
+
+    def to_line(self):
+        """Rebuild the raw IRC line, e.g. for replaying it."""
+        line = ':{0}!{0}@{0}.tmi.twitch.tv PRIVMSG {1} :{2}'.format(
+            self.user, self.channel, self.text)
+        if self.tags:
+            line = '@%s %s' % (self.tags, line)
+        return line
+
+
+def encode_block(records, level=6):
+    """
+    Encode (time, channel, user, tags, text) tuples into a block.
+    :return: the bytes of the block
+    """
+    columns = list(zip(*records))
+    times = array.array('d', columns[0])
+    if sys.byteorder == 'big':
+        times.byteswap()  # blocks are little-endian
+    bodies = [zlib.compress(times.tobytes(), level)]
+    for column in columns[1:]:
+        # chat lines never contain a newline, so it separates the values
+        bodies.append(zlib.compress('\n'.join(column).encode('utf-8'), level))
+    header = HEADER.pack(MAGIC, len(records), min(columns[0]),
+                         max(columns[0]), *[len(body) for body in bodies])
+    return header + b''.join(bodies)
+
+
+def decode_block(data):
+    """
+    :param data: the bytes of one block
+    :return: list of ArchivedMessage
+    """
+    lengths = HEADER.unpack_from(data)[4:]
+    offset = HEADER.size
+    columns = []
+    for length in lengths:
+        columns.append(zlib.decompress(data[offset:offset + length]))
+        offset += length
+    times = array.array('d')
+    times.frombytes(columns[0])
+    if sys.byteorder == 'big':
+        times.byteswap()
+    strings = [column.decode('utf-8').split('\n') for column in columns[1:]]
+    return [ArchivedMessage(*fields) for fields in zip(times, *strings)]
+
+
+class ChatArchive(object):
+    """
+    Background writer of the archive.
+    :param directory: where the segment files go
+    :param batch_size: messages per block at most; a full batch is
+        written right away
+    :param flush_interval: seconds a message waits at most before its
+        (partial) batch is written
+    :param max_segment_bytes: start a new segment file beyond this size
+    :param max_pending: messages held in memory at most; when the disk
+        cannot keep up, newer messages are dropped instead of blocking
+        the receive loop
+    :param level: zlib compression level
+    """
+
+    def __init__(self, directory, batch_size=1000, flush_interval=1.,
+                 max_segment_bytes=64 * 1024 * 1024, max_pending=100000,
+                 level=6):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_segment_bytes = max_segment_bytes
+        self.max_pending = max_pending
+        self.level = level
+        self.archived = 0
+        self.dropped = 0
+        self.blocks = 0
+        self.bytes_written = 0
+        self.errors = 0
+        self._pending = []
+        self._writing = False
+        self._closed = False
+        self._lock = threading.Condition()
+        self._wakeup = threading.Event()
+        self._segment = None
+        self._index = None
+        self._segment_number = 0
+        self._segment_prefix = time.strftime('chat-%Y%m%d-%H%M%S')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, message, received=None):
+        """
+        Queue a chat message for the archive; never blocks on the disk.
+        :param message: an IRCMessage of a PRIVMSG
+        :param received: time.time() it was received; used when the
+            message carries no server timestamp
+        :return: False when it was dropped because too much is pending
+        """
+        sent = message.timestamp if message.has_tags else None
+        if sent is None:
+            sent = received if received is not None else time.time()
+        # a line without prefix has no username; the columns need strings
+        record = (sent, message.channel or '', message.username or '',
+                  message.raw_tags, message.message or '')
+        with self._lock:
+            if self._closed or len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return False
+            self._pending.append(record)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Write everything appended so far.
+        :return: False when that did not finish within timeout seconds
+        """
+        self._wakeup.set()
+        with self._lock:
+            return self._lock.wait_for(
+                lambda: not self._pending and not self._writing, timeout)
+
+    def close(self):
+        """Write what is pending, then close the segment files."""
+        with self._lock:
+            self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            with self._lock:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                self._writing = bool(batch)
+                more = bool(self._pending)
+                closed = self._closed
+            if batch:
+                self._write_block(batch)
+            with self._lock:
+                self._writing = False
+                self._lock.notify_all()
+            if more:
+                self._wakeup.set()
+            elif closed:
+                break
+        self._close_segment()
+
+    def _write_block(self, batch):
+        try:
+            block = encode_block(batch, self.level)
+            if self._segment is None or \
+                    self._segment.tell() + len(block) > self.max_segment_bytes:
+                self._open_segment()
+            offset = self._segment.tell()
+            self._segment.write(block)
+            self._segment.flush()
+            channels = collections.Counter(record[1] for record in batch)
+            self._index.write(json.dumps({
+                'offset': offset,
+                'length': len(block),
+                'count': len(batch),
+                'start': min(record[0] for record in batch),
+                'end': max(record[0] for record in batch),
+                'channels': channels,
+            }) + '\n')
+            self._index.flush()
+        except (IOError, OSError, TypeError, ValueError) as e:
+            # count the lost batch, but keep the writer thread alive
+            self.errors += 1
+            print ("Could not write chat archive: ", e)
+            return
+        self.archived += len(batch)
+        self.blocks += 1
+        self.bytes_written += len(block)
+
+    def _open_segment(self):
+        self._close_segment()
+        name = '%s-%06d' % (self._segment_prefix, self._segment_number)
+        self._segment_number += 1
+        path = os.path.join(self.directory, name)
+        self._segment = open(path + '.seg', 'ab')
+        self._index = open(path + '.idx', 'a')
+
+    def _close_segment(self):
+        for f in (self._segment, self._index):
+            if f is not None:
+                try:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    f.close()
+                except (IOError, OSError) as e:
+                    print ("Could not close chat archive segment: ", e)
+        self._segment = None
+        self._index = None
+
+    def stats(self):
+        """:return: dict with the archive counters"""
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'archived': self.archived,
+            'pending': pending,
+            'dropped': self.dropped,
+            'blocks': self.blocks,
+            'bytes': self.bytes_written,
+            'errors': self.errors,
+        }
+
+
+def _segment_order(name):
+    """Sort key of a segment file name: its prefix, then its number."""
+    prefix, _, number = name[:-len('.seg')].rpartition('-')
+    try:
+        return prefix, int(number)
+    except ValueError:
+        return name, -1
+
+
+class ArchiveReader(object):
+    """
+    Reads an archive directory written by ChatArchive.
+    :param directory: the archive directory
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def segments(self):
+        """:return: paths of the segment files, oldest first"""
+        names = sorted((name for name in os.listdir(self.directory)
+                        if name.endswith('.seg')), key=_segment_order)
+        return [os.path.join(self.directory, name) for name in names]
+
+    @staticmethod
+    def _index_of(path):
+        """
+        The block index of a segment. Blocks missing from the .idx file
+        (e.g. after a crash) are found by walking the block headers.
+        """
+        entries = []
+        index_path = path[:-4] + '.idx'
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break
+        size = os.path.getsize(path)
+        offset = entries[-1]['offset'] + entries[-1]['length'] if entries else 0
+        with open(path, 'rb') as f:
+            while offset + HEADER.size <= size:
+                f.seek(offset)
+                header = HEADER.unpack(f.read(HEADER.size))
+                length = HEADER.size + sum(header[4:])
+                if header[0] != MAGIC or offset + length > size:
+                    break
+                entries.append({'offset': offset, 'length': length,
+                                'count': header[1], 'start': header[2],
+                                'end': header[3], 'channels': None})
+                offset += length
+        return entries
+
+    def messages(self, start=None, end=None, channels=None):
+        """
+        Iterate over the archived messages in the order they were written.
+        :param start: only messages at or after this time.time()
+        :param end: only messages before this time.time()
+        :param channels: only these channels (with or without '#')
+        :return: generator of ArchivedMessage
+        """
+        if channels is not None:
+            channels = set('#' + c.lstrip('#').lower() for c in channels)
+        for path in self.segments():
+            with open(path, 'rb') as f:
+                for entry in self._index_of(path):
+                    if start is not None and entry['end'] < start:
+                        continue
+                    if end is not None and entry['start'] >= end:
+                        continue
+                    if channels is not None and entry['channels'] is not None \
+                            and channels.isdisjoint(entry['channels']):
+                        continue
+                    f.seek(entry['offset'])
+                    for message in decode_block(f.read(entry['length'])):
+                        if start is not None and message.time < start:
+                            continue
+                        if end is not None and message.time >= end:
+                            continue
+                        if channels is not None and \
+                                message.channel not in channels:
+                            continue
+                        yield message
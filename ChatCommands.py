@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Chat commands viewers and moderators can use in the channel:
+
+    !tts <text>         read text aloud, even with the @ filter on
+    !voice [volume]     tell what reads the chat; moderators can set the
+                        volume (0 to 100)
+    !skip               moderators: drop everything waiting to be read
+    !mute <user>        moderators: stop reading a chatter
+    !unmute <user>      moderators: read a chatter again
+
+ChatCommands sits in the ChatReader before the ChatFilter. A line that
+does not start with the prefix costs one comparison; a command is found
+with one dict lookup. Each command has a permission level and cooldowns
+per chatter and for the whole channel, kept in Cooldowns, which forgets
+a cooldown once it is over. Moderators are not held by cooldowns.
+Replies go through send_chat_message, so they wait in the rate limited
+outbound queue like any other chat message.
+"""
+import heapq
+import itertools
+import time
+
+# permission levels
+EVERYONE = 0
+SUBSCRIBER = 1
+MODERATOR = 2
+BROADCASTER = 3
+
+# what dispatch() returns besides None (not a command) and the outcomes
+# of ChatReader.handle()
+HANDLED = 'command'
+DENIED = 'command_denied'
+COOLDOWN = 'command_cooldown'
+SPOKEN = 'command_spoken'
+
+
+def permission_of(user, message):
+    """
+    Permission level of the sender of a message.
+    :param user: lowercase username
+    :param message: the IRCMessage; without IRCv3 tags only the
+        broadcaster is recognized, by name
+    """
+    if message.channel[1:] == user:
+        return BROADCASTER
+    if message.has_tags:
+        if 'broadcaster' in message.badges:
+            return BROADCASTER
+        if message.is_moderator:
+            return MODERATOR
+        if message.is_subscriber:
+            return SUBSCRIBER
+    return EVERYONE
+
+
+class Cooldowns(object):
+    """
+    Keys that are cooling down, each until its own time. A heap of the
+    end times lets start() drop cooldowns that are over, so the dict only
+    holds the active ones.
+    """
+
+    def __init__(self):
+        self.until = {}
+        self._ends = []
+        self._order = itertools.count()
+
+    def __len__(self):
+        return len(self.until)
+
+    def active(self, key, now):
+        until = self.until.get(key)
+        return until is not None and until > now
+
+    def start(self, key, seconds, now):
+        """Cool key down for seconds from now."""
+        ends = self._ends
+        while ends and ends[0][0] <= now:
+            end, _, old = heapq.heappop(ends)
+            if self.until.get(old) == end:
+                del self.until[old]
+        if seconds > 0:
+            self.until[key] = now + seconds
+            heapq.heappush(ends, (now + seconds, next(self._order), key))
+
+
+class Command(object):
+    """
+    One chat command.
+    :param handler: called with a CommandContext, returns the outcome or
+        None for HANDLED
+    :param permission: lowest permission level allowed to use it
+    :param user_cooldown: seconds before the same chatter can use it again
+    :param global_cooldown: seconds before anybody can use it again
+    """
+    __slots__ = ('name', 'handler', 'permission', 'user_cooldown',
+                 'global_cooldown', 'help')
+
+    def __init__(self, name, handler, permission=EVERYONE, user_cooldown=0.,
+                 global_cooldown=0., help=''):
+        self.name = name
+        self.handler = handler
+        self.permission = permission
+        self.user_cooldown = user_cooldown
+        self.global_cooldown = global_cooldown
+        self.help = help
+
+
+class CommandContext(object):
+    """What a command handler gets: the reader, the sender and the arguments."""
+    __slots__ = ('reader', 'user', 'args', 'message', 'permission')
+
+    def __init__(self, reader, user, args, message, permission):
+        self.reader = reader
+        self.user = user
+        self.args = args
+        self.message = message
+        self.permission = permission
+
+    @property
+    def channel(self):
+        """Channel name, without '#'."""
+        return self.message.channel[1:]
+
+    def reply(self, text):
+        """Answer the sender in the channel."""
+        self.reader.stream.send_chat_message(self.channel,
+                                             "@%s %s" % (self.user, text))
+
+
+class ChatCommands(object):
+    """
+    Dispatch table of chat commands, with the built-in ones.
+    :param prefix: what a command starts with
+    :param tts_permission: permission level needed for !tts
+    :param user_cooldown: default seconds between two commands of one
+        chatter
+    :param global_cooldown: default seconds between two uses of one
+        command in the channel
+    :param replies: answer in the channel; False to act silently
+    """
+
+    def __init__(self, prefix='!', tts_permission=EVERYONE, user_cooldown=30.,
+                 global_cooldown=3., replies=True):
+        self.prefix = prefix
+        self.replies = replies
+        self.commands = {}
+        self.cooldowns = Cooldowns()
+        self.used = {}
+        self.add(Command('tts', self._tts, tts_permission, user_cooldown,
+                         global_cooldown, "!tts <text> reads text aloud"))
+        self.add(Command('voice', self._voice, EVERYONE, user_cooldown,
+                         10., "!voice tells what reads the chat"))
+        self.add(Command('skip', self._skip, MODERATOR,
+                         help="!skip drops what is waiting to be read"))
+        self.add(Command('mute', self._mute, MODERATOR,
+                         help="!mute <user> stops reading a chatter"))
+        self.add(Command('unmute', self._unmute, MODERATOR,
+                         help="!unmute <user> reads a chatter again"))
+
+    def add(self, command):
+        """Register a command, replacing one of the same name."""
+        self.commands[command.name] = command
+
+    def dispatch(self, reader, user, text, message, now=None):
+        """
+        Run the command in a chat line, if it is one.
+        :param reader: the ChatReader the line came through
+        :param user: lowercase username of the sender
+        :param now: time.monotonic(), passed in by tests
+        :return: None when the line is not a known command, otherwise
+            its outcome: HANDLED, SPOKEN, DENIED, COOLDOWN or the reason
+            the text of a command was not read
+        """
+        if not text.startswith(self.prefix):
+            return None
+        name, _, args = text[len(self.prefix):].partition(' ')
+        command = self.commands.get(name.lower())
+        if command is None:
+            return None
+        permission = permission_of(user, message)
+        if permission < command.permission:
+            return DENIED
+        if now is None:
+            now = time.monotonic()
+        cooldowns = self.cooldowns
+        if permission < MODERATOR:
+            if cooldowns.active((command.name, None), now) or \
+                    cooldowns.active((command.name, user), now):
+                return COOLDOWN
+        outcome = command.handler(CommandContext(reader, user, args.strip(),
+                                                 message, permission))
+        cooldowns.start((command.name, None), command.global_cooldown, now)
+        cooldowns.start((command.name, user), command.user_cooldown, now)
+        self.used[command.name] = self.used.get(command.name, 0) + 1
+        return outcome or HANDLED
+
+    def _reply(self, context, text):
+        if self.replies:
+            context.reply(text)
+
+    def _tts(self, context):
+        if not context.args:
+            return HANDLED
+        reader = context.reader
+        reason = reader.chat_filter.check(context.user, context.args,
+                                          context.message)
+        # asking with !tts is as good as an @mention
+        if reason is not None and reason != 'no_mention':
+            return reason
+        if reader.say(context.user, context.args, context.message) is not None:
+            return 'speech_queue'
+        return SPOKEN
+
+    def _voice(self, context):
+        reader = context.reader
+        if context.args and context.permission >= MODERATOR:
+            try:
+                reader.volume = min(100, max(0, int(context.args)))
+            except ValueError:
+                pass
+        self._reply(context, "Chat is read by the %s voice at volume %d, "
+                             "%d lines waiting" % (reader.speech.backend.name,
+                                                   reader.volume,
+                                                   len(reader.speech.queue)))
+
+    def _skip(self, context):
+        queue = context.reader.speech.queue
+        waiting = len(queue)
+        queue.clear()
+        self._reply(context, "Skipped %d lines" % waiting)
+
+    def _mute(self, context):
+        target = context.args.lstrip('@').lower()
+        if target:
+            reader = context.reader
+            reader.chat_filter = reader.chat_filter.replace(
+                muted_users=reader.chat_filter.muted_users | {target})
+            self._reply(context, "%s will not be read" % target)
+
+    def _unmute(self, context):
+        target = context.args.lstrip('@').lower()
+        if target:
+            reader = context.reader
+            reader.chat_filter = reader.chat_filter.replace(
+                muted_users=reader.chat_filter.muted_users - {target})
+            self._reply(context, "%s will be read again" % target)
+
+    def stats(self):
+        """:return: dict of command name to times it was run"""
+        return dict(self.used)
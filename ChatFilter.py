@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Decides which chat messages are read aloud.
+
+ChatFilter is built once from the current settings (muted users, the
+@channel filter, the character limit, blocklists) and then only applies
+a short list of precompiled checks to every message. Lookups use sets
+and a single combined regular expression, so the cost per message does
+not grow with the size of the mute list or the blocklists. Build a new
+ChatFilter when the settings change.
+"""
+import re
+
+# a few global emotes, used by the emote-only check for messages without
+# IRCv3 emote tags
+DEFAULT_EMOTES = frozenset([
+    '4Head', 'BabyRage', 'BibleThump', 'BloodTrail', 'CoolStoryBob',
+    'DansGame', 'EleGiggle', 'FailFish', 'Jebaited', 'Kappa', 'KappaPride',
+    'Kreygasm', 'LUL', 'MingLee', 'NotLikeThis', 'PJSalt', 'PogChamp',
+    'ResidentSleeper', 'SMOrc', 'SeemsGood', 'SwiftRage', 'TriHard',
+    'VoHiYo', 'WutFace', 'cmonBruh', 'monkaS', 'KEKW', 'OMEGALUL', 'Pog',
+    '<3', ':)', ':(', ':D', ';)', ':P',
+])
+
+_WORDS = re.compile(r"[\w']+")
+
+
+class ChatFilter(object):
+    """
+    Compiled message filter.
+    :param muted_users: usernames whose messages are never read
+    :param mention: channel name; when set, only messages containing
+        '@mention' (in any case) are read
+    :param max_length: messages of this many characters or more are
+        skipped, None for no limit
+    :param blocked_words: words (case-insensitive) that skip a message
+    :param blocked_patterns: regular expressions that skip a message
+    :param skip_emote_only: skip messages that consist of emotes only
+    :param emotes: emote names known to the emote-only check
+    """
+
+    def __init__(self, muted_users=(), mention=None, max_length=None,
+                 blocked_words=(), blocked_patterns=(),
+                 skip_emote_only=False, emotes=DEFAULT_EMOTES):
+        self.muted_users = frozenset(u.lower() for u in muted_users)
+        self.mention = mention
+        self.max_length = max_length
+        self.blocked_words = frozenset(w.lower() for w in blocked_words)
+        self.blocked_patterns = tuple(blocked_patterns)
+        self.skip_emote_only = skip_emote_only
+        self.emotes = frozenset(emotes)
+        self.checks = self._compile()
+
+    def __reduce__(self):
+        # the compiled checks are closures; pickle the settings instead
+        # (e.g. to hand the filter to ParseWorkers processes)
+        return (ChatFilter, (self.muted_users, self.mention, self.max_length,
+                             self.blocked_words, self.blocked_patterns,
+                             self.skip_emote_only, self.emotes))
+
+    def replace(self, **changes):
+        """
+        :return: a new ChatFilter with the same settings but the given
+            ones, e.g. replace(muted_users=...)
+        """
+        settings = dict(muted_users=self.muted_users, mention=self.mention,
+                        max_length=self.max_length,
+                        blocked_words=self.blocked_words,
+                        blocked_patterns=self.blocked_patterns,
+                        skip_emote_only=self.skip_emote_only,
+                        emotes=self.emotes)
+        settings.update(changes)
+        return ChatFilter(**settings)
+
+    def _compile(self):
+        """Build the list of (reason, check) pairs, cheapest first."""
+        checks = []
+        if self.muted_users:
+            muted = self.muted_users
+            checks.append(('muted', lambda user, text, message: user in muted))
+        if self.max_length is not None:
+            max_length = self.max_length
+            checks.append(('too_long',
+                           lambda user, text, message: len(text) >= max_length))
+        if self.mention:
+            find_mention = re.compile('@' + re.escape(self.mention),
+                                      re.IGNORECASE).search
+            checks.append(('no_mention',
+                           lambda user, text, message:
+                           find_mention(text) is None))
+        if self.blocked_words:
+            words = self.blocked_words
+            findall = _WORDS.findall
+            checks.append(('blocked_word',
+                           lambda user, text, message:
+                           not words.isdisjoint(findall(text.lower()))))
+        if self.blocked_patterns:
+            find_blocked = re.compile('|'.join('(?:%s)' % p for p in
+                                               self.blocked_patterns)).search
+            checks.append(('blocked_pattern',
+                           lambda user, text, message:
+                           find_blocked(text) is not None))
+        if self.skip_emote_only:
+            emotes = self.emotes
+
+            def emote_only(user, text, message):
+                # the emote tags are exact; the emote list is a fallback
+                if message is not None:
+                    tagged = message.is_emote_only()
+                    if tagged is not None:
+                        return tagged
+                return emotes.issuperset(text.split())
+            checks.append(('emote_only', emote_only))
+        return checks
+
+    def check(self, user, text, message=None):
+        """
+        Run the message through the filter.
+        :param user: lowercase username of the sender
+        :param text: the chat message
+        :param message: the IRCMessage, when available; its IRCv3 tags
+            make some checks exact
+        :return: None when the message should be read, otherwise the name
+            of the check that rejected it
+        """
+        for reason, rejects in self.checks:
+            if rejects(user, text, message):
+                return reason
+        return None
+
+    def __call__(self, user, text, message=None):
+        """:return: True when the message should be read"""
+        return self.check(user, text, message) is None
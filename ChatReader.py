@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+The chat reading core, shared by the GUI (TwitchChatBot.py) and the
+headless daemon (TwitchChatDaemon.py).
+
+ChatReader takes the messages of a TwitchChatStream, runs them through
+the ChatFilter and hands what passes to the SpeechWorker. It does not
+import tkinter or any keyboard hook.
+"""
+import select
+import time
+
+from ChatCommands import SPOKEN
+from ChatFilter import ChatFilter
+
+# handle() result for a line waiting for the selector's slot to end
+HELD = 'held'
+
+
+class ChatReader(object):
+    """
+    Reads the chat of one connection aloud.
+    :param stream: a connected TwitchChatStream
+    :param speech: the SpeechWorker to speak with
+    :param chat_filter: the ChatFilter deciding what is read
+    :param channels: channel names (without #) to read, None to read
+        every joined channel
+    :param volume: speech volume from 0 to 100
+    :param strip_emotes: leave emotes out of the spoken text (needs the
+        IRCv3 emote tags)
+    :param archive: a ChatArchive that keeps every chat message received,
+        read or not; None to keep nothing
+    :param metrics: optional Metrics to count outcomes and time the
+        filter and the way to the speech queue in
+    :param commands: optional ChatCommands, run on the lines that are
+        commands instead of reading them
+    :param duplicates: optional DuplicateDetector; lines that pass the
+        filter but repeat a recent line are skipped as 'duplicate'
+    :param selector: optional SpeechSelector; lines that pass the filter
+        are then held for its slot and only the selected ones are read
+    :param analytics: optional ChatAnalytics that counts every chat
+        message received, read or not
+    :param verbose: print every line that is read
+    """
+
+    def __init__(self, stream, speech, chat_filter=None, channels=None,
+                 volume=50, strip_emotes=False, archive=None, metrics=None,
+                 commands=None, duplicates=None, selector=None,
+                 analytics=None, verbose=False):
+        self.stream = stream
+        self.speech = speech
+        self.chat_filter = chat_filter or ChatFilter()
+        self.set_channels(channels)
+        self.volume = volume
+        self.strip_emotes = strip_emotes
+        self.archive = archive
+        self.metrics = metrics
+        self.commands = commands
+        self.duplicates = duplicates
+        self.selector = selector
+        self.analytics = analytics
+        self.verbose = verbose
+        self.read = 0
+        self.skipped = 0
+
+    def set_channels(self, channels):
+        """
+        Only read these channels from now on.
+        :param channels: channel names (without #), None for all
+        """
+        self.channels = None if channels is None else set(channels)
+
+    def handle(self, message, now=None):
+        """
+        Filter one chat message and queue it for speech.
+        :param message: an IRCMessage from the stream
+        :param now: the time of the message when replaying recorded chat,
+            used by the duplicate detector and the selector instead of
+            the clock, and counted at that time by the analytics; None
+            for live chat
+        :return: None when the message was queued, HELD when it waits for
+            the selector, otherwise the reason it was skipped
+        """
+        reason = self._handle(message, now)
+        if reason != HELD:
+            self._count(reason, message)
+        return reason
+
+    def _count(self, reason, message=None, amount=1):
+        if reason is None:
+            self.read += amount
+        else:
+            self.skipped += amount
+        if self.metrics is not None:
+            self.metrics.messages.inc(reason or 'read', amount)
+            if reason is None:
+                self.metrics.queue.observe(time.monotonic() -
+                                           message.received)
+
+    def _handle(self, message, now=None):
+        if message.received is None:
+            message.received = time.monotonic()
+        if self.archive is not None:
+            self.archive.append(message)
+        if self.analytics is not None:
+            self.analytics.observe(message, now)
+        if self.channels is not None and message.channel[1:] not in self.channels:
+            return 'other_channel'
+        user = message.username.lower()
+        text = message.message
+        if self.commands is not None:
+            outcome = self.commands.dispatch(self, user, text, message)
+            if outcome is not None:
+                return None if outcome == SPOKEN else outcome
+        if getattr(self.stream, 'chat_filter', None) is self.chat_filter:
+            # a ParallelReceiver's workers passed it with this filter
+            reason = None
+        elif self.metrics is None:
+            reason = self.chat_filter.check(user, text, message)
+        else:
+            start = time.monotonic()
+            reason = self.chat_filter.check(user, text, message)
+            self.metrics.filter.observe(time.monotonic() - start)
+        if reason is not None:
+            return reason
+        if self.duplicates is not None and self.duplicates.check(text, now):
+            return 'duplicate'
+        if self.strip_emotes and message.has_tags:
+            text = message.text_without_emotes()
+        if self.selector is not None:
+            reason = self.selector.offer((user, text, message), user, text,
+                                         message, now)
+            return HELD if reason is None else reason
+        return self.say(user, text, message)
+
+    def say(self, user, text, message):
+        """
+        Queue a line for speech, without filtering it.
+        :return: None when it was queued, 'speech_queue' when dropped
+        """
+        if not self.speech.say(text, self.volume, user, message.received,
+                               prefix=user + " said:"):
+            return 'speech_queue'
+        if self.verbose:
+            print (user + " length: " + str(len(text)))
+        return None
+
+    def poll(self, timeout=None):
+        """
+        Wait until the server sends something, then handle everything
+        that was received.
+        :param timeout: seconds to wait at most, None to wait forever
+        """
+        try:
+            select.select([self.stream.s], [], [], timeout)
+        except (OSError, ValueError):
+            # the socket was closed or replaced by a reconnect
+            if timeout:
+                time.sleep(timeout)
+        self.receive()
+
+    def receive(self):
+        """Handle everything received so far, without waiting."""
+        for message in self.stream.twitch_receive_messages():
+            self.handle(message)
+        self.select()
+
+    def select(self, now=None, flush=False):
+        """
+        Read the lines the selector picked, once their slot is over.
+        Called by poll(); without a selector it does nothing.
+        :param now: the replayed time, None for live chat
+        :param flush: close the current slot even if it is not over, e.g.
+            at the end of a replay
+        """
+        if self.selector is None:
+            return
+        if flush:
+            chosen, passed_over = self.selector.flush(now)
+        else:
+            chosen, passed_over = self.selector.due(now)
+        for user, text, message in chosen:
+            self._count(self.say(user, text, message), message)
+        if passed_over:
+            self._count('not_selected', amount=passed_over)
+
+    def run(self, stopped):
+        """
+        Read the chat until stopped.
+        :param stopped: a threading.Event that ends the loop when set
+        """
+        while not stopped.is_set():
+            self.poll(1.)
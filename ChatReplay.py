@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Replays recorded chat through the reading pipeline, offline.
+
+The lines come from a raw IRC log or from a ChatArchive directory and go
+through the same steps as live chat: TwitchChatStream._parse_message,
+the ChatFilter and the speech queue, with the null speech backend
+standing in for a voice. That reproduces real traffic for tuning the
+filter and queue settings, and at full speed it is a repeatable
+performance test of the receive pipeline:
+
+    python ChatReplay.py --log chat.log --max --mute nightbot
+    python ChatReplay.py --archive archive/ --speed 10 --tts-rate 15
+
+A raw log has one line as received from the server per line. A line may
+start with the time.time() it was received and a tab; otherwise the
+tmi-sent-ts tag is used for pacing, when there is one. The replay takes
+the filter and speech queue options of TwitchChatDaemon.py.
+"""
+import collections
+import sys
+import time
+
+from ChatAnalytics import format_snapshot
+from ChatArchive import ArchiveReader
+from Speech import NullBackend
+from TwitchChatDaemon import build_parser, build_reader
+from TwitchChatStream import TwitchChatStream
+
+
+def log_source(path):
+    """
+    Lines of a raw IRC log.
+    :return: generator of (time or None, line)
+    """
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            sent = None
+            head, tab, rest = line.partition('\t')
+            if tab:
+                try:
+                    sent = float(head)
+                except ValueError:
+                    pass
+                else:
+                    line = rest
+            yield sent, line
+
+
+def archive_source(directory, start=None, end=None, channels=None):
+    """
+    Messages of a ChatArchive, as raw lines.
+    :return: generator of (time, line)
+    """
+    for message in ArchiveReader(directory).messages(start, end, channels):
+        yield message.time, message.to_line()
+
+
+class ReplayStream(TwitchChatStream):
+    """
+    A TwitchChatStream that is never connected. What it would send (the
+    PONGs) is only counted.
+    """
+
+    def __init__(self, username='replay'):
+        TwitchChatStream.__init__(self, username, 'oauth:replay')
+        self.sent = 0
+
+    def _send(self, message, lane=None):
+        self.sent += 1
+
+
+class _Timed(object):
+    """Stands in for obj, timing every call of one of its methods."""
+
+    def __init__(self, obj, method, samples):
+        self._obj = obj
+        self._method = getattr(obj, method)
+        self._samples = samples
+        setattr(self, method, self._call)
+
+    def __getattr__(self, name):
+        return getattr(self._obj, name)
+
+    def _call(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._method(*args, **kwargs)
+        finally:
+            self._samples.append(time.perf_counter() - start)
+
+
+def _percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return float('nan')
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class ChatReplay(object):
+    """
+    Feeds recorded lines through a ChatReader.
+    :param reader: a ChatReader reading a ReplayStream
+    :param speed: 1 for the original pace, N for N times faster, None
+        for as fast as possible
+    """
+    STAGES = ('parse', 'filter', 'queue', 'handle')
+
+    def __init__(self, reader, speed=None):
+        self.reader = reader
+        self.speed = speed
+        self.times = dict((stage, []) for stage in self.STAGES)
+        self.lines = 0
+        self.messages = 0
+        self.outcomes = collections.Counter()
+        self.elapsed = 0.
+        # time of the last line that had one, None without any
+        self.clock = None
+        reader.chat_filter = _Timed(reader.chat_filter, 'check',
+                                    self.times['filter'])
+        reader.speech = _Timed(reader.speech, 'say', self.times['queue'])
+
+    def _wait_until(self, sent, first):
+        """Sleep until the line sent at sent is due."""
+        due = first[1] + (sent - first[0]) / self.speed
+        ahead = due - time.perf_counter()
+        if ahead > 0:
+            time.sleep(ahead)
+
+    def run(self, source, limit=None):
+        """
+        Replay the lines of a source.
+        :param source: iterable of (time or None, raw line)
+        :param limit: stop after this many lines
+        """
+        parse = self.reader.stream._parse_message
+        handle = self.reader.handle
+        select = self.reader.select
+        parse_times = self.times['parse']
+        handle_times = self.times['handle']
+        perf_counter = time.perf_counter
+        first = None
+        start = perf_counter()
+        for sent, line in source:
+            if limit is not None and self.lines >= limit:
+                break
+            self.lines += 1
+            before = perf_counter()
+            message = parse(line)
+            parse_times.append(perf_counter() - before)
+            if message is None:
+                continue
+            self.messages += 1
+            if sent is None and message.has_tags:
+                sent = message.timestamp
+            if sent is not None:
+                # the recorded time drives the selector slots, at any speed
+                self.clock = sent
+                if self.speed:
+                    if first is None:
+                        first = (sent, perf_counter())
+                    self._wait_until(sent, first)
+            before = perf_counter()
+            self.outcomes[handle(message, self.clock) or 'read'] += 1
+            handle_times.append(perf_counter() - before)
+            select(self.clock)
+        # the lines of the last slot would otherwise never be read
+        select(self.clock, flush=True)
+        self.elapsed = perf_counter() - start
+        return self
+
+    def report(self):
+        """Print throughput, outcomes and the time spent per stage."""
+        print ("Replayed %d lines (%d chat messages) in %.2f s"
+               % (self.lines, self.messages, self.elapsed))
+        if self.elapsed > 0:
+            print ("  throughput    : %.0f lines/s" % (self.lines / self.elapsed))
+        for outcome, count in self.outcomes.most_common():
+            print ("  %-13s : %d" % (outcome, count))
+        print ("  %-8s %8s %9s %9s %9s %9s" % ('stage', 'calls', 'mean us',
+                                              'p50 us', 'p99 us', 'max us'))
+        for stage in self.STAGES:
+            samples = sorted(self.times[stage])
+            if not samples:
+                continue
+            print ("  %-8s %8d %9.2f %9.2f %9.2f %9.2f" % (
+                stage, len(samples), sum(samples) / len(samples) * 1e6,
+                _percentile(samples, .5) * 1e6,
+                _percentile(samples, .99) * 1e6, samples[-1] * 1e6))
+        if self.reader.duplicates is not None:
+            stats = self.reader.duplicates.stats()
+            print ("  duplicates    : %d of %d (%.1f%%), %d forgotten early"
+                   % (stats['duplicates'], stats['checked'],
+                      stats['hit_rate'] * 100, stats['evicted']))
+        if self.reader.selector is not None:
+            stats = self.reader.selector.stats()
+            print ("  selection     : %(mode)s, %(selected)d selected, "
+                   "%(passed_over)d passed over, %(cooldown)d in cooldown"
+                   % stats)
+        stats = self.reader.speech.queue.stats()
+        print ("  speech        : %d spoken, dropped %s" % (stats['spoken'],
+                                                           stats['dropped']))
+        stats = self.reader.speech.stats()
+        if stats['gaps']:
+            print ("  gaps          : mean %.1f ms, max %.1f ms, %d renders "
+                   "cancelled" % (stats['gap_mean'] * 1e3,
+                                  stats['gap_max'] * 1e3,
+                                  stats['cancelled_renders']))
+        if self.reader.analytics is not None:
+            snapshot = self.reader.analytics.snapshot(top=5, now=self.clock)
+            for line in format_snapshot(snapshot):
+                print ("  " + line)
+
+
+def main(argv=None):
+    parser = build_parser()
+    parser.description = "Replay recorded Twitch chat through the reader."
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--log', help="raw IRC log, one line each")
+    source.add_argument('--archive', help="ChatArchive directory")
+    pace = parser.add_mutually_exclusive_group()
+    pace.add_argument('--speed', type=float, default=1.,
+                      help="replay N times faster than recorded")
+    pace.add_argument('--max', action='store_true',
+                      help="replay as fast as possible")
+    parser.add_argument('--limit', type=int, help="replay at most this many lines")
+    parser.add_argument('--tts-rate', type=float, default=15.,
+                        help="characters per second of the stand-in voice, "
+                             "0 to speak instantly")
+    parser.add_argument('--tts-render-ms', type=float, default=0.,
+                        help="milliseconds the stand-in voice takes to render")
+    parser.set_defaults(backend='null', cache_dir='none')
+    args = parser.parse_args(argv)
+    if args.channel:
+        args.channel = [c.lower().lstrip('#') for c in args.channel]
+
+    reader = build_reader(args, ReplayStream())
+    if isinstance(reader.speech.backend, NullBackend):
+        reader.speech.backend.chars_per_second = args.tts_rate
+        reader.speech.backend.render_seconds = args.tts_render_ms / 1e3
+    if args.log:
+        lines = log_source(args.log)
+    else:
+        lines = archive_source(args.archive, channels=args.channel)
+    replay = ChatReplay(reader, None if args.max else args.speed)
+    try:
+        replay.run(lines, args.limit)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.speech.stop()
+        if reader.archive is not None:
+            reader.archive.close()
+    replay.report()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Recognizes copypasta and emote floods, so they are read only once.
+
+The SpeechQueue only collapses a line that is still waiting to be
+spoken; once it was read, the next copy of a copypasta is read again.
+DuplicateDetector remembers the lines of the last window seconds in
+fixed memory and reports a line as a duplicate when it, or a line nearly
+like it, was seen max_repeats times in that window:
+
+    normalize    the TextNormalizer of the speech ('noooo' -> 'noo',
+                 'LUL LUL LUL' -> 'LUL', 'gg' -> 'good game'), then
+                 lower case without punctuation
+    MinHash      one permutation MinHash of the words and word pairs:
+                 their hashes are spread over bands x rows bins and the
+                 smallest of each bin kept; lines sharing most words and
+                 word pairs get equal bands
+    keys         one per band without an empty bin, plus the whole
+                 normalized text
+    counting     the keys are counted in a counting Bloom filter; a ring
+    Bloom filter buffer of the keys of the window removes them again when
+                 they age out or the ring is full
+
+Checking a line costs the same however many lines the window holds.
+The keys of a text are memoized, so repeated texts skip the MinHash.
+"""
+import array
+import collections
+import re
+import time
+
+from TextNormalizer import TextNormalizer
+
+_NOT_WORD = re.compile(r"[^\w\s']+")
+
+
+class DuplicateDetector(object):
+    """
+    Sliding window near-duplicate detector, see the module docstring.
+    :param window: seconds a line is remembered
+    :param max_repeats: how often the same (or a nearly the same) line is
+        let through per window; 1 reads a copypasta once
+    :param capacity: most lines remembered at once; older ones are
+        forgotten early when chat is faster than capacity per window
+    :param bands: MinHash bands; more bands catch less similar lines
+    :param rows: values per band; more rows need more similar lines. The
+        default 3 bands of 3 rows catch lines sharing about 70% of their
+        words and word pairs most of the time
+    :param counters: size of the counting Bloom filter, by default about
+        twenty per key of capacity lines, which keeps false hits rare
+    :param probes: counters per key
+    :param memo_size: signatures kept for repeated texts
+    :param normalizer: TextNormalizer to share with the SpeechWorker, so
+        a line is cleaned up once; by default one of its own
+    """
+
+    def __init__(self, window=30., max_repeats=1, capacity=4096, bands=3,
+                 rows=3, counters=None, probes=4, memo_size=4096,
+                 normalizer=None):
+        self.window = window
+        self.max_repeats = max_repeats
+        self.capacity = capacity
+        self.bands = bands
+        self.rows = rows
+        self.probes = probes
+        if counters is None:
+            counters = 20 * capacity * (bands + 1)
+        self.counts = array.array('H', bytes(2 * counters))
+        self.normalizer = normalizer if normalizer is not None \
+            else TextNormalizer()
+        self.ring = collections.deque()
+        self.memo = collections.OrderedDict()
+        self.memo_size = memo_size
+        self.checked = 0
+        self.duplicates = 0
+        self.evicted = 0
+
+    def _signature(self, normalized):
+        """
+        MinHash of the words and word pairs, one pass over them.
+        :return: list of the smallest hash of each bin, None when empty
+        """
+        words = normalized.split()
+        bins = self.bands * self.rows
+        signature = [None] * bins
+        for shingle in set(words).union(zip(words, words[1:])):
+            value = hash(shingle)
+            index = value % bins
+            smallest = signature[index]
+            if smallest is None or value < smallest:
+                signature[index] = value
+        return signature
+
+    def _positions(self, key):
+        """Counters of a key, by double hashing."""
+        h = hash(key)
+        step = (h >> 32) | 1
+        size = len(self.counts)
+        return tuple((h + i * step) % size for i in range(self.probes))
+
+    def _keys(self, text):
+        """
+        Counter positions of every key of a text, memoized.
+        :return: (tuple of the positions of each key, all positions)
+        """
+        memo = self.memo
+        keys = memo.get(text)
+        if keys is not None:
+            memo.move_to_end(text)
+            return keys
+        normalized = ' '.join(
+            _NOT_WORD.sub(' ', self.normalizer(text).lower()).split())
+        positions = [self._positions(normalized)]
+        if ' ' in normalized:
+            # a single word only has its exact key
+            signature = self._signature(normalized)
+            rows = self.rows
+            for band in range(self.bands):
+                values = tuple(signature[band * rows:(band + 1) * rows])
+                # empty bins would make short lines look alike
+                if None not in values:
+                    positions.append(self._positions((band,) + values))
+        keys = memo[text] = (tuple(positions),
+                                   sum(positions, ()))
+        if len(memo) > self.memo_size:
+            memo.popitem(last=False)
+        return keys
+
+    def _expire(self, now):
+        ring = self.ring
+        counts = self.counts
+        limit = now - self.window
+        while ring and (ring[0][0] <= limit or len(ring) >= self.capacity):
+            if ring[0][0] > limit:
+                self.evicted += 1
+            for position in ring.popleft()[1]:
+                count = counts[position]
+                # a saturated counter stays saturated
+                if count and count < 0xFFFF:
+                    counts[position] = count - 1
+
+    def seen(self, text, now=None):
+        """
+        Remember a line.
+        :param now: time.monotonic(), passed in by replays and tests
+        :return: how many times it, or a line like it, was seen within
+            the window before (an estimate that may be too high, never
+            too low)
+        """
+        if now is None:
+            now = time.monotonic()
+        self._expire(now)
+        keys, positions = self._keys(text)
+        counts = self.counts
+        repeats = 0
+        for key in keys:
+            count = min(map(counts.__getitem__, key))
+            if count > repeats:
+                repeats = count
+        for position in positions:
+            if counts[position] < 0xFFFF:
+                counts[position] += 1
+        self.ring.append((now, positions))
+        return repeats
+
+    def check(self, text, now=None):
+        """
+        Remember a line and tell whether it should be skipped.
+        :return: True when it was seen max_repeats times already
+        """
+        self.checked += 1
+        if self.seen(text, now) >= self.max_repeats:
+            self.duplicates += 1
+            return True
+        return False
+
+    def clear(self):
+        """Forget every line."""
+        self.ring.clear()
+        self.counts = array.array('H', bytes(2 * len(self.counts)))
+
+    def stats(self):
+        """:return: dict with the hit rate and the window fill"""
+        return {
+            'checked': self.checked,
+            'duplicates': self.duplicates,
+            'hit_rate': self.duplicates / float(self.checked)
+            if self.checked else 0.,
+            'window_lines': len(self.ring),
+            'evicted': self.evicted,
+            'memo_entries': len(self.memo),
+        }
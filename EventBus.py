@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Message passing between the Tk mainloop and the thread reading the chat.
+
+Tk widgets may only be touched from the mainloop, and the reading thread
+should not look at them at all. So the two only talk through an
+EventBus:
+
+    GUI -> reader   commands (START, STOP, VOLUME, SETTINGS, ...) in a
+                    deque; a byte on a socket pair wakes the reader out
+                    of its select() right away
+    reader -> GUI   statuses (READING, AUTO_MESSAGE, ERROR, CALL) in a
+                    queue the mainloop drains with after()
+
+Settings reach the reader as ReaderSettings snapshots, sent only when
+the user changes something, instead of being read from the widgets on
+every loop. Other threads (the keyboard hook) send commands the same
+way, and post CALL statuses to have the mainloop run something for them.
+"""
+import collections
+import queue
+import select
+import socket
+import threading
+import time
+
+from ChatReader import ChatReader
+
+# commands, GUI -> reader
+START = 'start'
+STOP = 'stop'
+VOLUME = 'volume'
+SETTINGS = 'settings'
+CHANNEL = 'channel'
+QUIT = 'quit'
+
+# statuses, reader -> GUI
+READING = 'reading'
+AUTO_MESSAGE = 'auto_message'
+ERROR = 'error'
+CALL = 'call'
+
+ReaderSettings = collections.namedtuple(
+    'ReaderSettings',
+    'chat_filter auto_message auto_interval auto_enabled duplicates')
+ReaderSettings.__doc__ = """
+Settings of the reading thread, as of one change in the GUI.
+:param chat_filter: the ChatFilter to apply
+:param duplicates: the DuplicateDetector skipping repeated lines, None
+    to read them all
+:param auto_message: text sent to the channel every auto_interval
+    seconds while reading, when auto_enabled
+"""
+
+
+class EventBus(object):
+    """
+    Commands to one consumer thread and statuses back. Every method may
+    be called from any thread.
+    """
+
+    def __init__(self):
+        self._commands = collections.deque()
+        self._statuses = queue.Queue()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+
+    def fileno(self):
+        """Readable when commands are waiting, for select()."""
+        return self._wake_r.fileno()
+
+    def send(self, command, value=None):
+        """Queue a command and wake the consumer."""
+        self._commands.append((command, value))
+        try:
+            self._wake_w.send(b'x')
+        except (IOError, OSError):
+            # the buffer is full of wake-ups already, or the bus is closed
+            pass
+
+    def commands(self):
+        """:return: list of the (command, value) pairs sent since last time"""
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (IOError, OSError):
+            pass
+        commands = []
+        while self._commands:
+            commands.append(self._commands.popleft())
+        return commands
+
+    def post(self, status, value=None):
+        """Queue a status for the mainloop."""
+        self._statuses.put((status, value))
+
+    def statuses(self):
+        """:return: list of the (status, value) pairs posted, never blocks"""
+        statuses = []
+        while True:
+            try:
+                statuses.append(self._statuses.get_nowait())
+            except queue.Empty:
+                return statuses
+
+    def close(self):
+        self._wake_r.close()
+        self._wake_w.close()
+
+
+class ReaderThread(object):
+    """
+    Owns every read of a TwitchChatStream. Until a channel is given and
+    START received it only keeps the connection alive (PONGs, join
+    answers); then it reads the chat aloud through a ChatReader.
+    :param stream: a connected TwitchChatStream
+    :param speech: the SpeechWorker to speak with
+    :param bus: the EventBus to take commands from and post statuses to
+    :param settings: the first ReaderSettings
+    :param volume: speech volume from 0 to 100
+    :param reader_options: further keyword arguments of the ChatReader
+    """
+
+    def __init__(self, stream, speech, bus, settings, volume=50,
+                 **reader_options):
+        self.stream = stream
+        self.speech = speech
+        self.bus = bus
+        self.settings = settings
+        self.volume = volume
+        self.reader_options = reader_options
+        self.reader = None
+        self.reading = False
+        self.last_auto_message = time.time()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _apply(self, command, value):
+        if command == SETTINGS:
+            self.settings = value
+            if self.reader is not None:
+                self.reader.chat_filter = value.chat_filter
+                self.reader.duplicates = value.duplicates
+        elif command == VOLUME:
+            self.volume = value
+            if self.reader is not None:
+                self.reader.volume = value
+        elif command == CHANNEL:
+            self.stream.current_channel = value
+            self.reader = ChatReader(self.stream, self.speech,
+                                     self.settings.chat_filter,
+                                     channels=[value], volume=self.volume,
+                                     duplicates=self.settings.duplicates,
+                                     **self.reader_options)
+        elif command == START:
+            if self.reader is None:
+                self.bus.post(ERROR, "Join a channel first")
+            elif not self.reading:
+                self.reading = True
+                self.bus.post(READING, True)
+        elif command == STOP:
+            self.speech.clear()
+            if self.reading:
+                self.reading = False
+                self.bus.post(READING, False)
+
+    def _auto_message(self):
+        """Send the auto message when it is due; :return: seconds until next"""
+        settings = self.settings
+        if not (self.reading and settings.auto_enabled):
+            return None
+        left = self.last_auto_message + settings.auto_interval - time.time()
+        if left > 0:
+            return left
+        self.stream.send_chat_message(self.stream.current_channel,
+                                      settings.auto_message)
+        self.last_auto_message = time.time()
+        self.bus.post(AUTO_MESSAGE, settings.auto_message)
+        return settings.auto_interval
+
+    def _run(self):
+        stream = self.stream
+        bus = self.bus
+        while True:
+            for command, value in bus.commands():
+                if command == QUIT:
+                    return
+                try:
+                    self._apply(command, value)
+                except Exception as e:
+                    bus.post(ERROR, "%s failed: %s" % (command, e))
+            timeout = 1.
+            try:
+                due = self._auto_message()
+            except Exception as e:
+                bus.post(ERROR, "Auto message failed: %s" % e)
+                due = None
+            if due is not None:
+                timeout = min(timeout, due)
+            try:
+                select.select([stream.s, bus], [], [], timeout)
+            except (OSError, TypeError, ValueError):
+                # not connected yet, or the socket was replaced by a
+                # reconnect: still wait for commands
+                select.select([bus], [], [], timeout)
+            if self.reading:
+                self.reader.receive()
+            else:
+                # keep answering PINGs and reading the join answers; the
+                # analytics count the chat even while it is not read
+                analytics = self.reader_options.get('analytics')
+                for message in stream.twitch_receive_messages():
+                    if analytics is not None:
+                        analytics.observe(message)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Tracks which channels a connection has joined.
+
+JOINs are not answered right away: they wait in the JOIN lane of the
+OutboundScheduler for the join limit, and Twitch confirms a join by
+echoing the JOIN back (followed by the 353/366 names list) or refuses it
+with a NOTICE or a numeric error. JoinManager keeps a ChannelJoin per
+channel and moves it through
+
+    pending -> sent -> joined
+                    -> failed     (NOTICE or numeric error)
+                    -> timed_out  (no answer within timeout seconds)
+
+so many JOINs can be queued at once and their outcome read later,
+instead of sleeping after every JOIN.
+"""
+import threading
+import time
+
+PENDING = 'pending'
+SENT = 'sent'
+JOINED = 'joined'
+FAILED = 'failed'
+TIMED_OUT = 'timed_out'
+PARTED = 'parted'
+
+# states that will not change without a new JOIN
+SETTLED = (JOINED, FAILED, TIMED_OUT, PARTED)
+
+
+def channel_name(channel):
+    """
+    The name Twitch uses for a channel: lowercase, without '#'. Twitch
+    answers a JOIN #Chan for chan.
+    """
+    return channel.lstrip('#').lower()
+
+# msg-id values of the NOTICEs refusing a JOIN
+JOIN_FAILURES = frozenset([
+    'msg_banned', 'msg_channel_blocked', 'msg_channel_suspended',
+    'msg_requires_verified_phone_number', 'msg_verified_email', 'tos_ban',
+])
+
+# numeric replies refusing a JOIN: no such channel, too many channels,
+# channel full, invite only, banned, bad key
+JOIN_ERRORS = frozenset(['403', '405', '471', '473', '474', '475'])
+
+
+class ChannelJoin(object):
+    """
+    Join state of one channel.
+    :param channel: channel name, without '#'
+    """
+    __slots__ = ('channel', 'state', 'reason', 'requested', 'sent',
+                 'confirmed')
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.state = PENDING
+        self.reason = None
+        self.requested = time.monotonic()
+        self.sent = None
+        self.confirmed = None
+
+    def __repr__(self):
+        return "ChannelJoin(%r, %r)" % (self.channel, self.state)
+
+    @property
+    def latency(self):
+        """Seconds from the request to the confirmation, or None."""
+        if self.confirmed is None:
+            return None
+        return self.confirmed - self.requested
+
+
+class JoinManager(object):
+    """
+    Per-channel join states of one connection. Safe to use from the
+    receive thread, the sender thread and the caller at the same time.
+    :param timeout: seconds after sending a JOIN before it counts as
+        timed out
+    """
+
+    def __init__(self, timeout=10.):
+        self.timeout = timeout
+        self.joins = {}
+        self._changed = threading.Condition()
+
+    def request(self, channel):
+        """
+        Record that channel should be joined.
+        :param channel: channel name, in any case, with or without '#'
+        :return: (ChannelJoin, True when a JOIN needs to be sent)
+        """
+        channel = channel_name(channel)
+        with self._changed:
+            join = self.joins.get(channel)
+            if join is not None and join.state in (PENDING, SENT, JOINED):
+                # already joined or on its way
+                return join, False
+            join = self.joins[channel] = ChannelJoin(channel)
+            return join, True
+
+    def sent(self, channel):
+        """The JOIN for channel left the outbound queue."""
+        with self._changed:
+            join = self.joins.get(channel)
+            if join is not None and join.state == PENDING:
+                join.state = SENT
+                join.sent = time.monotonic()
+
+    def confirmed(self, channel):
+        """Twitch echoed our JOIN, or sent the names list of channel."""
+        with self._changed:
+            join = self.joins.get(channel)
+            if join is None:
+                join = self.joins[channel] = ChannelJoin(channel)
+            if join.state != JOINED:
+                join.state = JOINED
+                join.reason = None
+                join.confirmed = time.monotonic()
+                self._changed.notify_all()
+
+    def failed(self, channel, reason):
+        """Twitch refused to join channel."""
+        with self._changed:
+            join = self.joins.get(channel)
+            if join is not None and join.state in (PENDING, SENT):
+                join.state = FAILED
+                join.reason = reason
+                self._changed.notify_all()
+
+    def parted(self, channel):
+        """We left channel."""
+        with self._changed:
+            join = self.joins.get(channel)
+            if join is not None:
+                join.state = PARTED
+                self._changed.notify_all()
+
+    def forget(self, channel):
+        """Stop tracking channel, e.g. after sending a PART."""
+        with self._changed:
+            self.joins.pop(channel, None)
+
+    def expire(self):
+        """Mark JOINs without an answer for timeout seconds as timed out."""
+        now = time.monotonic()
+        with self._changed:
+            for join in self.joins.values():
+                if join.state == SENT and now - join.sent > self.timeout:
+                    join.state = TIMED_OUT
+                    join.reason = 'timeout'
+                    self._changed.notify_all()
+
+    def reset(self):
+        """
+        After a reconnect nothing is joined any more.
+        :return: the channels that have to be joined again
+        """
+        with self._changed:
+            channels = sorted(channel for channel, join in self.joins.items()
+                              if join.state in (PENDING, SENT, JOINED,
+                                                TIMED_OUT))
+            for channel in channels:
+                self.joins[channel] = ChannelJoin(channel)
+            return channels
+
+    def state(self, channel):
+        """:return: the state of channel, None when it was never joined"""
+        channel = channel_name(channel)
+        self.expire()
+        with self._changed:
+            join = self.joins.get(channel)
+            return None if join is None else join.state
+
+    def joined(self):
+        """:return: set of the channels currently joined"""
+        with self._changed:
+            return set(channel for channel, join in self.joins.items()
+                       if join.state == JOINED)
+
+    def wait(self, channels=None, timeout=None):
+        """
+        Wait until the given channels (all by default) are settled:
+        joined, failed or timed out. Something else must keep reading
+        the connection meanwhile.
+        :param channels: channel names, in any case, with or without '#'
+        :return: dict of channel name (as channel_name() gives it) to state
+        """
+        if channels is not None:
+            channels = [channel_name(channel) for channel in channels]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self.expire()
+            with self._changed:
+                names = list(self.joins) if channels is None else channels
+                states = dict((channel, self.joins[channel].state
+                               if channel in self.joins else None)
+                              for channel in names)
+                if all(state is None or state in SETTLED
+                       for state in states.values()):
+                    return states
+                remaining = None if deadline is None else \
+                    deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return states
+                # wake up at least every second to expire timeouts
+                self._changed.wait(1. if remaining is None
+                                   else min(1., remaining))
+
+    def summary(self):
+        """:return: dict of state to number of channels"""
+        with self._changed:
+            counts = {}
+            for join in self.joins.values():
+                counts[join.state] = counts.get(join.state, 0) + 1
+            return counts
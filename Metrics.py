@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and latency histograms of the chat reader.
+
+The stream, the ChatReader and the SpeechWorker each take an optional
+Metrics object. Without one they skip the instrumentation entirely, so
+it costs nothing when disabled. With one, every chat line is stamped
+with time.monotonic() when its bytes are read from the socket and the
+delay from there is recorded at each stage:
+
+    irc_parse_seconds            socket read -> line parsed
+    chat_filter_seconds          time spent in the ChatFilter
+    chat_queue_seconds           socket read -> put on the speech queue
+    speech_wait_seconds          socket read -> synthesis started
+    speech_synthesis_seconds     rendering (or speaking) one utterance
+    speech_gap_seconds           silence between two utterances
+    speech_end_to_end_seconds    socket read -> playback finished
+
+Values sampled only when they are exported (queue depths, drops by
+reason) are registered as callbacks. Metrics.render() returns everything
+in the Prometheus text format; MetricsServer serves it over HTTP on
+/metrics, MetricsDump writes it to a file every few seconds.
+MetricsServer also serves ChatAnalytics snapshots as JSON on /analytics.
+"""
+import bisect
+import collections
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+
+# seconds, from well below a parse up to the slowest speech
+LATENCY_BUCKETS = (.00001, .00005, .0001, .0005, .001, .005, .01, .05, .1,
+                   .5, 1., 2.5, 5., 10., 30., 60.)
+
+
+def _labels(name, value):
+    if value is None:
+        return ''
+    return '{%s="%s"}' % (name, str(value).replace('\\', '\\\\')
+                          .replace('"', '\\"'))
+
+
+class Counter(object):
+    """
+    Monotonic count, optionally split by one label.
+    :param name: metric name
+    :param help: one line description
+    :param label: name of the label, e.g. 'reason'
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, value=None, amount=1):
+        """
+        Count one event.
+        :param value: the label value, when the counter has a label
+        """
+        # unlocked: a lost increment under contention is acceptable here
+        self.values[value] = self.values.get(value, 0) + amount
+
+    def samples(self):
+        if not self.values:
+            return [(self.name, 0)] if self.label is None else []
+        return [(self.name + _labels(self.label, value), count)
+                for value, count in sorted(self.values.items(),
+                                           key=lambda item: str(item[0]))]
+
+
+class Histogram(object):
+    """
+    Distribution of durations in fixed buckets.
+    :param name: metric name
+    :param help: one line description
+    :param buckets: upper bounds of the buckets, ascending
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, fraction):
+        """Estimate of a quantile: the upper bound of its bucket."""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        samples = []
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            samples.append(('%s_bucket{le="%g"}' % (self.name, bound), seen))
+        samples.append(('%s_bucket{le="+Inf"}' % self.name, self.count))
+        samples.append((self.name + '_sum', self.sum))
+        samples.append((self.name + '_count', self.count))
+        return samples
+
+
+class Callback(object):
+    """
+    A value read from elsewhere when it is exported.
+    :param func: returns a number, or a dict of label value to number
+    :param kind: 'gauge', or 'counter' for values that only grow
+    :param label: name of the label, when func returns a dict
+    """
+
+    def __init__(self, name, help, func, kind='gauge', label=None):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.kind = kind
+        self.label = label
+
+    def samples(self):
+        value = self.func()
+        if isinstance(value, dict):
+            return [(self.name + _labels(self.label, key), count)
+                    for key, count in sorted(value.items())]
+        return [(self.name, value)]
+
+
+class Metrics(object):
+    """
+    Registry of every metric of one reader. The instruments the reader
+    uses are created up front, so the hot paths only touch attributes.
+    """
+
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+        self.lines = self.counter(
+            'irc_lines_received_total', "IRC lines read from the socket")
+        self.parse = self.histogram(
+            'irc_parse_seconds', "Socket read until the line was parsed")
+        self.reconnects = self.counter(
+            'irc_reconnects_total', "Reconnect attempts", 'result')
+        self.messages = self.counter(
+            'chat_messages_total', "Chat messages by what became of them",
+            'outcome')
+        self.filter = self.histogram(
+            'chat_filter_seconds', "Time spent in the chat filter")
+        self.queue = self.histogram(
+            'chat_queue_seconds', "Socket read until queued for speech")
+        self.speech_wait = self.histogram(
+            'speech_wait_seconds', "Socket read until synthesis started")
+        self.synthesis = self.histogram(
+            'speech_synthesis_seconds', "Rendering or speaking one utterance")
+        self.gap = self.histogram(
+            'speech_gap_seconds', "Silence before an utterance while "
+            "speech was waiting")
+        self.end_to_end = self.histogram(
+            'speech_end_to_end_seconds', "Socket read until playback finished")
+
+    def _add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("Metric %s is already registered" % metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, label=None):
+        return self._add(Counter(name, help, label))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def callback(self, name, help, func, kind='gauge', label=None):
+        return self._add(Callback(name, help, func, kind, label))
+
+    def watch_stream(self, stream):
+        """Export the outbound queue depth of a TwitchChatStream."""
+        self.callback('irc_outbound_pending', "Lines waiting to be sent",
+                      stream.outbound.pending)
+
+    def watch_speech(self, speech):
+        """Export the speech queue depth and its drops by reason."""
+        queue = speech.queue
+        self.callback('speech_queue_depth', "Utterances waiting to be spoken",
+                      queue.__len__)
+        self.callback('speech_dropped_total', "Utterances dropped by reason",
+                      lambda: dict(queue.dropped), 'counter', 'reason')
+        self.callback('speech_renders_cancelled_total',
+                      "Renders thrown away because the utterance was dropped",
+                      lambda: speech.cancelled, 'counter')
+
+    def watch_duplicates(self, duplicates):
+        """Export the hit rate and the fill of a DuplicateDetector."""
+        self.callback('chat_duplicate_hit_ratio',
+                      "Share of checked lines found to be duplicates",
+                      lambda: duplicates.stats()['hit_rate'])
+        self.callback('chat_duplicate_window_lines',
+                      "Lines remembered by the duplicate detector",
+                      duplicates.ring.__len__)
+
+    def watch_analytics(self, analytics):
+        """Export the chat rate per channel of a ChatAnalytics."""
+        self.callback('chat_messages_per_second',
+                      "Chat messages per second over the last 10 seconds",
+                      analytics.rates, label='channel')
+
+    def render(self):
+        """:return: every metric in the Prometheus text format"""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, value in metric.samples():
+                lines.append('%s %r' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """
+    Serves Metrics.render() on http://host:port/metrics from a
+    background thread, and ChatAnalytics.snapshot() as JSON on
+    /analytics?channel=name&top=10 (both parameters optional).
+    :param metrics: the Metrics to serve, None for analytics only
+    :param port: TCP port, 0 for any free port (see .port)
+    :param host: address to listen on; only the local machine by default
+    :param analytics: optional ChatAnalytics to serve
+    """
+
+    def __init__(self, metrics, port=9108, host='127.0.0.1', analytics=None):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                if path in ('/', '/metrics') and metrics is not None:
+                    self._send(metrics.render(),
+                               'text/plain; version=0.0.4; charset=utf-8')
+                elif path == '/analytics' and analytics is not None:
+                    params = parse_qs(query)
+                    try:
+                        top = int(params.get('top', ['10'])[0])
+                    except ValueError:
+                        self.send_error(400, "top must be a number")
+                        return
+                    snapshot = analytics.snapshot(
+                        params.get('channel', [None])[0], top)
+                    self._send(json.dumps(snapshot, indent=1),
+                               'application/json; charset=utf-8')
+                else:
+                    self.send_error(404)
+
+            def _send(self, text, content_type):
+                body = text.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = _ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class MetricsDump(object):
+    """
+    Writes Metrics.render() to a file every interval seconds, replacing
+    the previous dump, or prints it when path is '-'.
+    """
+
+    def __init__(self, metrics, path, interval=10.):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop, after one last dump."""
+        self._stopped.set()
+        self._thread.join()
+
+    def dump(self):
+        text = self.metrics.render()
+        if self.path == '-':
+            print (text)
+            return
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                f.write(text)
+            os.replace(self.path + '.tmp', self.path)
+        except (IOError, OSError) as e:
+            print ("Could not write metrics: ", e)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.dump()
+        self.dump()
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for irc.twitch.tv, for testing and benchmarking the
+chat reader offline.
+
+It speaks the part of the protocol the client uses: PASS/NICK login
+replies, JOIN echoes, PING/PONG in both directions, and it floods every
+joined channel with PRIVMSGs at a configurable rate and line size.
+Every flooded message starts with its sequence number and the time.time()
+it was sent at, so a client can measure latency and count lost lines:
+
+    :viewer12!viewer12@viewer12.tmi.twitch.tv PRIVMSG #chan :17 1700000000.123456 lorem ...
+
+Clients that requested the twitch.tv/tags capability get the messages
+with IRCv3 tags (badges, display-name, emotes, id, ...) like Twitch
+sends them.
+
+Run it standalone and point a client at it:
+
+    python MockTwitchServer.py --port 6667 --rate 500 --count 100000
+    python TwitchChatDaemon.py --host 127.0.0.1 --port 6667 ...
+"""
+import argparse
+import random
+import socket
+import socketserver
+import threading
+import time
+
+WORDS = ['gg', 'LUL', 'Kappa', 'PogChamp', 'what', 'a', 'play', 'is', 'this',
+         'real', 'lol', 'nice', 'one', 'streamer', 'hello', 'chat', 'wow',
+         'KEKW', 'monkaS', 'no', 'way', 'clip', 'it', 'insane']
+
+# emote ids of the WORDS that are global Twitch emotes
+EMOTE_IDS = {'Kappa': '25', 'PogChamp': '88', 'LUL': '425618'}
+
+
+def emote_tag(text):
+    """
+    The value of the emotes tag for text, e.g. '25:0-4,12-16/88:6-13'.
+    Positions count characters, both ends inclusive.
+    """
+    ranges = {}
+    position = 0
+    for word in text.split(' '):
+        emote_id = EMOTE_IDS.get(word)
+        if emote_id is not None:
+            ranges.setdefault(emote_id, []).append(
+                '%d-%d' % (position, position + len(word) - 1))
+        position += len(word) + 1
+    return '/'.join('%s:%s' % (emote_id, ','.join(spans))
+                    for emote_id, spans in sorted(ranges.items()))
+
+
+def message_tags(seq, user, text, mod=False, subscriber=False):
+    """The IRCv3 tag prefix (without '@') Twitch puts on a PRIVMSG."""
+    badges = []
+    if mod:
+        badges.append('moderator/1')
+    if subscriber:
+        badges.append('subscriber/12')
+    return ('badges=%s;color=;display-name=%s;emotes=%s;id=mock-%d;mod=%d;'
+            'subscriber=%d;tmi-sent-ts=%d;user-type=%s'
+            % (','.join(badges), user.capitalize(), emote_tag(text), seq,
+               mod, subscriber, time.time() * 1000, 'mod' if mod else ''))
+
+
+def flood_text(seq, size, rng):
+    """
+    Text of one flooded message: sequence number, send time, then words
+    up to roughly size characters.
+    """
+    text = '%d %.6f' % (seq, time.time())
+    while len(text) < size:
+        text += ' ' + rng.choice(WORDS)
+    return text
+
+
+class _ClientHandler(socketserver.StreamRequestHandler):
+    """One client connection."""
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.nick = None
+        self.oauth = None
+        self.caps = set()
+        self.alive = True
+        self.send_lock = threading.Lock()
+
+    def send(self, line):
+        with self.send_lock:
+            self.wfile.write((line + '\r\n').encode('utf-8'))
+
+    def handle(self):
+        server = self.server
+        server.client_connected(self)
+        if server.ping_interval:
+            threading.Thread(target=self._ping, daemon=True).start()
+        try:
+            for raw in self.rfile:
+                line = raw.decode('utf-8', 'replace').rstrip('\r\n')
+                server.received.append(line)
+                self._command(line)
+                if not self.alive:
+                    break
+        except (IOError, OSError):
+            pass
+        finally:
+            self.alive = False
+            server.client_disconnected(self)
+
+    def _command(self, line):
+        command, _, rest = line.partition(' ')
+        command = command.upper()
+        if command == 'PASS':
+            self.oauth = rest
+        elif command == 'NICK':
+            self.nick = rest.strip().lower()
+            self._login()
+        elif command == 'CAP':
+            parts = rest.split(' :', 1)
+            if len(parts) == 2:
+                self.caps.update(parts[1].split())
+                self.send(':tmi.twitch.tv CAP * ACK :%s' % parts[1])
+        elif command == 'JOIN':
+            for channel in rest.split(','):
+                self._join(channel.strip().lstrip('#').lower())
+        elif command == 'PART':
+            channel = rest.strip()
+            self.send(':{0}!{0}@{0}.tmi.twitch.tv PART {1}'.format(self.nick,
+                                                                   channel))
+        elif command == 'PING':
+            self.send(':tmi.twitch.tv PONG tmi.twitch.tv :%s'
+                      % rest.lstrip(':'))
+        elif command == 'PONG':
+            self.server.pongs += 1
+        elif command == 'QUIT':
+            self.alive = False
+
+    def _login(self):
+        if not self.oauth or not self.oauth.startswith('oauth:'):
+            self.send(':tmi.twitch.tv NOTICE * :Improperly formatted auth')
+            self.alive = False
+            return
+        if self.oauth in self.server.rejected_oauth:
+            self.send(':tmi.twitch.tv NOTICE * :Login authentication failed')
+            self.alive = False
+            return
+        for number, text in (('001', 'Welcome, GLHF!'),
+                             ('002', 'Your host is tmi.twitch.tv'),
+                             ('003', 'This server is rather new'),
+                             ('004', '-'),
+                             ('375', '-'),
+                             ('372', 'You are in a great big world!'),
+                             ('376', '>')):
+            self.send(':tmi.twitch.tv %s %s :%s' % (number, self.nick, text))
+
+    def _join(self, channel):
+        if channel in self.server.missing_channels:
+            self.send(':tmi.twitch.tv NOTICE #%s :msg_channel_suspended'
+                      % channel)
+            return
+        self.send(':{0}!{0}@{0}.tmi.twitch.tv JOIN #{1}'.format(self.nick,
+                                                               channel))
+        self.send(':{0}.tmi.twitch.tv 353 {0} = #{1} :{0}'.format(self.nick,
+                                                                 channel))
+        self.send(':{0}.tmi.twitch.tv 366 {0} #{1} :End of /NAMES list'
+                  .format(self.nick, channel))
+        if self.server.rate:
+            threading.Thread(target=self._flood, args=(channel,),
+                             daemon=True).start()
+
+    def _ping(self):
+        while self.alive:
+            time.sleep(self.server.ping_interval)
+            try:
+                self.send('PING :tmi.twitch.tv')
+            except (IOError, OSError):
+                return
+
+    def _flood(self, channel):
+        """Send count messages to the channel at rate messages/second."""
+        server = self.server
+        rng = random.Random(channel)
+        users = ['viewer%d' % i for i in range(server.users)]
+        tagged = 'twitch.tv/tags' in self.caps
+        start = time.time()
+        seq = 0
+        while self.alive and (server.count is None or seq < server.count):
+            # send in small batches, sleeping whenever ahead of schedule
+            ahead = start + seq / float(server.rate) - time.time()
+            if ahead > 0:
+                time.sleep(ahead)
+            batch = []
+            for _ in range(max(1, int(server.rate / 1000.))):
+                if server.count is not None and seq >= server.count:
+                    break
+                user = rng.choice(users)
+                text = flood_text(seq, server.line_size, rng)
+                line = (':{0}!{0}@{0}.tmi.twitch.tv PRIVMSG #{1} :{2}'
+                        .format(user, channel, text))
+                if tagged:
+                    roll = rng.random()
+                    line = '@%s %s' % (message_tags(seq, user, text,
+                                                    roll < .02, roll < .3),
+                                       line)
+                batch.append(line)
+                seq += 1
+            try:
+                with self.send_lock:
+                    self.wfile.write(('\r\n'.join(batch) + '\r\n')
+                                     .encode('utf-8'))
+            except (IOError, OSError):
+                return
+            server.sent += len(batch)
+
+
+class MockTwitchServer(socketserver.ThreadingTCPServer):
+    """
+    Threaded fake Twitch IRC server.
+    :param host: address to listen on
+    :param port: port to listen on, 0 for any free port (see .port)
+    :param rate: PRIVMSGs per second flooded to every joined channel,
+        0 to send no chat at all
+    :param count: number of PRIVMSGs per channel, None for no end
+    :param line_size: approximate length of the message text
+    :param users: number of distinct chatters
+    :param ping_interval: seconds between server PINGs, None for none
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, rate=100, count=None,
+                 line_size=60, users=500, ping_interval=None):
+        socketserver.ThreadingTCPServer.__init__(self, (host, port),
+                                                 _ClientHandler)
+        self.rate = rate
+        self.count = count
+        self.line_size = line_size
+        self.users = users
+        self.ping_interval = ping_interval
+        self.rejected_oauth = set()
+        self.missing_channels = set()
+        self.received = []
+        self.clients = []
+        self.sent = 0
+        self.pongs = 0
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def client_connected(self, handler):
+        self.clients.append(handler)
+
+    def client_disconnected(self, handler):
+        if handler in self.clients:
+            self.clients.remove(handler)
+
+    def start(self):
+        """Serve from a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and drop every client."""
+        self.shutdown()
+        for client in list(self.clients):
+            client.alive = False
+            try:
+                client.request.shutdown(socket.SHUT_RDWR)
+            except (IOError, OSError):
+                pass
+        self.server_close()
+
+    def drop_clients(self):
+        """Cut every connection, to test reconnecting."""
+        for client in list(self.clients):
+            client.alive = False
+            try:
+                client.request.shutdown(socket.SHUT_RDWR)
+            except (IOError, OSError):
+                pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local fake Twitch IRC server.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6667)
+    parser.add_argument('--rate', type=float, default=100,
+                        help="PRIVMSGs per second per joined channel")
+    parser.add_argument('--count', type=int, default=None,
+                        help="PRIVMSGs per channel, default: no end")
+    parser.add_argument('--line-size', type=int, default=60)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--ping-interval', type=float, default=None)
+    args = parser.parse_args(argv)
+    server = MockTwitchServer(args.host, args.port, args.rate, args.count,
+                              args.line_size, args.users, args.ping_interval)
+    print ("Mock Twitch IRC server on %s:%d" % (args.host, server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Parsing and filtering in worker processes, for the busiest channels.
+
+In the normal mode a single thread decodes, parses and filters every
+line, and in a channel with thousands of lines a second that thread
+runs into the GIL. ParallelReceiver moves that work to other processes:
+
+    reader thread       socket -> batches of whole lines (raw bytes)
+    ParseWorkerPool     N processes: decode, parse, run the ChatFilter
+    collector thread    results -> put back in the order they were read
+
+The consumer (ChatReader) then only sees the chat messages that passed
+the filter, in the original order, and does not run that filter again.
+They come back as the fields of the parsed IRCMessage, so the consumer
+does not parse them again either. Lines that are not chat (PING, JOIN
+echoes, NOTICEs) are handed back to TwitchChatStream._parse_message, so
+PONGs and join tracking work as usual.
+
+ParallelReceiver stands in for the stream: it has twitch_receive_messages()
+and a selectable .s, and passes everything else on to the stream.
+
+A worker process that dies takes its batches with it: the pool skips
+them, so the batches after them are still delivered, and hands new
+batches to the other workers only.
+"""
+import collections
+import errno
+import multiprocessing
+import os
+import queue
+import select
+import socket
+import threading
+import time
+from sys import intern
+
+from TwitchIRC import IRCMessage, LineFramer, parse_line
+
+
+def process_batch(data, check):
+    """
+    Decode, parse and filter a batch of whole lines.
+    :param data: raw bytes, ending with a line terminator
+    :param check: ChatFilter.check, or None to keep every chat message
+    :return: (IRCMessage.fields() of the chat messages that passed,
+        other lines, dict of skip reason to count)
+    """
+    framer = LineFramer()
+    framer.feed(data)
+    passed = []
+    control = []
+    skipped = {}
+    for line in framer.lines():
+        message = parse_line(line)
+        if message is None:
+            continue
+        if message.command != 'PRIVMSG':
+            control.append(line)
+        elif message.channel and message.trailing:
+            if check is not None:
+                reason = check(message.username.lower(), message.trailing,
+                               message)
+                if reason is not None:
+                    skipped[reason] = skipped.get(reason, 0) + 1
+                    continue
+            prefix, command, params, trailing, tagged, tags_end = \
+                message.fields()
+            # the command and channel repeat on every line; interned, the
+            # pickle sends each only once per batch
+            passed.append((prefix, intern(command), list(map(intern, params)),
+                           trailing, tagged, tags_end))
+    return passed, control, skipped
+
+
+def _work(tasks, results, chat_filter):
+    """Main function of a worker process."""
+    check = None if chat_filter is None else chat_filter.check
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        if task[0] == 'filter':
+            check = None if task[1] is None else task[1].check
+            continue
+        _, seq, read_at, data = task
+        results.put((seq, read_at) + process_batch(data, check))
+
+
+class ParseWorkerPool(object):
+    """
+    Worker processes running process_batch(). Batches are handed out
+    round robin and their results come back in submission order.
+    :param chat_filter: ChatFilter applied in the workers, None for none
+    :param workers: number of processes, by default one per core but one
+    """
+
+    def __init__(self, chat_filter=None, workers=None):
+        if not workers:
+            workers = max(1, (os.cpu_count() or 2) - 1)
+        self.results = multiprocessing.Queue()
+        self.tasks = []
+        self.processes = []
+        for _ in range(workers):
+            tasks = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=_work, args=(tasks, self.results, chat_filter))
+            process.daemon = True
+            process.start()
+            self.tasks.append(tasks)
+            self.processes.append(process)
+        self.submitted = 0
+        self.delivered = 0
+        self.lost = 0
+        self._done = {}
+        # worker of every batch not delivered yet
+        self._assigned = {}
+        self._lock = threading.Lock()
+
+    def set_filter(self, chat_filter):
+        """Use another ChatFilter for every batch submitted from now on."""
+        for tasks in self.tasks:
+            tasks.put(('filter', chat_filter))
+
+    def submit(self, data, read_at=None):
+        """
+        Queue a batch of whole lines.
+        :param data: raw bytes, ending with a line terminator
+        :param read_at: time.monotonic() when it was read
+        """
+        alive = [worker for worker, process in enumerate(self.processes)
+                 if process.is_alive()]
+        if not alive:
+            raise RuntimeError("Every parse worker has died")
+        with self._lock:
+            seq = self.submitted
+            self.submitted += 1
+            worker = alive[seq % len(alive)]
+            self._assigned[seq] = worker
+        self.tasks[worker].put(('lines', seq, read_at, data))
+
+    def collect(self, timeout=None):
+        """
+        Wait for a result, then return every batch that is now complete
+        in order. The batches of a worker that died are skipped.
+        :return: list of (read_at, passed, control, skipped)
+        """
+        try:
+            result = self.results.get(timeout=timeout)
+        except queue.Empty:
+            result = None
+        if result is not None:
+            self._store(result)
+        if self.delivered not in self._done:
+            self._skip_lost()
+        ready = []
+        with self._lock:
+            while self.delivered in self._done:
+                ready.append(self._done.pop(self.delivered))
+                del self._assigned[self.delivered]
+                self.delivered += 1
+        return ready
+
+    def _store(self, result):
+        # a batch given up on already is not delivered late
+        if result[0] >= self.delivered:
+            self._done[result[0]] = result[1:]
+
+    def _skip_lost(self):
+        """Give up on the batches of the worker of the next batch, if dead."""
+        with self._lock:
+            worker = self._assigned.get(self.delivered)
+        if worker is None or self.processes[worker].is_alive():
+            return
+        # what it sent before it died may still be in the queue
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self._store(result)
+        with self._lock:
+            for seq, owner in list(self._assigned.items()):
+                if owner == worker and seq not in self._done:
+                    self._done[seq] = (None, [], [], {})
+                    self.lost += 1
+
+    def close(self):
+        for tasks, process in zip(self.tasks, self.processes):
+            if process.is_alive():
+                tasks.put(None)
+            else:
+                # nobody reads these tasks any more: do not wait at exit
+                # until they are written to the pipe
+                tasks.cancel_join_thread()
+        for process in self.processes:
+            process.join(2.)
+            if process.is_alive():
+                process.terminate()
+
+
+class ParallelReceiver(object):
+    """
+    Reads a TwitchChatStream with a ParseWorkerPool.
+    :param stream: a connected TwitchChatStream; its own
+        twitch_receive_messages() must no longer be used
+    :param chat_filter: ChatFilter run in the workers; the ChatReader
+        only gets the messages that pass it, so leave it None when every
+        message is needed (commands, a ChatArchive, analytics)
+    :param workers: number of worker processes
+    """
+
+    def __init__(self, stream, chat_filter=None, workers=None):
+        self.stream = stream
+        # what the workers filter with; a ChatReader using the same
+        # filter does not check the messages again
+        self.chat_filter = chat_filter
+        self.pool = ParseWorkerPool(chat_filter, workers)
+        self.skipped = collections.Counter()
+        self.ready = collections.deque()
+        # set by the reader thread when no worker is left
+        self.error = None
+        # the consumer selects on .s, the collector writes a byte to
+        # the other end whenever results are ready
+        self.s, self._wake = socket.socketpair()
+        self.s.setblocking(False)
+        self._running = True
+        self._threads = [threading.Thread(target=self._read),
+                         threading.Thread(target=self._collect)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def set_filter(self, chat_filter):
+        self.chat_filter = chat_filter
+        self.pool.set_filter(chat_filter)
+
+    def _read(self):
+        """Reader thread: socket to batches of whole lines."""
+        stream = self.stream
+        pending = bytearray()
+        current = None
+        while self._running:
+            s = stream.s
+            if s is None:
+                time.sleep(.5)
+                continue
+            if s is not current:
+                # connected or reconnected: start from a clean line
+                current = s
+                del pending[:]
+            try:
+                select.select([s], [], [], .5)
+                data = s.recv(65536)
+            except (OSError, ValueError) as e:
+                if getattr(e, 'errno', None) in (errno.EAGAIN,
+                                                 errno.EWOULDBLOCK):
+                    continue
+                if stream.connected:
+                    stream.supervisor.lost(s)
+                time.sleep(.5)
+                continue
+            if not data:
+                stream.supervisor.lost(s)
+                time.sleep(.5)
+                continue
+            stream.supervisor.received()
+            pending += data
+            end = pending.rfind(b'\n')
+            if end >= 0:
+                try:
+                    self.pool.submit(bytes(pending[:end + 1]),
+                                     time.monotonic())
+                except RuntimeError as e:
+                    self.error = e
+                    self._wake.send(b'x')
+                    return
+                del pending[:end + 1]
+
+    def _collect(self):
+        """Collector thread: ordered results to the consumer."""
+        while self._running:
+            ready = self.pool.collect(.5)
+            if ready:
+                self.ready.extend(ready)
+                try:
+                    self._wake.send(b'x')
+                except (IOError, OSError):
+                    pass
+
+    def twitch_receive_messages(self):
+        """
+        Like TwitchChatStream.twitch_receive_messages: every chat message
+        received (and passed by the filter) since the last call.
+        :raises RuntimeError: when every worker process has died
+        """
+        try:
+            while self.s.recv(4096):
+                pass
+        except (IOError, OSError):
+            pass
+        if self.error is not None and not self.ready:
+            raise self.error
+        stream = self.stream
+        metrics = stream.metrics
+        while self.ready:
+            read_at, passed, control, skipped = self.ready.popleft()
+            for line in control:
+                stream._parse_message(line)
+            for reason, count in skipped.items():
+                self.skipped[reason] += count
+                if metrics is not None:
+                    metrics.messages.inc(reason, count)
+            if metrics is not None:
+                metrics.lines.inc(amount=len(passed) + len(control) +
+                                  sum(skipped.values()))
+            for fields in passed:
+                message = IRCMessage(*fields)
+                message.received = read_at
+                yield message
+
+    def close(self):
+        """Stop the threads and the workers; the stream stays open."""
+        self._running = False
+        for thread in self._threads:
+            thread.join(2.)
+        self.pool.close()
+        self.s.close()
+        self._wake.close()
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Outbound rate limiting for the Twitch chat.
+
+Twitch silently drops (and eventually locks out) accounts that send too
+much. The limits are counted per account over a sliding window:
+
+    chat messages:  20 per 30 seconds (100 for moderators/broadcasters)
+    JOIN commands:  20 per 10 seconds
+
+TokenBucket enforces one such limit, OutboundScheduler sends queued
+lines on its own thread, keeping PONG replies and JOINs ahead of chat
+messages.
+"""
+import collections
+import threading
+import time
+
+CHAT_LIMIT = 20
+MODERATOR_CHAT_LIMIT = 100
+CHAT_PERIOD = 30.
+JOIN_LIMIT = 20
+JOIN_PERIOD = 10.
+
+
+class TokenBucket(object):
+    """
+    Allows bursts of up to capacity sends, refilled at capacity tokens
+    per period seconds. Safe to share between threads (and connections
+    of the same account).
+    :param capacity: maximum number of sends in a burst
+    :type capacity: int
+    :param period: seconds it takes to refill the whole bucket
+    :type period: float
+    """
+
+    def __init__(self, capacity, period):
+        self.capacity = float(capacity)
+        self.rate = capacity / float(period)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def try_acquire(self):
+        """
+        Take one token if there is one.
+        :return: True when the caller may send now
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1.:
+                self.tokens -= 1.
+                return True
+            return False
+
+    def delay(self):
+        """:return: seconds until the next token is available"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1.:
+                return 0.
+            return (1. - self.tokens) / self.rate
+
+
+class OutboundScheduler(object):
+    """
+    Queue of lines to send to the server, drained by a background thread.
+    Lines are sent in three lanes: control lines (PONG) go out right
+    away, JOINs go next within the join limit, and chat messages use
+    whatever the chat limit leaves.
+    :param send: function called with each line (without line ending);
+        it may raise socket.error, in which case the line is retried
+    :param chat_bucket: TokenBucket for chat messages
+    :param join_bucket: TokenBucket for JOIN commands
+    """
+    CONTROL = 'control'
+    JOIN = 'join'
+    CHAT = 'chat'
+
+    def __init__(self, send, chat_bucket=None, join_bucket=None):
+        self.send = send
+        self.chat_bucket = chat_bucket or TokenBucket(CHAT_LIMIT, CHAT_PERIOD)
+        self.join_bucket = join_bucket or TokenBucket(JOIN_LIMIT, JOIN_PERIOD)
+        self.lanes = {
+            self.CONTROL: collections.deque(),
+            self.JOIN: collections.deque(),
+            self.CHAT: collections.deque(),
+        }
+        self.retry_delay = 1.
+        self._buckets = ((self.CONTROL, None),
+                         (self.JOIN, self.join_bucket),
+                         (self.CHAT, self.chat_bucket))
+        self._wakeup = threading.Condition()
+        self._paused = False
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        """Start the sender thread (once)."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop the sender thread; queued lines are kept."""
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+
+    def pause(self):
+        """Hold all lines, e.g. while the connection is down."""
+        with self._wakeup:
+            self._paused = True
+
+    def resume(self):
+        """Continue sending after pause()."""
+        with self._wakeup:
+            self._paused = False
+            self._wakeup.notify()
+
+    def put(self, line, lane=CHAT):
+        """
+        Queue a line.
+        :param line: the IRC line, without line ending
+        :param lane: one of CONTROL, JOIN and CHAT
+        """
+        with self._wakeup:
+            self.lanes[lane].append(line)
+            self._wakeup.notify()
+
+    def pending(self):
+        """:return: number of lines waiting to be sent"""
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def _next_line(self):
+        """
+        Pick the next line that may be sent now.
+        :return: (line, lane, 0) or (None, None, seconds to wait)
+        """
+        wait = None
+        for lane, bucket in self._buckets:
+            if not self.lanes[lane]:
+                continue
+            if bucket is None or bucket.try_acquire():
+                return self.lanes[lane].popleft(), lane, 0.
+            delay = bucket.delay()
+            wait = delay if wait is None else min(wait, delay)
+        return None, None, wait
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                while True:
+                    if self._stopped:
+                        return
+                    if not self._paused:
+                        line, lane, wait = self._next_line()
+                        if line is not None:
+                            break
+                    else:
+                        wait = None
+                    self._wakeup.wait(wait)
+            try:
+                self.send(line)
+            except (IOError, OSError):
+                # keep the line and its place, the connection will be
+                # back (or replaced) shortly
+                with self._wakeup:
+                    self.lanes[lane].appendleft(line)
+                    self._wakeup.wait(self.retry_delay)
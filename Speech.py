@@ -0,0 +1,796 @@
+# -*- coding: utf-8 -*-
+"""
+Text-to-speech for the chat reader.
+
+A TTSBackend turns text into speech. SpeechWorker owns one backend and
+speaks queued utterances on its own thread, so receiving and parsing the
+chat carries on while a message is being read aloud. SpeechQueue bounds
+what is waiting to be spoken and decides what to drop. Backends that can
+render audio to bytes (can_render) let the worker reuse earlier renders
+from an AudioCache instead of synthesizing the same text again, and let
+it render the next queued utterances while the current one plays
+(prefetch), so there is no synthesis-sized silence between two lines.
+
+Backends:
+    SAPIBackend      Windows speech API through one long-lived PowerShell
+    VoiceExeBackend  the bundled voice.exe, one process per utterance
+    SayBackend       macOS 'say'
+    EspeakBackend    espeak on Linux
+    Pyttsx3Backend   in-process engine, when pyttsx3 is installed
+    FileBackend      writes utterances to a file (headless testing)
+    NullBackend      discards everything
+"""
+import collections
+import itertools
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from AudioCache import normalize
+
+try:
+    import pyttsx3
+except ImportError:
+    pyttsx3 = None
+
+
+def _temp_path(suffix):
+    handle, path = tempfile.mkstemp(suffix=suffix)
+    os.close(handle)
+    return path
+
+
+def _read_and_remove(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+class TTSBackend(object):
+    """
+    Base class of the speech backends. speak() blocks until the
+    utterance has been read aloud. Backends with can_render set also
+    implement render() and play(), splitting synthesis from playback.
+    """
+    name = 'base'
+    can_render = False
+
+    def speak(self, text, volume):
+        """
+        Read text aloud.
+        :param text: the text to speak
+        :param volume: volume from 0 to 100
+        """
+        raise NotImplementedError
+
+    def render(self, text, volume):
+        """
+        Synthesize text without playing it.
+        :return: the audio as bytes, in a format play() accepts
+        """
+        raise NotImplementedError
+
+    def play(self, audio):
+        """Play audio returned by render(), blocking until it is done."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release the synthesizer."""
+        pass
+
+
+class NullBackend(TTSBackend):
+    """
+    Backend that only counts what it was asked to say.
+    :param chars_per_second: when set, pretend to speak at this rate, so
+        the speech queue fills up like with a real voice
+    :param render_seconds: pretend rendering takes this long
+    """
+    name = 'null'
+    can_render = True
+
+    def __init__(self, chars_per_second=None, render_seconds=0.):
+        self.chars_per_second = chars_per_second
+        self.render_seconds = render_seconds
+        self.spoken = 0
+        self.rendered = 0
+
+    def _pretend(self, length):
+        if self.chars_per_second:
+            time.sleep(length / float(self.chars_per_second))
+
+    def speak(self, text, volume):
+        self.spoken += 1
+        if self.render_seconds:
+            time.sleep(self.render_seconds)
+        self._pretend(len(text))
+
+    def render(self, text, volume):
+        self.rendered += 1
+        if self.render_seconds:
+            time.sleep(self.render_seconds)
+        return text.encode('utf-8')
+
+    def play(self, audio):
+        self.spoken += 1
+        self._pretend(len(audio))
+
+
+class FileBackend(TTSBackend):
+    """
+    Backend that appends every utterance to a text file, one piece per
+    line as 'volume<TAB>text'. Useful to run and test the reader
+    headless.
+    :param path: file to write to
+    """
+    name = 'file'
+    can_render = True
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def speak(self, text, volume):
+        self.play(self.render(text, volume))
+
+    def render(self, text, volume):
+        return ('%d\t%s' % (volume, text.replace('\n', ' '))).encode('utf-8')
+
+    def play(self, audio):
+        self._file.write(audio.decode('utf-8') + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class VoiceExeBackend(TTSBackend):
+    """
+    The bundled voice.exe (https://www.elifulkerson.com/projects/commandline-text-to-speech.php).
+    The text is passed as an argument, never through a shell.
+    :param path: path of voice.exe
+    """
+    name = 'voice.exe'
+
+    def __init__(self, path):
+        self.path = path
+
+    def speak(self, text, volume):
+        subprocess.call([self.path, '-v', str(int(volume)), text])
+
+
+class SAPIBackend(TTSBackend):
+    """
+    Windows speech API driven by PowerShell processes that stay alive for
+    the whole session. Commands are fed over stdin and the process
+    reports back on stdout when it is done, so there is no process
+    start-up per message. Rendering has a process of its own, so the
+    next utterance can be rendered while the current one plays.
+    """
+    name = 'sapi'
+    can_render = True
+    # one command per line, fields separated by tabs:
+    #   speak <volume> <text> / render <volume> <wav path> <text> / play <wav path>
+    SCRIPT = (
+        "Add-Type -AssemblyName System.Speech;"
+        "$s = New-Object System.Speech.Synthesis.SpeechSynthesizer;"
+        "[Console]::InputEncoding = [Text.Encoding]::UTF8;"
+        "while (($l = [Console]::In.ReadLine()) -ne $null) {"
+        " $p = $l.Split([char]9, 3);"
+        " if ($p[0] -eq 'play') {"
+        "  (New-Object System.Media.SoundPlayer $p[1]).PlaySync()"
+        " } elseif ($p[0] -eq 'render') {"
+        "  $q = $p[2].Split([char]9, 2);"
+        "  $s.Volume = [int]$p[1];"
+        "  $s.SetOutputToWaveFile($q[0]);"
+        "  $s.Speak($q[1]);"
+        "  $s.SetOutputToDefaultAudioDevice()"
+        " } else {"
+        "  $s.Volume = [int]$p[1];"
+        "  $s.Speak($p[2])"
+        " }"
+        " [Console]::Out.WriteLine('done');"
+        " [Console]::Out.Flush() }")
+
+    def __init__(self):
+        # 'speak' (speak and play) and 'render', each with its lock
+        self._processes = {}
+        self._locks = {'speak': threading.Lock(), 'render': threading.Lock()}
+
+    @staticmethod
+    def available():
+        return os.name == 'nt' and shutil.which('powershell') is not None
+
+    def _start(self):
+        return subprocess.Popen(
+            ['powershell', '-NoProfile', '-NonInteractive', '-Command',
+             self.SCRIPT],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+
+    def _command(self, role, *fields):
+        """Send one command and wait until PowerShell reports it done."""
+        with self._locks[role]:
+            process = self._processes.get(role)
+            if process is None or process.poll() is not None:
+                process = self._processes[role] = self._start()
+            line = '\t'.join(' '.join(str(f).split()) for f in fields) + '\n'
+            process.stdin.write(line.encode('utf-8'))
+            process.stdin.flush()
+            process.stdout.readline()
+
+    def speak(self, text, volume):
+        self._command('speak', 'speak', volume, text)
+
+    def render(self, text, volume):
+        path = _temp_path('.wav')
+        self._command('render', 'render', volume, path, text)
+        return _read_and_remove(path)
+
+    def play(self, audio):
+        path = _temp_path('.wav')
+        try:
+            with open(path, 'wb') as f:
+                f.write(audio)
+            self._command('speak', 'play', path)
+        finally:
+            os.remove(path)
+
+    def close(self):
+        for role in list(self._processes):
+            with self._locks[role]:
+                process = self._processes.pop(role)
+                process.stdin.close()
+                process.wait()
+
+
+class SayBackend(TTSBackend):
+    """macOS 'say'. The volume is set with an embedded [[volm]] command."""
+    name = 'say'
+    can_render = True
+
+    @staticmethod
+    def available():
+        return sys.platform == 'darwin' and shutil.which('say') is not None
+
+    def speak(self, text, volume):
+        subprocess.call(['say', '[[volm %.2f]] %s' % (volume / 100., text)])
+
+    def render(self, text, volume):
+        path = _temp_path('.aiff')
+        subprocess.call(['say', '-o', path,
+                         '[[volm %.2f]] %s' % (volume / 100., text)])
+        return _read_and_remove(path)
+
+    def play(self, audio):
+        path = _temp_path('.aiff')
+        try:
+            with open(path, 'wb') as f:
+                f.write(audio)
+            subprocess.call(['afplay', path])
+        finally:
+            os.remove(path)
+
+
+class EspeakBackend(TTSBackend):
+    """
+    espeak (or espeak-ng) on Linux. Rendering to WAV is supported when
+    aplay is there to play it back.
+    """
+    name = 'espeak'
+
+    def __init__(self):
+        self.program = shutil.which('espeak-ng') or shutil.which('espeak')
+        self.player = shutil.which('aplay')
+        self.can_render = self.player is not None
+
+    @staticmethod
+    def available():
+        return bool(shutil.which('espeak-ng') or shutil.which('espeak'))
+
+    def speak(self, text, volume):
+        # espeak amplitude goes from 0 to 200, 100 being the default
+        subprocess.call([self.program, '-a', str(int(volume * 2)), '--', text])
+
+    def render(self, text, volume):
+        return subprocess.run(
+            [self.program, '-a', str(int(volume * 2)), '--stdout', '--', text],
+            stdout=subprocess.PIPE).stdout
+
+    def play(self, audio):
+        subprocess.run([self.player, '-q', '-'], input=audio)
+
+
+class Pyttsx3Backend(TTSBackend):
+    """In-process speech engine from the optional pyttsx3 package."""
+    name = 'pyttsx3'
+
+    def __init__(self):
+        self.engine = pyttsx3.init()
+
+    @staticmethod
+    def available():
+        return pyttsx3 is not None
+
+    def speak(self, text, volume):
+        self.engine.setProperty('volume', volume / 100.)
+        self.engine.say(text)
+        self.engine.runAndWait()
+
+
+def default_backend(voice_exe=None):
+    """
+    Pick the best speech backend for this platform.
+    :param voice_exe: path of the bundled voice.exe, used on Windows when
+        PowerShell is not available
+    :return: a TTSBackend
+    """
+    if SAPIBackend.available():
+        return SAPIBackend()
+    if os.name == 'nt' and voice_exe:
+        return VoiceExeBackend(voice_exe)
+    if SayBackend.available():
+        return SayBackend()
+    if EspeakBackend.available():
+        return EspeakBackend()
+    if Pyttsx3Backend.available():
+        return Pyttsx3Backend()
+    return NullBackend()
+
+
+def make_backend(name, voice_exe=None, path=None):
+    """
+    Create a backend by name, see the module docstring.
+    :param name: backend name, or 'auto' for default_backend()
+    :param voice_exe: path of voice.exe for the 'voice.exe' backend
+    :param path: output file for the 'file' backend
+    """
+    if name == 'auto':
+        return default_backend(voice_exe)
+    if name == 'null':
+        return NullBackend()
+    if name == 'file':
+        return FileBackend(path or 'speech.txt')
+    if name == 'voice.exe':
+        return VoiceExeBackend(voice_exe)
+    backends = dict((cls.name, cls) for cls in (SAPIBackend, SayBackend,
+                                                 EspeakBackend, Pyttsx3Backend))
+    if name not in backends:
+        raise ValueError("Unknown speech backend: %s" % name)
+    return backends[name]()
+
+
+RENDERING = 'rendering'
+RENDERED = 'rendered'
+
+
+class Utterance(object):
+    """
+    A line waiting to be spoken.
+    :param text: the text to speak
+    :param volume: volume from 0 to 100
+    :param user: chatter the text came from, if any
+    :param received: time.monotonic() when the chat line was received
+    :param prefix: spoken before the text, e.g. 'bob said:'. It is
+        rendered and cached on its own, so the same text from different
+        chatters shares its audio.
+    """
+    __slots__ = ('text', 'volume', 'user', 'received', 'prefix', 'key',
+                 'state', 'audio', 'cancelled')
+
+    def __init__(self, text, volume, user=None, received=None, prefix=None):
+        self.text = text
+        self.volume = volume
+        self.user = user
+        self.received = time.monotonic() if received is None else received
+        self.prefix = prefix
+        # duplicates are the same text, whoever wrote it
+        self.key = normalize(text)
+        # render ahead: None until claimed, then RENDERING and RENDERED
+        self.state = None
+        self.audio = None
+        # set when the queue drops it, so its rendering can stop early
+        self.cancelled = False
+
+    @property
+    def spoken(self):
+        """The prefix and the text, as one string."""
+        if self.prefix is None:
+            return self.text
+        return self.prefix + ' ' + self.text
+
+
+class SpeechQueue(object):
+    """
+    Bounded queue between the chat and the speech worker, so the delay
+    between a chat line and its speech cannot grow without bound.
+    :param maxsize: maximum number of utterances waiting to be spoken,
+        at least 1
+    :param overflow: what to drop when the queue is full:
+        DROP_OLDEST (keep up with the chat), DROP_NEWEST (finish what was
+        queued first) or FAIR_SHARE (drop the oldest line of the chatter
+        with the most queued lines)
+    :param collapse_duplicates: drop a line when the same text is already
+        waiting to be spoken, from any chatter
+    :param max_age: seconds after which a queued line is dropped instead
+        of spoken, None to keep lines until spoken
+    """
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+    FAIR_SHARE = 'fair-share'
+
+    def __init__(self, maxsize=20, overflow=DROP_OLDEST,
+                 collapse_duplicates=True, max_age=None):
+        if overflow not in (self.DROP_OLDEST, self.DROP_NEWEST,
+                            self.FAIR_SHARE):
+            raise ValueError("Unknown overflow policy: %s" % overflow)
+        if maxsize < 1:
+            raise ValueError("The speech queue must hold at least one "
+                             "utterance, not %s" % maxsize)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.collapse_duplicates = collapse_duplicates
+        self.max_age = max_age
+        self.items = collections.deque()
+        self.texts = collections.Counter()
+        self.users = collections.Counter()
+        self.enqueued = 0
+        self.spoken = 0
+        self.dropped = collections.Counter()
+        self.last_lag = 0.
+        self.max_lag = 0.
+        self.total_lag = 0.
+        self._ready = threading.Condition()
+        self._closed = False
+
+    def __len__(self):
+        return len(self.items)
+
+    def _append(self, utterance):
+        self.items.append(utterance)
+        self.texts[utterance.key] += 1
+        self.users[utterance.user] += 1
+
+    def _remove(self, utterance):
+        self.items.remove(utterance)
+        self._forget(utterance)
+
+    def _drop(self, utterance, reason):
+        utterance.cancelled = True
+        self.dropped[reason] += 1
+
+    def _forget(self, utterance):
+        self.texts[utterance.key] -= 1
+        if not self.texts[utterance.key]:
+            del self.texts[utterance.key]
+        self.users[utterance.user] -= 1
+        if not self.users[utterance.user]:
+            del self.users[utterance.user]
+
+    def put(self, utterance):
+        """
+        Queue an utterance, applying the drop policies.
+        :return: False when the utterance itself was dropped
+        """
+        with self._ready:
+            if self.collapse_duplicates and utterance.key in self.texts:
+                self.dropped['duplicate'] += 1
+                return False
+            if len(self.items) >= self.maxsize:
+                if self.overflow == self.DROP_NEWEST:
+                    self.dropped['overflow'] += 1
+                    return False
+                if self.overflow == self.FAIR_SHARE:
+                    user = max(self.users, key=self.users.get)
+                    if user == utterance.user or \
+                            self.users[user] <= self.users[utterance.user]:
+                        # this chatter already has the largest share
+                        self.dropped['fair_share'] += 1
+                        return False
+                    victim = next(u for u in self.items if u.user == user)
+                    self._remove(victim)
+                    self._drop(victim, 'fair_share')
+                else:
+                    victim = self.items.popleft()
+                    self._forget(victim)
+                    self._drop(victim, 'overflow')
+            self._append(utterance)
+            self.enqueued += 1
+            # the speech thread and any render-ahead threads
+            self._ready.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        """
+        Wait for the next utterance that is not too old.
+        :return: an Utterance, or None on timeout or after close()
+        """
+        with self._ready:
+            while True:
+                while self.items:
+                    utterance = self.items.popleft()
+                    self._forget(utterance)
+                    if self.max_age is not None and \
+                            time.monotonic() - utterance.received > self.max_age:
+                        self._drop(utterance, 'expired')
+                        continue
+                    # the render-ahead window moved on
+                    self._ready.notify_all()
+                    return utterance
+                if self._closed:
+                    return None
+                if not self._ready.wait(timeout) and timeout is not None:
+                    return None
+
+    def claim(self, window, timeout=None):
+        """
+        For the render-ahead threads: wait for one of the next window
+        utterances that nobody renders yet, and mark it RENDERING.
+        :return: the Utterance, or None on timeout or after close()
+        """
+        with self._ready:
+            while True:
+                for utterance in itertools.islice(self.items, window):
+                    if utterance.state is None:
+                        utterance.state = RENDERING
+                        return utterance
+                if self._closed:
+                    return None
+                if not self._ready.wait(timeout) and timeout is not None:
+                    return None
+
+    def spoken_done(self, utterance):
+        """Record the end-to-end lag of an utterance that was spoken."""
+        lag = time.monotonic() - utterance.received
+        with self._ready:
+            self.spoken += 1
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.total_lag += lag
+
+    def clear(self):
+        """Drop everything that has not been spoken yet."""
+        with self._ready:
+            for utterance in self.items:
+                self._drop(utterance, 'cleared')
+            self.items.clear()
+            self.texts.clear()
+            self.users.clear()
+
+    def close(self):
+        """Wake up and end the consumer."""
+        with self._ready:
+            self._closed = True
+            self._ready.notify_all()
+
+    def stats(self):
+        """:return: dict with queue depth, drop counters and lag"""
+        with self._ready:
+            return {
+                'depth': len(self.items),
+                'enqueued': self.enqueued,
+                'spoken': self.spoken,
+                'dropped': dict(self.dropped),
+                'last_lag': self.last_lag,
+                'max_lag': self.max_lag,
+                'mean_lag': self.total_lag / self.spoken if self.spoken else 0.,
+            }
+
+
+class SpeechWorker(object):
+    """
+    Speaks queued utterances on a background thread with one long-lived
+    backend. Utterances wait in a bounded SpeechQueue, whose policies
+    decide what is dropped when the chat is faster than the speech.
+    :param backend: the TTSBackend to speak with
+    :param cache: optional AudioCache, used when the backend can render
+    :param speech_queue: the SpeechQueue to take utterances from
+    :param metrics: optional Metrics to time the synthesis, the silence
+        between utterances and the lag up to the start and the end of the
+        speech in
+    :param normalizer: optional TextNormalizer; text is normalized on
+        the speech thread, right before it is spoken (so dropped lines
+        cost nothing), in the pieces of normalizer.chunks()
+    :param prefetch: render this many queued utterances ahead while the
+        current one plays; 0 to render each one when its turn comes.
+        Only used when the backend can render.
+    :param render_threads: threads rendering ahead
+    """
+
+    def __init__(self, backend, cache=None, speech_queue=None, metrics=None,
+                 normalizer=None, prefetch=0, render_threads=1):
+        self.backend = backend
+        self.cache = cache
+        self.queue = speech_queue if speech_queue is not None else SpeechQueue()
+        self.metrics = metrics
+        self.normalizer = normalizer
+        self.prefetch = prefetch if backend.can_render else 0
+        self.gaps = 0
+        self.gap_total = 0.
+        self.gap_max = 0.
+        self.cancelled = 0
+        self._last_end = None
+        self._rendered_ready = threading.Condition()
+        self._render_threads = []
+        if self.prefetch:
+            for _ in range(max(1, render_threads)):
+                thread = threading.Thread(target=self._render_ahead)
+                thread.daemon = True
+                thread.start()
+                self._render_threads.append(thread)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def say(self, text, volume=50, user=None, received=None, prefix=None):
+        """
+        Queue text to be spoken.
+        :param user: chatter the text came from, for the fair-share policy
+        :param received: time.monotonic() when the chat line arrived, to
+            measure the end-to-end lag from there
+        :param prefix: spoken before the text and cached apart from it,
+            e.g. 'bob said:'
+        :return: False when the text was dropped
+        """
+        return self.queue.put(Utterance(text, volume, user, received,
+                                        prefix))
+
+    def clear(self):
+        """Drop everything that has not been spoken yet."""
+        self.queue.clear()
+
+    def stop(self):
+        """Drop pending utterances and stop the worker after the current one."""
+        self.queue.clear()
+        self.queue.close()
+        self._thread.join(5.)
+        for thread in self._render_threads:
+            thread.join(5.)
+        self.backend.close()
+
+    def stats(self):
+        """:return: dict with the silence between utterances and renders
+            thrown away"""
+        return {
+            'gaps': self.gaps,
+            'gap_total': self.gap_total,
+            'gap_max': self.gap_max,
+            'gap_mean': self.gap_total / self.gaps if self.gaps else 0.,
+            'cancelled_renders': self.cancelled,
+        }
+
+    def _pieces(self, text):
+        if self.normalizer is not None:
+            return self.normalizer.chunks(self.normalizer(text))
+        return [text]
+
+    def _texts(self, utterance, render):
+        """
+        The pieces to speak or render. Rendered pieces are cached one by
+        one, so the prefix is a piece of its own there; speak() gets the
+        prefix and the text in one go, without a pause between them.
+        """
+        if not render or utterance.prefix is None:
+            return self._pieces(utterance.spoken)
+        return self._pieces(utterance.prefix) + self._pieces(utterance.text)
+
+    def _gap(self, ready):
+        """
+        Record the silence before a piece starts: since the previous one
+        ended, or since this one was taken from the queue when the
+        speech was idle until then.
+        """
+        now = time.monotonic()
+        if self._last_end is not None:
+            gap = now - max(self._last_end, ready)
+            self.gaps += 1
+            self.gap_total += gap
+            self.gap_max = max(self.gap_max, gap)
+            if self.metrics is not None:
+                self.metrics.gap.observe(gap)
+
+    def _run(self):
+        while True:
+            utterance = self.queue.get()
+            if utterance is None:
+                return
+            ready = time.monotonic()
+            volume = utterance.volume
+            metrics = self.metrics
+            if metrics is not None:
+                metrics.speech_wait.observe(ready - utterance.received)
+            try:
+                if self.prefetch:
+                    for audio in self._audio(utterance):
+                        self._gap(ready)
+                        self.backend.play(audio)
+                        self._last_end = time.monotonic()
+                else:
+                    render = self.cache is not None and self.backend.can_render
+                    for text in self._texts(utterance, render):
+                        if render:
+                            audio = self._rendered(text, volume)
+                            self._gap(ready)
+                            self.backend.play(audio)
+                        else:
+                            self._gap(ready)
+                            start = time.monotonic()
+                            self.backend.speak(text, volume)
+                            if metrics is not None:
+                                metrics.synthesis.observe(time.monotonic() -
+                                                          start)
+                        self._last_end = time.monotonic()
+            except Exception as e:
+                print ("Speech failed: ", e)
+                self._last_end = time.monotonic()
+            self.queue.spoken_done(utterance)
+            if metrics is not None:
+                metrics.end_to_end.observe(time.monotonic() -
+                                           utterance.received)
+
+    def _audio(self, utterance):
+        """The rendered pieces of an utterance, waiting for its renderer."""
+        if utterance.state is None:
+            # nobody got to it before its turn; no renderer can claim it
+            # any more now that it left the queue
+            return self._render(utterance)
+        with self._rendered_ready:
+            while utterance.state != RENDERED:
+                self._rendered_ready.wait()
+        if utterance.audio is None:
+            raise RuntimeError("rendering failed")
+        return utterance.audio
+
+    def _render(self, utterance):
+        """
+        Render every piece of an utterance.
+        :return: list of audio, None when it was dropped meanwhile
+        """
+        audio = []
+        for text in self._texts(utterance, True):
+            if utterance.cancelled:
+                return None
+            audio.append(self._rendered(text, utterance.volume))
+        return audio
+
+    def _render_ahead(self):
+        """Render-ahead thread: renders the next queued utterances."""
+        while True:
+            utterance = self.queue.claim(self.prefetch)
+            if utterance is None:
+                return
+            try:
+                audio = self._render(utterance)
+            except Exception as e:
+                print ("Rendering failed: ", e)
+                audio = None
+            with self._rendered_ready:
+                if utterance.cancelled:
+                    # dropped while it was rendered: nobody will play it
+                    self.cancelled += 1
+                    audio = None
+                utterance.audio = audio
+                utterance.state = RENDERED
+                self._rendered_ready.notify_all()
+
+    def _rendered(self, text, volume):
+        """Audio for text, from the cache or freshly rendered."""
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(text, self.backend.name, volume)
+            audio = self.cache.get(key)
+            if audio is not None:
+                return audio
+        start = time.monotonic()
+        audio = self.backend.render(text, volume)
+        if self.metrics is not None:
+            self.metrics.synthesis.observe(time.monotonic() - start)
+        if key is not None:
+            self.cache.put(key, audio)
+        return audio
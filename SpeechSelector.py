@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Picks what is worth reading when the chat is faster than the speech.
+
+Without a selector every line that passes the ChatFilter goes to the
+speech queue, and in a flood the queue's drop policy decides what is
+read: mostly whatever came last. SpeechSelector instead collects the
+lines of a short time slot and releases only the best of them:
+
+    TOP       the per_slot highest scoring lines of the slot
+    SAMPLE    per_slot lines picked at random (reservoir sampling), so
+              every line of the slot has the same chance
+
+A line's score grows with the chatter's standing (broadcaster,
+moderator, VIP, subscriber) and with mentions of the streamer, and
+shrinks when the same text was seen recently. Chatters who were read
+less than user_cooldown seconds ago are passed over. Offering a line is
+O(1) amortized: a dict lookup for the cooldown, a ring of recent texts
+for the novelty and a heap of per_slot entries (or a reservoir of that
+size) for the slot.
+"""
+import collections
+import heapq
+import random
+import time
+
+from AudioCache import normalize
+
+TOP = 'top'
+SAMPLE = 'sample'
+SELECTION_MODES = (TOP, SAMPLE)
+
+DEFAULT_WEIGHTS = {
+    'broadcaster': 4.,
+    'moderator': 3.,
+    'vip': 2.,
+    'subscriber': 1.,
+    'mention': 3.,
+    'question': .5,
+}
+
+
+class SpeechSelector(object):
+    """
+    Slot by slot selection of the lines to read, see the module docstring.
+    :param mode: TOP or SAMPLE
+    :param slot: seconds per slot
+    :param per_slot: lines released per slot
+    :param mentions: names (e.g. the streamer's) whose mention raises the
+        score of a line
+    :param user_cooldown: seconds after being read before a chatter's
+        lines are considered again, 0 for none
+    :param recent: number of recent lines a text is compared with for
+        the novelty
+    :param weights: dict overriding entries of DEFAULT_WEIGHTS
+    :param rng: random.Random for SAMPLE, e.g. seeded for a replay
+    """
+
+    def __init__(self, mode=TOP, slot=5., per_slot=1, mentions=(),
+                 user_cooldown=30., recent=200, weights=None, rng=None):
+        if mode not in SELECTION_MODES:
+            raise ValueError("Unknown selection mode: %s" % mode)
+        self.mode = mode
+        self.slot = slot
+        self.per_slot = per_slot
+        self.mentions = tuple(name.lower() for name in mentions)
+        self.user_cooldown = user_cooldown
+        self.weights = dict(DEFAULT_WEIGHTS)
+        self.weights.update(weights or {})
+        self.rng = rng or random.Random()
+        self.recent = collections.deque(maxlen=recent)
+        self.seen = collections.Counter()
+        self.last_read = {}
+        self.slot_start = None
+        self.candidates = []
+        self.offered = 0
+        self._seq = 0
+        self.selected = 0
+        self.passed_over = 0
+        self.cooled_down = 0
+
+    def score(self, user, text, message=None):
+        """
+        Relevance of a line; at least 1 for a new text from a chatter
+        without badges.
+        :param message: the IRCMessage, for the badges; None scores the
+            text only
+        """
+        weights = self.weights
+        score = 1.
+        if message is not None and message.has_tags:
+            badges = message.badges
+            if 'broadcaster' in badges:
+                score += weights['broadcaster']
+            elif message.is_moderator:
+                score += weights['moderator']
+            if 'vip' in badges:
+                score += weights['vip']
+            if message.is_subscriber:
+                score += weights['subscriber']
+        lowered = text.lower()
+        for name in self.mentions:
+            if name in lowered:
+                score += weights['mention']
+                break
+        if '?' in text:
+            score += weights['question']
+        # the same text again is worth less each time it was seen lately
+        return score / (1 + self.seen[normalize(text)])
+
+    def _remember(self, text):
+        recent = self.recent
+        key = normalize(text)
+        if len(recent) == recent.maxlen:
+            old = recent.popleft()
+            self.seen[old] -= 1
+            if not self.seen[old]:
+                del self.seen[old]
+        recent.append(key)
+        self.seen[key] += 1
+
+    def offer(self, item, user, text, message=None, now=None):
+        """
+        Consider a line for the current slot.
+        :param item: what due() hands back when the line is selected
+        :param now: time.monotonic(), passed in by replays and tests
+        :return: None when the line is a candidate, 'cooldown' when its
+            chatter was read too recently
+        """
+        if now is None:
+            now = time.monotonic()
+        if self.slot_start is None:
+            self.slot_start = now
+        last = self.last_read.get(user)
+        if last is not None and now - last < self.user_cooldown:
+            self._remember(text)
+            self.cooled_down += 1
+            return 'cooldown'
+        score = self.score(user, text, message)
+        self._remember(text)
+        self.offered += 1
+        self._seq += 1
+        candidates = self.candidates
+        if self.mode == TOP:
+            # min-heap of the best per_slot; ties go to the earlier line
+            entry = (score, -self._seq, user, item)
+            if len(candidates) < self.per_slot:
+                heapq.heappush(candidates, entry)
+            elif entry > candidates[0]:
+                heapq.heapreplace(candidates, entry)
+        elif len(candidates) < self.per_slot:
+            candidates.append((score, -self._seq, user, item))
+        else:
+            index = self.rng.randrange(self.offered)
+            if index < self.per_slot:
+                candidates[index] = (score, -self._seq, user, item)
+        return None
+
+    def due(self, now=None):
+        """
+        Close the slot when its time is up.
+        :return: (items selected, in the order they arrived, number of
+            lines passed over); ([], 0) while the slot is still open
+        """
+        if self.slot_start is None:
+            return [], 0
+        if now is None:
+            now = time.monotonic()
+        if now - self.slot_start < self.slot:
+            return [], 0
+        return self._close(now)
+
+    def flush(self, now=None):
+        """
+        Close the slot whether or not its time is up, e.g. when a replay
+        ends; :return: like due()
+        """
+        if self.slot_start is None:
+            return [], 0
+        if now is None:
+            now = time.monotonic()
+        return self._close(now)
+
+    def _close(self, now):
+        chosen = sorted(self.candidates, key=lambda entry: -entry[1])
+        passed_over = self.offered - len(chosen)
+        self.candidates = []
+        self.offered = 0
+        self.slot_start = now if chosen or passed_over else None
+        last_read = self.last_read
+        # forget chatters whose cooldown is over; that leaves only the
+        # few read in the last user_cooldown seconds
+        for user in [user for user, last in last_read.items()
+                     if now - last >= self.user_cooldown]:
+            del last_read[user]
+        for entry in chosen:
+            last_read[entry[2]] = now
+        self.selected += len(chosen)
+        self.passed_over += passed_over
+        return [entry[3] for entry in chosen], passed_over
+
+    def stats(self):
+        """:return: dict with the selection counters"""
+        return {
+            'mode': self.mode,
+            'selected': self.selected,
+            'passed_over': self.passed_over,
+            'cooldown': self.cooled_down,
+            'pending': len(self.candidates),
+        }
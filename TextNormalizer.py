@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Turns chat text into something a speech engine reads well.
+
+Raw chat is full of things that sound bad or slow synthesis down: links
+read out character by character, "noooooooooo", twenty LULs in a row,
+"gg wp", and control characters or markup some engines interpret (say
+reads [[...]] as commands). TextNormalizer cleans a line up right
+before it is spoken:
+
+    links              https://clips.twitch.tv/Abc  -> link to clips.twitch.tv
+    mentions           @streamer                    -> streamer
+    repeated letters   noooooooo!!!!                -> noo!
+    emote runs         LUL LUL LUL LUL              -> LUL
+    numbers            1st, 10k, 50%, 3.5           -> first, ten thousand, ...
+    abbreviations      gg wp                        -> good game well played
+
+Chat repeats itself, so results are memoized in a bounded LRU cache,
+shared by the threads that render speech.
+chunks() splits a long line into sentence-sized pieces, so the first
+piece can be spoken while the next one is still being synthesized.
+"""
+import collections
+import re
+import threading
+
+from ChatFilter import DEFAULT_EMOTES
+
+ABBREVIATIONS = {
+    'afk': 'away from keyboard', 'bc': 'because', 'brb': 'be right back',
+    'btw': 'by the way', 'dm': 'direct message', 'gg': 'good game',
+    'gj': 'good job', 'gl': 'good luck', 'hf': 'have fun',
+    'idc': "I don't care", 'idk': "I don't know", 'imo': 'in my opinion',
+    'irl': 'in real life', 'jk': 'just kidding', 'nvm': 'never mind',
+    'np': 'no problem', 'omg': 'oh my god', 'pls': 'please', 'plz': 'please',
+    'ppl': 'people', 'rn': 'right now', 'smh': 'shaking my head',
+    'tbh': 'to be honest', 'thx': 'thanks', 'ty': 'thank you', 'u': 'you',
+    'ur': 'your', 'w/': 'with', 'w/o': 'without', 'wp': 'well played',
+    'wtf': 'what the heck', 'yw': "you're welcome",
+}
+
+_ONES = ['zero', 'one', 'two', 'three', 'four', 'five', 'six', 'seven',
+         'eight', 'nine', 'ten', 'eleven', 'twelve', 'thirteen', 'fourteen',
+         'fifteen', 'sixteen', 'seventeen', 'eighteen', 'nineteen']
+_TENS = ['', '', 'twenty', 'thirty', 'forty', 'fifty', 'sixty', 'seventy',
+         'eighty', 'ninety']
+_SCALES = [(10 ** 9, 'billion'), (10 ** 6, 'million'), (1000, 'thousand')]
+_ORDINALS = {'one': 'first', 'two': 'second', 'three': 'third',
+             'five': 'fifth', 'eight': 'eighth', 'nine': 'ninth',
+             'twelve': 'twelfth'}
+_SUFFIXES = {'k': 1000, 'm': 10 ** 6, 'b': 10 ** 9}
+
+_CONTROL = re.compile(u'[\x00-\x1f\x7f\u200b-\u200f\u202a-\u202e\ufeff]')
+_MARKUP = re.compile(r'\[\[|\]\]')
+_URL = re.compile(r'^(?:https?://|www\.)([^/\s?#]*)', re.IGNORECASE)
+_REPEATED_LETTER = re.compile(r'(\w)\1{2,}')
+_REPEATED_PUNCTUATION = re.compile(r'([!?.,])\1+')
+_NUMBER = re.compile(r'^([(\[]?)(-?)(\d+(?:,\d{3})*)(\.\d+)?'
+                     r'(st|nd|rd|th|k|m|b|%)?([.,!?:;)\]]*)$', re.IGNORECASE)
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+
+def number_to_words(number):
+    """
+    Spell out a whole number, e.g. 1337 -> 'one thousand three hundred
+    thirty seven'. Numbers of a trillion and more are read digit by digit.
+    """
+    if number < 0:
+        return 'minus ' + number_to_words(-number)
+    if number < 20:
+        return _ONES[number]
+    if number < 100:
+        tens, ones = divmod(number, 10)
+        return _TENS[tens] + ('' if not ones else ' ' + _ONES[ones])
+    if number < 1000:
+        hundreds, rest = divmod(number, 100)
+        return _ONES[hundreds] + ' hundred' + (
+            '' if not rest else ' ' + number_to_words(rest))
+    if number >= 10 ** 12:
+        return ' '.join(_ONES[int(digit)] for digit in str(number))
+    for scale, name in _SCALES:
+        if number >= scale:
+            head, rest = divmod(number, scale)
+            return number_to_words(head) + ' ' + name + (
+                '' if not rest else ' ' + number_to_words(rest))
+
+
+def ordinal_words(number):
+    """e.g. 21 -> 'twenty first'"""
+    words = number_to_words(number).split(' ')
+    last = words[-1]
+    if last in _ORDINALS:
+        words[-1] = _ORDINALS[last]
+    elif last.endswith('y'):
+        words[-1] = last[:-1] + 'ieth'
+    else:
+        words[-1] = last + 'th'
+    return ' '.join(words)
+
+
+def _expand_number(match):
+    opening, sign, digits, fraction, suffix, closing = match.groups()
+    number = int(digits.replace(',', ''))
+    suffix = (suffix or '').lower()
+    if suffix in ('st', 'nd', 'rd', 'th') and not fraction:
+        words = ordinal_words(number)
+    elif suffix in _SUFFIXES and not fraction:
+        words = number_to_words(number * _SUFFIXES[suffix])
+    else:
+        words = number_to_words(number)
+        if fraction:
+            words += ' point ' + ' '.join(_ONES[int(digit)]
+                                          for digit in fraction[1:])
+        if suffix == '%':
+            words += ' percent'
+        elif suffix in _SUFFIXES:
+            words += ' ' + dict(_SCALES)[_SUFFIXES[suffix]]
+    if sign:
+        words = 'minus ' + words
+    return opening + words + closing
+
+
+class TextNormalizer(object):
+    """
+    Memoizing speech text cleanup, see the module docstring.
+    :param max_entries: size of the memo cache
+    :param emotes: emote names whose runs are collapsed
+    :param abbreviations: dict of lowercase chat abbreviation to its
+        spoken form
+    :param max_repeat: longest run of one letter that is kept
+    :param max_word_run: longest run of one word that is kept
+    :param chunk_size: characters per piece returned by chunks()
+    """
+
+    def __init__(self, max_entries=4096, emotes=DEFAULT_EMOTES,
+                 abbreviations=ABBREVIATIONS, max_repeat=2, max_word_run=3,
+                 chunk_size=200):
+        self.max_entries = max_entries
+        self.emotes = frozenset(emotes)
+        self.abbreviations = abbreviations
+        self.max_repeat = max_repeat
+        self.max_word_run = max_word_run
+        self.chunk_size = chunk_size
+        self.memo = collections.OrderedDict()
+        # the speech thread and the render threads share the memo
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._repeat = r'\1' * max_repeat
+
+    def __call__(self, text):
+        """:return: the normalized text, memoized"""
+        memo = self.memo
+        with self._lock:
+            normalized = memo.get(text)
+            if normalized is not None:
+                memo.move_to_end(text)
+                self.hits += 1
+                return normalized
+            self.misses += 1
+        normalized = self.normalize(text)
+        with self._lock:
+            memo[text] = normalized
+            if len(memo) > self.max_entries:
+                memo.popitem(last=False)
+        return normalized
+
+    def normalize(self, text):
+        """The cleanup itself, without the memo."""
+        text = _MARKUP.sub(' ', _CONTROL.sub(' ', text))
+        words = []
+        previous = None
+        run = 0
+        for word in text.split():
+            word = self._word(word)
+            if not word:
+                continue
+            if word == previous:
+                run += 1
+                if run >= self.max_word_run or word in self.emotes:
+                    continue
+            else:
+                previous = word
+                run = 0
+            words.append(word)
+        text = ' '.join(words)
+        # a leading dash would be taken for an option by command line
+        # speech programs
+        return text.lstrip('- ')
+
+    def _word(self, word):
+        url = _URL.match(word)
+        if url:
+            domain = url.group(1).lower()
+            if domain.startswith('www.'):
+                domain = domain[4:]
+            return 'link to ' + domain if domain else 'link'
+        if word[0] == '@' and len(word) > 1:
+            word = word[1:]
+        expanded = self.abbreviations.get(word.lower())
+        if expanded is not None:
+            return expanded
+        if word[0].isdigit() or (word[0] in '-([' and
+                                 any(c.isdigit() for c in word[:3])):
+            number = _NUMBER.match(word)
+            if number:
+                return _expand_number(number)
+        word = _REPEATED_PUNCTUATION.sub(r'\1', word)
+        return _REPEATED_LETTER.sub(self._repeat, word)
+
+    def chunks(self, text, size=None):
+        """
+        Split text into pieces of about size characters, at sentence
+        ends where possible, else at commas, else at spaces.
+        :return: list of pieces
+        """
+        size = size or self.chunk_size
+        if len(text) <= size:
+            return [text] if text else []
+        pieces = []
+        current = ''
+        for sentence in _SENTENCE_END.split(text):
+            for part in self._split_long(sentence, size):
+                if current and len(current) + 1 + len(part) > size:
+                    pieces.append(current)
+                    current = part
+                else:
+                    current = current + ' ' + part if current else part
+        if current:
+            pieces.append(current)
+        return pieces
+
+    @staticmethod
+    def _split_long(sentence, size):
+        if len(sentence) <= size:
+            return [sentence]
+        parts = []
+        current = ''
+        for word in sentence.replace(', ', ',  ').split(' '):
+            if not word:
+                # a comma boundary: break here when the piece is long
+                if len(current) > size // 2:
+                    parts.append(current)
+                    current = ''
+                continue
+            while len(word) > size:
+                if current:
+                    parts.append(current)
+                    current = ''
+                parts.append(word[:size])
+                word = word[size:]
+            if current and len(current) + 1 + len(word) > size:
+                parts.append(current)
+                current = word
+            else:
+                current = current + ' ' + word if current else word
+        if current:
+            parts.append(current)
+        return parts
+
+    def stats(self):
+        """:return: dict with the memo hit/miss counters"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / float(lookups) if lookups else 0.,
+            'entries': len(self.memo),
+        }
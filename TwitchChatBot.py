@@ -27,268 +27,26 @@ This file contains the python code used to interface with the Twitch
 chat. Twitch chat is IRC-based, so it is basically an IRC-bot, but with
 special features for Twitch, such as congestion control built in.
 """
-import pyHook #import HookManager, GetKeyState, HookConstants
+try: # Windows only, the hotkeys are disabled without it
+    import pyHook #import HookManager, GetKeyState, HookConstants
+except ImportError:
+    pyHook = None
 #from __future__ import print_function
 import tkinter as tk
-import time
-import socket
-import re
 import sys
-try: # Mac user
-    import fcntl
-except: # Windows user, they'll use socket instead
-    pass
-import subprocess
 import os
-import errno
-import threading
-
-class TwitchChatStream(object):
-    """
-    The TwitchChatStream is used for interfacing with the Twitch chat of
-    a channel. To use this, an oauth-account (of the user chatting)
-    should be created. At the moment of writing, this can be done here:
-    https://twitchapps.com/tmi/
-    :param username: Twitch username
-    :type username: string
-    :param oauth: oauth for logging in (see https://twitchapps.com/tmi/)
-    :type oauth: string
-    :param verbose: show all stream messages on stdout (for debugging)
-    :type verbose: boolean
-    """
-
-    def __init__(self, username, oauth, verbose=False):
-        """Create a new stream object, and try to connect."""
-        self.username = username
-        self.oauth = oauth
-        self.verbose = verbose
-        self.current_channel = ""
-        self.last_sent_time = time.time()
-        self.buffer = []
-        self.connected = False
-        self.s = None
-
-    def __enter__(self):
-        self.connect()
-        return self
-
-    def __exit__(self, type, value, traceback):
-        self.s.close()
-
-    @staticmethod
-    def _logged_in_successful(data):
-        """
-        Test the login status from the returned communication of the
-        server.
-        :param data: bytes received from server during login
-        :type data: list of bytes
-        :return boolean, True when you are logged in.
-        """
-        '''
-        if re.match(r'^:(testserver\.local|tmi\.twitch\.tv)'join(self
-                    r' NOTICE \* :'
-                    r'(Login unsuccessful|Error logging in)*$',
-                    data.strip()):
-            return False'''
-        if "Login authentication failed" in data or "Improperly formatted auth" in data:
-            return False
-        else:
-            return True
-
-    @staticmethod
-    def _check_has_ping(data):
-        """
-        Check if the data from the server contains a request to ping.
-        :param data: the byte string from the server
-        :type data: list of bytes
-        :return: True when there is a request to ping, False otherwise
-        """
-        return re.match(
-            r'^PING :tmi\.twitch\.tv$', data)
-
-    @staticmethod
-    def _check_has_channel(data):
-        """
-        Check if the data from the server contains a channel switch.
-        :param data: the byte string from the server
-        :type data: list of bytes
-        :return: Name of channel when new channel, False otherwise
-        """
-        return re.findall(
-            r'^:[a-zA-Z0-9_]+\![a-zA-Z0-9_]+@[a-zA-Z0-9_]+'
-            r'\.tmi\.twitch\.tv '
-            r'JOIN #([a-zA-Z0-9_]+)$', data)
-
-    @staticmethod
-    def _check_has_message(data):
-        """
-        Check if the data from the server contains a message a user
-        typed in the chat.
-        :param data: the byte string from the server
-        :type data: list of bytes
-        :return: returns iterator over these messages
-        """
-        return re.match(r'^:[a-zA-Z0-9_]+\![a-zA-Z0-9_]+@[a-zA-Z0-9_]+'
-                        r'\.tmi\.twitch\.tv '
-                        r'PRIVMSG #[a-zA-Z0-9_]+ :.+$', data)
-
-    def connect(self):
-        """
-        Connect to Twitch
-        """
-
-        # Do not use non-blocking stream, they are not reliably
-        # non-blocking
-        # s.setblocking(False)
-        # s.settimeout(1.0)
-
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        connect_host = "irc.twitch.tv"
-        connect_port = 6667
-        try:
-            s.connect((connect_host, connect_port))
-        except (Exception, IOError):
-            print ("Unable to create a socket to %s:%s" % (connect_host,connect_port))
-            raise  # unexpected, because it is a blocking socket
-
-        # Connected to twitch
-        # Sending our details to twitch...
-        s.send(('PASS %s\r\n' % self.oauth).encode('utf-8'))
-        s.send(('NICK %s\r\n' % self.username).encode('utf-8'))
-        if self.verbose:
-            print ('PASS %s\r\n' % self.oauth)
-            print ('NICK %s\r\n' % self.username)
-
-        received = s.recv(1024).decode()
-        if self.verbose:
-            print (received)
-        if not TwitchChatStream._logged_in_successful(received):
-            # ... and they didn't accept our details
-            self.connected=False
-            return #raise IOError("Twitch did not accept the username-oauth combination")
-        
-        else:
-            self.connected=True
-            # ... and they accepted our details
-            # Connected to twitch.tv!
-            # now make this socket non-blocking on the OS-level
-            try: # Mac user
-                fcntl.fcntl(s,fcntl.F_SETFL,os.O_NONBLOCK)
-            except: # Windows user
-                s.setblocking(0)
-            self.s = s
-
-
-    def _push_from_buffer(self):
-        """
-        Push a message on the stack to the IRC stream.
-        This is necessary to avoid Twitch overflow control.
-        """
-        if len(self.buffer) > 0:
-            if time.time() - self.last_sent_time > 5:
-                try:
-                    message = self.buffer.pop(0)
-                    self.s.send(message.encode('utf-8'))
-                    if self.verbose:
-                        print (message)
-                finally:
-                    self.last_sent_time = time.time()
-
-    def _send(self, message):
-        """
-        Send a message to the IRC stream
-        :param message: the message to be sent.
-        :type message: string
-        """
-        if len(message) > 0:
-            self.buffer.append(message + "\n")
-
-    def _send_pong(self):
-        """
-        Send a pong message, usually in reply to a received ping message
-        """
-        self._send("PONG")
-
-    def join_channel(self, channel):
-        """
-        Join a different chat channel on Twitch.
-        Note, this function returns immediately, but the switch might
-        take a moment
-        :param channel: name of the channel (without #)
-        """
-        self.s.send(('JOIN #%s\r\n' % channel).encode('utf-8'))
-        if self.verbose:
-            print ('JOIN #%s\r\n' % channel)
-
-    def send_chat_message(self, toChannel, message):
-        """
-        Send a chat message to the server.
-        :param message: String to send (don't use \\n)
-        :param toChannel: lowercase string of channel name to send message to
-        """
-        self._send("PRIVMSG #{0} :{1}".format(toChannel, message))
-
-    def _parse_message(self, data):
-        """
-        Parse the bytes received from the socket.
-        :param data: the bytes received from the socket
-        :return:
-        """
-        if TwitchChatStream._check_has_ping(data):
-            self._send_pong()
-        if TwitchChatStream._check_has_channel(data):
-            self.current_channel = \
-                TwitchChatStream._check_has_channel(data)[0]
-
-        if TwitchChatStream._check_has_message(data):
-            return {
-                'channel': re.findall(r'^:.+![a-zA-Z0-9_]+'
-                                      r'@[a-zA-Z0-9_]+'
-                                      r'.+ '
-                                      r'PRIVMSG (.*?) :',
-                                      data)[0],
-                'username': re.findall(r'^:([a-zA-Z0-9_]+)!', data)[0],
-                'message': re.findall(r'PRIVMSG #[a-zA-Z0-9_]+ :(.+)',
-                                      data)[0]#.decode('utf8')
-            }
-        else:
-            return None
-
-    def twitch_receive_messages(self):
-        """
-        Call this function to process everything received by the socket
-        This needs to be called frequently enough (~10s) Twitch logs off
-        users not replying to ping commands.
-        :return: list of chat messages received. Each message is a dict
-            with the keys ['channel', 'username', 'message']
-        """
-        self._push_from_buffer()
-        result = []
-        while True:
-            # process the complete buffer, until no data is left no more
-            try:
-                msg = self.s.recv(4096).decode()     # NON-BLOCKING RECEIVE!
-            except socket.error as e:
-                err = e.args[0]
-                if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
-                    # There is no more data available to read
-                    return result
-                else:
-                    # a "real" error occurred
-                    # import traceback
-                    # import sys
-                    # print(traceback.format_exc())
-                    # print("Trying to recover...")
-                    self.connect()
-                    return result
-            else:
-                if self.verbose:
-                    print (msg)
-                rec = [self._parse_message(line)
-                       for line in filter(None, msg.split('\r\n'))]
-                rec = [r for r in rec if r]     # remove Nones
-                result.extend(rec)
 
+from AudioCache import AudioCache, default_cache_dir
+from ChatAnalytics import ChatAnalytics, format_snapshot
+from ChatFilter import ChatFilter
+from DuplicateDetector import DuplicateDetector
+from EventBus import (AUTO_MESSAGE, CALL, CHANNEL, ERROR, QUIT, READING,
+                      SETTINGS, START, STOP, VOLUME, EventBus, ReaderSettings,
+                      ReaderThread)
+from JoinManager import JOINED, PENDING, SENT
+from Speech import SpeechQueue, SpeechWorker, default_backend
+from TextNormalizer import TextNormalizer
+from TwitchChatStream import TwitchChatStream
 
 class Interface(tk.Tk):
     def __init__(self):
@@ -301,24 +59,35 @@ class Interface(tk.Tk):
         self.menubar = tk.Menu(self,tearoff=0)
         self.menubar.add_command(label="Help",command = self.showHelp)
         self.menubar.add_command(label="Hotkeys", command=self.showHotkeys)
+        self.menubar.add_command(label="Chat Stats", command=self.showStats)
         self.config(menu=self.menubar)
         
         self.isInChannel = False
-        self.wantsToReceive = False
-        self.receiving = False
-        self.STOP = False
+        self.channel = None
         self.silencedUsers = ['nightbot']
-        self.lastMessageTime = time.time()
+        self.maxLength = 100
+        self.chatFilter = ChatFilter()
+        # counted on the reader thread, looked at from the Chat Stats window
+        self.analytics = ChatAnalytics()
+        # the reading thread never touches the widgets: settings and
+        # commands go to it over the bus, statuses come back
+        self.bus = EventBus()
+        self.readerThread = None
+        self.main = None
         self.title("Twitch Chat Text-To-Speech")
         self.attributes('-topmost',1)
         self.lift()
         self.focus_force()
-        OS = os.name
-        if OS == 'nt': # Windows
-            self.isWindows = True
-        else:
-            self.isWindows = False
-            
+        # Speech runs on its own thread so reading chat never waits for it
+        # Old lines are dropped first so speech keeps up with the chat
+        self.speech = SpeechWorker(default_backend(self.resourcePath("voice.exe")),
+                                   cache=AudioCache(directory=default_cache_dir()),
+                                   speech_queue=SpeechQueue(maxsize=10, max_age=60.),
+                                   normalizer=TextNormalizer(),
+                                   prefetch=2)
+        # kept across connects, and off with the checkbox below
+        self.duplicates = DuplicateDetector(normalizer=self.speech.normalizer)
+
         self.PASS = ""
         self.NICK = ""
         
@@ -361,8 +130,14 @@ class Interface(tk.Tk):
         self.stopButton.grid(row=4,column=0,columnspan=2,padx=5,pady=5)
         
         self.filterAt = tk.IntVar()
+        self.filterAt.trace_add('write', self.updateFilter)
         self.filterAtButton = tk.Checkbutton(self.settingsFrame,text="Filter Messages by @",variable = self.filterAt)
         self.filterAtButton.grid(row=20,column=0,columnspan=2,padx=5,pady=0)
+
+        self.skipRepeats = tk.IntVar(value=1)
+        self.skipRepeats.trace_add('write', self.pushSettings)
+        self.skipRepeatsButton = tk.Checkbutton(self.settingsFrame,text="Skip Repeated Lines",variable = self.skipRepeats)
+        self.skipRepeatsButton.grid(row=21,column=0,columnspan=2,padx=5,pady=0)
         
 
         self.chatterLabel = tk.Label(self.optionsFrame,text="Mute User")
@@ -380,28 +155,35 @@ class Interface(tk.Tk):
     
         self.maxLengthLabel = tk.Label(self.optionsFrame,text="Message Character Limit")
         self.maxLengthLabel.grid(row=3,column=0,columnspan=2,padx=5,pady=5)
-        self.maxLengthEntry = tk.Entry(self.optionsFrame)
+        self.maxLengthVar = tk.StringVar()
+        self.maxLengthVar.trace_add('write', self.updateFilter)
+        self.maxLengthEntry = tk.Entry(self.optionsFrame,textvariable=self.maxLengthVar)
         self.maxLengthEntry.grid(row=4,column=0,columnspan=2,padx=5,pady=5)
         self.maxLengthEntry.insert(0,"100")
 
         self.autoMessageLabel = tk.Label(self.settingsFrame,text="Auto Message Interval")
         self.autoMessageLabel.grid(row=0,column=0,columnspan=2,padx=5,pady=5)
-        self.autoMessageEntry = tk.Entry(self.settingsFrame,width=10)
+        self.autoMessageIntervalVar = tk.StringVar()
+        self.autoMessageIntervalVar.trace_add('write', self.pushSettings)
+        self.autoMessageEntry = tk.Entry(self.settingsFrame,width=10,textvariable=self.autoMessageIntervalVar)
         self.autoMessageEntry.insert(0,'100000')
         self.autoMessageEntry.grid(row=1,column=0,sticky='e',padx=5,pady=5)
         self.autoMessageUnitsLabel = tk.Label(self.settingsFrame,text="seconds")
         self.autoMessageUnitsLabel.grid(row=0,column=1,padx=5,pady=5)
         self.autoMessageEntryLabel = tk.Label(self,text="Auto Message").grid(row=0,column=2)
         self.autoMessageVar = tk.IntVar()
+        self.autoMessageVar.trace_add('write', self.pushSettings)
         self.autoMessageToggle = tk.Checkbutton(self,text="On",variable=self.autoMessageVar)
         self.autoMessageToggle.grid(row=0,column=3,sticky='sw')
         self.autoMessageEntryText = tk.Text(self,width=20,height=5,pady=5)
         self.autoMessageEntryText.insert(tk.END, "Chat in this channel is being aloud by a Text-To-Speech program 'TwitchChatBot'!")
         self.autoMessageEntryText.grid(row=1,column=2,columnspan=2,padx=5,sticky='s',pady=10)
+        self.autoMessageEntryText.edit_modified(False)
+        self.autoMessageEntryText.bind('<<Modified>>', self.autoMessageEdited)
         
         self.scaleLabel = tk.Label(self.settingsFrame, text="Speech Volume")
         self.scaleLabel.grid(row=2,column=0,columnspan=2,padx=5,pady=5)
-        self.volumeScale = tk.Scale(self.settingsFrame,from_=0,to=100,orient='horizontal',length=150)
+        self.volumeScale = tk.Scale(self.settingsFrame,from_=0,to=100,orient='horizontal',length=150,command=self.setVolume)
         self.volumeScale.grid(row=3,column=0,columnspan=2,padx=5,pady=4)
         self.volumeScale.set(50)
         
@@ -414,6 +196,8 @@ class Interface(tk.Tk):
         self.closeButton.grid(row=6,column=3,sticky='e',pady=5,padx=5)
         self.addButtons()
         self.disableButtons()
+        self.updateFilter()
+        self.drainEvents()
 
     def addButtons(self):
         self.allButtons = []
@@ -440,6 +224,20 @@ class Interface(tk.Tk):
         topLabel = tk.Label(top,text="CTRL-SHIFT-R to read messages.\nCTRL-SHIFT-S to stop reading.\nCTRL-SHIFT-F to toggle the @Filter.\nCTRL-SHIFT-E to raise volume by 10.\nCTRL-SHIFT-D to lower volume by 10.")
         topLabel.pack()
         top.geometry('{}x{}'.format(320,100))
+
+    def showStats(self):
+        top = tk.Toplevel(self)
+        top.title("Chat Stats")
+        statsLabel = tk.Label(top,justify='left',anchor='w',padx=10,pady=10)
+        statsLabel.pack(fill='both')
+        self.refreshStats(top, statsLabel)
+
+    def refreshStats(self, top, statsLabel):
+        if not top.winfo_exists():
+            return
+        lines = format_snapshot(self.analytics.snapshot(self.channel, top=5))
+        statsLabel.config(text="\n".join(lines) or "No chat seen yet")
+        self.after(1000, self.refreshStats, top, statsLabel)
         
     def checkBannedUsers(self):      
         top = tk.Toplevel(self)
@@ -451,29 +249,86 @@ class Interface(tk.Tk):
         listBox.pack()
             
     def silenceUser(self):
-        user = self.chatterEntry.get()
+        user = self.chatterEntry.get().lower()
         if user not in self.silencedUsers:
             self.silencedUsers.append(user)
         self.chatterEntry.delete(0,'end')
+        self.updateFilter()
         
     def unsilenceUser(self):
         user = self.chatterEntry.get().lower()
         if user in self.silencedUsers:
             self.silencedUsers.remove(user)
         self.chatterEntry.delete(0,'end')
+        self.updateFilter()
+
+    def updateFilter(self, *args):
+        # Rebuild the message filter; only called when a setting changes
+        try:
+            self.maxLength = int(self.maxLengthVar.get())
+        except ValueError:
+            pass # keep the last valid limit while the user is typing
+        mention = None
+        if self.filterAt.get() == 1:
+            mention = self.channel
+        self.chatFilter = ChatFilter(muted_users=self.silencedUsers,
+                                     mention=mention,
+                                     max_length=self.maxLength)
+        self.pushSettings()
+
+    def readerSettings(self):
+        # Snapshot of the widgets, taken on the mainloop
+        try:
+            interval = float(self.autoMessageIntervalVar.get())
+        except ValueError:
+            interval = 120.
+        return ReaderSettings(chat_filter=self.chatFilter,
+                              auto_message=self.autoMessageEntryText.get('1.0',tk.END),
+                              auto_interval=max(interval, 60.),
+                              auto_enabled=self.autoMessageVar.get() == 1,
+                              duplicates=self.duplicates if self.skipRepeats.get() == 1 else None)
+
+    def pushSettings(self, *args):
+        # Only called when a setting changes
+        if not hasattr(self, 'autoMessageEntryText'):
+            return # the window is still being built
+        self.bus.send(SETTINGS, self.readerSettings())
+
+    def autoMessageEdited(self, event):
+        if self.autoMessageEntryText.edit_modified():
+            self.autoMessageEntryText.edit_modified(False)
+            self.pushSettings()
+
+    def setVolume(self, value):
+        self.bus.send(VOLUME, int(float(value)))
+
+    def stepVolume(self, step):
+        self.volumeScale.set(min(100, max(0, self.volumeScale.get() + step)))
+
+    def toggleFilter(self):
+        self.filterAt.set(1 - self.filterAt.get())
         
     def connect(self):
         self.NICK = self.NICKEntry.get()
         self.PASS = self.PASSEntry.get()
         if not self.PASS.startswith('oauth:'):
             self.PASS = 'oauth:'+self.PASS
+        self.quitReader()
+        if self.main is not None:
+            # otherwise its supervisor keeps reconnecting the old login
+            self.main.close()
         self.main = TwitchChatStream(self.NICK,self.PASS,verbose=False)
         #self.main = TwitchChatStream(self.NICK,self.PASS,verbose=True)
         self.main.connect()
         if self.main.connected:
             self.connectButton.config(bg="green")
             self.joinButton.config(state='normal')
-            self.checkIfWantsToReceive()
+            # from now on only the reader thread reads the connection
+            self.readerThread = ReaderThread(self.main, self.speech, self.bus,
+                                             self.readerSettings(),
+                                             volume=int(self.volumeScale.get()),
+                                             analytics=self.analytics,
+                                             verbose=True)
             print("Connected")
         else:
             self.connectButton.config(bg="red")
@@ -481,28 +336,31 @@ class Interface(tk.Tk):
             
     def join(self):
         self.joinButton.configure(bg="red")
-        channel = self.JOINEntry.get().lower()
+        channel = self.JOINEntry.get().lower().lstrip('#')
         self.main.join_channel(channel)
-        #self.main.twitch_receive_messages()
-        self.old_channel = self.main.current_channel
-        time.sleep(1)
-        self.main.twitch_receive_messages()
-        print("-----------------")
-        print("I was in: " + self.old_channel)
-        print("I'm in channel: " + self.main.current_channel)
-        print("-----------------")      
-        if self.old_channel == self.main.current_channel:
-            # Didn't actually join channel
-            self.joinButton.configure(bg="red")
-            self.disableButtons()
-            print("I'm in channel: " + self.main.current_channel)
-            
-        else:
+        # the answer comes in asynchronously, look for it without
+        # blocking the GUI
+        self.after(100, self.checkJoin, channel)
+
+    def checkJoin(self, channel):
+        # the reader thread reads the answer, this only looks at it
+        state = self.main.joins.state(channel)
+        if state in (PENDING, SENT):
+            self.after(100, self.checkJoin, channel)
+        elif state == JOINED:
             # Successfully joined channel
             self.joinButton.configure(bg="green")
             self.enableButtons()
             self.isInChannel = True
-        print("I'm in channel: " + self.main.current_channel)
+            self.channel = channel
+            self.updateFilter()
+            self.bus.send(CHANNEL, channel)
+            print("I'm in channel: " + channel)
+        else:
+            # Didn't actually join channel
+            self.joinButton.configure(bg="red")
+            self.disableButtons()
+            print("Could not join %s: %s" % (channel, state))
 
                 
     def resourcePath(self,filename):
@@ -513,134 +371,68 @@ class Interface(tk.Tk):
             base_path = os.path.abspath(".")
         return os.path.join(base_path, filename)
 
-    def TTS(self,message):
-        if self.isWindows and not self.STOP:
-            voice = self.resourcePath("voice.exe")
-            subprocess.call(voice + " -v " + str(int(self.volumeScale.get())) + " " + message,shell=True)
-        if not self.isWindows and not self.STOP:
-            os.system("say " + message)
-            
     def receiveMessages(self):
-        print("Receiving: ", self.receiving)
-        self.STOP = False
-        if not self.receiving and self.isInChannel:
-            self.recThread = threading.Thread(target=self.receive)
-            self.recThread.start()
-            self.receiveMessagesButton.config(bg="green")
-            print("After started thread and color changed to green")
-        
+        if self.isInChannel:
+            self.bus.send(START)
+
     def stop(self):
         if self.isInChannel:
-            try:            
-                print("Wanted to receive before stopping? --> ", self.wantsToReceive)
-                self.STOP = True    
-                self.receiving = False
-                self.wantsToReceive = False
-                del(self.recThread) 
-                self.receiveMessagesButton.config(bg="red")
-            except Exception as e:
-                print("GOT AN ERROR IN STOP: ", e)
-                pass
-        
+            self.bus.send(STOP)
+
+    def quitReader(self):
+        if self.readerThread is not None:
+            self.bus.send(QUIT)
+            self.readerThread.join(2.)
+            self.readerThread = None
+
     def totalDestroy(self):
-        self.stop()
+        self.quitReader()
+        self.speech.stop()
         self.destroy()        
         try:
-            self.main.s.close()
+            self.main.close()
         except:
             pass
-        
-    def autoSend(self):
-        try:
-            autoMessageInterval = float(self.autoMessageEntry.get()) # float
-        except:
-            autoMessageInterval = 120.
-        if autoMessageInterval < 60.:
-            self.autoMessageEntry.delete(0,'end')
-            self.autoMessageEntry.insert(0,'60')
-            autoMessageInterval = 60.
-        self.autoMessage = self.autoMessageEntryText.get('1.0',tk.END)#"BOOGA"#Include @" + self.main.current_channel + " to have your message read aloud to " + self.main.current_channel + "!"
-        currentTime = time.time()
-        timePassed = currentTime - self.lastMessageTime
-        autoMessageOn = self.autoMessageVar.get()
-        if timePassed > autoMessageInterval and autoMessageOn:
-            print("I'm sending a message")
-            self.main.send_chat_message(self.main.current_channel,self.autoMessage)
-            time.sleep(1)
-            self.lastMessageTime = currentTime
-            self.main.twitch_receive_messages()
-            
-    def checkIfWantsToReceive(self):
-        if self.wantsToReceive and not self.receiving:
-            print("USER HOTKEYED RECEIVED")
-            self.receiveMessages()
-        self.after(1000,self.checkIfWantsToReceive) # Call this function repeatedly every 1000 milliseconds
-            
+
+    def drainEvents(self):
+        # Statuses of the reader thread and calls from the keyboard hook
+        for status, value in self.bus.statuses():
+            if status == READING:
+                self.receiveMessagesButton.config(bg="green" if value else "red")
+            elif status == AUTO_MESSAGE:
+                print("I sent a message")
+            elif status == ERROR:
+                print(value)
+            elif status == CALL:
+                value()
+        self.after(50, self.drainEvents)
+
     def OnKeyboardEvent(self,event):
         pressedShift = pyHook.GetKeyState(pyHook.HookConstants.VKeyToID('VK_LSHIFT')) or  pyHook.GetKeyState(pyHook.HookConstants.VKeyToID('VK_RSHIFT'))
         pressedCtrl = pyHook.GetKeyState(pyHook.HookConstants.VKeyToID('VK_CONTROL'))
         print(pyHook.HookConstants.IDToName(event.KeyID))
         if pressedShift and pressedCtrl:
             pressedKey = pyHook.HookConstants.IDToName(event.KeyID) # Letter that user pressed
+            # the hook may run outside the mainloop: commands go straight
+            # to the reader thread, widget changes through the mainloop
             if pressedKey == 'R':
-                time.sleep(.2)
                 print("Receive")
-                self.wantsToReceive = True
+                self.bus.send(START)
             elif pressedKey == 'S':
                 print("Stop")
-                self.stop()
+                self.bus.send(STOP)
             elif pressedKey == 'F':
                 print("Toggle filter")
-                self.filterAt.set(abs(1 - self.filterAt.get())) # Swaps 0 with 1, 1 with 0
+                self.bus.post(CALL, self.toggleFilter)
             elif pressedKey == 'D':
-                loweredVolume = self.volumeScale.get() - 10
-                if loweredVolume < 0:
-                    loweredVolume = 0
-                self.volumeScale.set(loweredVolume)
+                self.bus.post(CALL, lambda: self.stepVolume(-10))
             elif pressedKey == 'E':
-                raisedVolume = self.volumeScale.get() + 10
-                if raisedVolume > 100:
-                    raisedVolume = 100
-                self.volumeScale.set(raisedVolume)
+                self.bus.post(CALL, lambda: self.stepVolume(10))
 
         return True
         
 
 
-    def receive(self):
-        print("IN RECEIVE FUNC")
-        self.receiving = True
-        
-        if self.STOP:
-            print ("self.stop is True")
-            return
-        
-        
-        
-        
-        while not self.STOP:
-            self.autoSend()
-            self.maxLength = int(self.maxLengthEntry.get())
-            #print(self.filterAt.get())
-            rec = self.main.twitch_receive_messages()        
-            if rec and not self.STOP:
-                for message_info in rec:
-                    if message_info['channel'] == "#"+self.main.current_channel:
-                        if self.STOP:
-                            return  
-                        user = message_info['username'].lower()
-                        message = message_info['message']
-                        fullMessage = user + " said: " + message
-                        if (self.filterAt.get() == 1 and ("@"+self.main.current_channel in message.lower()) ) or self.filterAt.get() == 0:                            
-                            if user not in self.silencedUsers and len(message) < self.maxLength:
-                                fullMessage.replace("@","")
-                                self.TTS(fullMessage)
-                                print(user + " length: " + str(len(message)))
-        
-            time.sleep(.2)      
-
-        self.STOP = False
-                
     def enableButtons(self):
         for button in self.allButtons:
             button.config(state='normal')
@@ -652,11 +444,12 @@ class Interface(tk.Tk):
 # ---------- Run Program ----------- #
 
 
-gui = Interface()
-
-hm = pyHook.HookManager()    
-hm.KeyDown = gui.OnKeyboardEvent
-hm.HookKeyboard()
-# set the hook
-gui.mainloop()
+if __name__ == '__main__':
+    gui = Interface()
 
+    if pyHook is not None:
+        hm = pyHook.HookManager()    
+        hm.KeyDown = gui.OnKeyboardEvent
+        hm.HookKeyboard()
+        # set the hook
+    gui.mainloop()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless Twitch chat reader.
+
+Reads one or more channels aloud without the GUI or the keyboard hook,
+e.g. on a server or a streaming box without a desktop session:
+
+    python TwitchChatDaemon.py --username mybot --channel tsm_dyrus
+
+Settings can also come from an INI file with a [reader] section; the
+keys are the long option names, lists are comma separated, except the
+regular expressions of block_pattern, which go one per line. Options on
+the command line win, and list options given on the command line are
+added to the ones from the file:
+
+    [reader]
+    username = mybot
+    oauth = oauth:abcdefg12345
+    channel = tsm_dyrus, another_channel
+    backend = file
+    output = speech.txt
+    mute = nightbot, streamelements
+    block_pattern =
+        ^!
+        (lul|kek){3,}
+
+The oauth code can also be passed in the TWITCH_OAUTH environment
+variable, which keeps it out of the process list.
+"""
+import argparse
+import configparser
+import os
+import signal
+import sys
+import threading
+
+from AudioCache import AudioCache, default_cache_dir
+from ChatCommands import (BROADCASTER, EVERYONE, MODERATOR, SUBSCRIBER,
+                          ChatCommands)
+from ChatFilter import ChatFilter
+from ChatReader import ChatReader
+from DuplicateDetector import DuplicateDetector
+from JoinManager import JOINED
+from Speech import SpeechQueue, SpeechWorker, make_backend
+from SpeechSelector import SELECTION_MODES, SpeechSelector
+from TextNormalizer import TextNormalizer
+from TwitchChatStream import TWITCH_HOST, TWITCH_PORT, TwitchChatStream
+
+LIST_OPTIONS = ('channel', 'mute', 'block_word', 'block_pattern')
+
+PERMISSIONS = {'everyone': EVERYONE, 'subscriber': SUBSCRIBER,
+               'moderator': MODERATOR, 'broadcaster': BROADCASTER}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Read Twitch chat aloud, without a GUI.")
+    parser.add_argument('--config', help="INI file with a [reader] section")
+    parser.add_argument('--username', help="Twitch username")
+    parser.add_argument('--oauth', help="oauth code (see https://twitchapps.com/tmi/)")
+    parser.add_argument('--channel', action='append',
+                        help="channel to read, can be repeated")
+    parser.add_argument('--host', default=TWITCH_HOST,
+                        help="IRC server, e.g. a local MockTwitchServer")
+    parser.add_argument('--port', type=int, default=TWITCH_PORT)
+    parser.add_argument('--backend', default='auto',
+                        help="speech backend: auto, sapi, voice.exe, say, "
+                             "espeak, pyttsx3, file or null")
+    parser.add_argument('--output', default='speech.txt',
+                        help="output file of the 'file' backend")
+    parser.add_argument('--volume', type=int, default=50)
+    parser.add_argument('--max-length', type=int, default=100,
+                        help="skip messages of this many characters or more")
+    parser.add_argument('--mention',
+                        help="only read messages containing @MENTION")
+    parser.add_argument('--mute', action='append',
+                        help="user to ignore, can be repeated")
+    parser.add_argument('--block-word', action='append',
+                        help="skip messages with this word, can be repeated")
+    parser.add_argument('--block-pattern', action='append',
+                        help="skip messages matching this regular expression")
+    parser.add_argument('--skip-emote-only', action='store_true')
+    parser.add_argument('--strip-emotes', action='store_true',
+                        help="leave emotes out of the spoken text")
+    parser.add_argument('--raw-text', action='store_true',
+                        help="speak the chat as is, without expanding "
+                             "numbers and abbreviations or eliding links")
+    parser.add_argument('--queue-size', type=int, default=10)
+    parser.add_argument('--overflow', default=SpeechQueue.DROP_OLDEST,
+                        choices=(SpeechQueue.DROP_OLDEST,
+                                 SpeechQueue.DROP_NEWEST,
+                                 SpeechQueue.FAIR_SHARE))
+    parser.add_argument('--max-age', type=float, default=60.,
+                        help="drop lines waiting longer than this many seconds")
+    parser.add_argument('--commands', action='store_true',
+                        help="let viewers use !tts and !voice, and "
+                             "moderators !skip, !mute and !unmute")
+    parser.add_argument('--tts-permission', default='everyone',
+                        choices=sorted(PERMISSIONS),
+                        help="who may use !tts")
+    parser.add_argument('--command-cooldown', type=float, default=30.,
+                        help="seconds before a viewer can use a command again")
+    parser.add_argument('--dedup-window', type=float, default=30.,
+                        help="skip lines (nearly) like one of the last this "
+                             "many seconds, 0 to read repeats")
+    parser.add_argument('--dedup-repeats', type=int, default=1,
+                        help="times a repeated line is read per window")
+    parser.add_argument('--dedup-capacity', type=int, default=4096,
+                        help="most lines remembered for the duplicate check")
+    parser.add_argument('--select', default='all',
+                        choices=('all',) + SELECTION_MODES,
+                        help="in a flood, read every line that passes the "
+                             "filter (all), the best ones of each slot (top) "
+                             "or a random sample of each slot (sample)")
+    parser.add_argument('--slot', type=float, default=5.,
+                        help="seconds per selection slot")
+    parser.add_argument('--per-slot', type=int, default=1,
+                        help="lines read per selection slot")
+    parser.add_argument('--user-cooldown', type=float, default=30.,
+                        help="seconds before a chatter who was read is "
+                             "selected again")
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help="render this many queued lines ahead while "
+                             "one is spoken, 0 to render one at a time")
+    parser.add_argument('--render-threads', type=int, default=1,
+                        help="threads rendering ahead")
+    parser.add_argument('--cache-dir', default=default_cache_dir(),
+                        help="on-disk audio cache, 'none' to disable")
+    parser.add_argument('--archive-dir',
+                        help="keep every chat message in an archive here")
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help="parse and filter in this many processes, "
+                             "for very busy channels")
+    parser.add_argument('--analytics', action='store_true',
+                        help="count the chat rate, top chatters, emotes and "
+                             "words; served as JSON on /analytics of the "
+                             "metrics port and printed on exit")
+    parser.add_argument('--analytics-capacity', type=int, default=200,
+                        help="chatters, emotes and words tracked per channel")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve Prometheus metrics on this local port")
+    parser.add_argument('--metrics-dump',
+                        help="write the metrics to this file, '-' to print them")
+    parser.add_argument('--metrics-interval', type=float, default=10.,
+                        help="seconds between two metrics dumps")
+    parser.add_argument('--verbose', action='store_true')
+    return parser
+
+
+def read_config(path):
+    """
+    Read the [reader] section of an INI file.
+    :return: dict of option name to value, lists already split
+    """
+    # no interpolation, a '%' in a pattern is just a '%'
+    config = configparser.ConfigParser(interpolation=None)
+    if not config.read(path):
+        raise IOError("Cannot read config file %s" % path)
+    settings = {}
+    if config.has_section('reader'):
+        for key, value in config.items('reader'):
+            key = key.replace('-', '_')
+            if key == 'block_pattern':
+                # regular expressions may contain commas, as in a{1,3}
+                value = [v.strip() for v in value.splitlines() if v.strip()]
+            elif key in LIST_OPTIONS:
+                value = [v.strip() for v in value.split(',') if v.strip()]
+            elif key in ('skip_emote_only', 'strip_emotes', 'raw_text',
+                         'commands', 'analytics', 'verbose'):
+                value = config.getboolean('reader', key)
+            settings[key] = value
+    return settings
+
+
+def parse_args(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.config:
+        # values from the file become defaults, so the command line wins
+        parser.set_defaults(**read_config(args.config))
+        args = parser.parse_args(argv)
+    args.oauth = args.oauth or os.environ.get('TWITCH_OAUTH')
+    if not args.username or not args.oauth or not args.channel:
+        parser.error("--username, --oauth (or TWITCH_OAUTH) and --channel are required")
+    if not args.oauth.startswith('oauth:'):
+        args.oauth = 'oauth:' + args.oauth
+    args.channel = [c.lower().lstrip('#') for c in args.channel]
+    return args
+
+
+def build_reader(args, stream, metrics=None):
+    """Create the filter, speech worker and reader described by args."""
+    chat_filter = ChatFilter(muted_users=args.mute or (),
+                             mention=args.mention,
+                             max_length=args.max_length,
+                             blocked_words=args.block_word or (),
+                             blocked_patterns=args.block_pattern or (),
+                             skip_emote_only=args.skip_emote_only)
+    normalizer = None if args.raw_text else TextNormalizer()
+    cache = None
+    if args.cache_dir and args.cache_dir.lower() != 'none':
+        cache = AudioCache(directory=args.cache_dir)
+    speech = SpeechWorker(make_backend(args.backend, path=args.output),
+                          cache=cache,
+                          speech_queue=SpeechQueue(maxsize=args.queue_size,
+                                                   overflow=args.overflow,
+                                                   max_age=args.max_age),
+                          metrics=metrics,
+                          normalizer=normalizer,
+                          prefetch=args.prefetch,
+                          render_threads=args.render_threads)
+    archive = None
+    if args.archive_dir:
+        from ChatArchive import ChatArchive
+        archive = ChatArchive(args.archive_dir)
+    commands = None
+    if args.commands:
+        commands = ChatCommands(tts_permission=PERMISSIONS[args.tts_permission],
+                                user_cooldown=args.command_cooldown)
+    duplicates = None
+    if args.dedup_window > 0:
+        duplicates = DuplicateDetector(args.dedup_window, args.dedup_repeats,
+                                       args.dedup_capacity,
+                                       normalizer=normalizer)
+    analytics = None
+    if args.analytics:
+        from ChatAnalytics import ChatAnalytics
+        analytics = ChatAnalytics(args.analytics_capacity)
+    selector = None
+    if args.select != 'all':
+        # mentions of the streamers or of the reader's own account
+        mentions = list(args.channel or ())
+        if args.username:
+            mentions.append(args.username)
+        selector = SpeechSelector(
+            args.select, slot=args.slot, per_slot=args.per_slot,
+            mentions=mentions, user_cooldown=args.user_cooldown)
+    return ChatReader(stream, speech, chat_filter, channels=args.channel,
+                      volume=args.volume, strip_emotes=args.strip_emotes,
+                      archive=archive, metrics=metrics, commands=commands,
+                      duplicates=duplicates, selector=selector,
+                      analytics=analytics, verbose=args.verbose)
+
+
+def report_joins(stream, channels, timeout=120.):
+    """Print how joining the channels went, once it is known."""
+    states = stream.joins.wait(channels, timeout)
+    for channel in channels:
+        join = stream.joins.joins.get(channel)
+        if states[channel] == JOINED:
+            print ("Joined #%s in %.1f s" % (channel, join.latency))
+        else:
+            print ("Could not join #%s: %s" % (
+                channel, join.reason if join and join.reason else states[channel]))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    metrics = None
+    if args.metrics_port is not None or args.metrics_dump:
+        from Metrics import Metrics, MetricsDump, MetricsServer
+        metrics = Metrics()
+    stream = TwitchChatStream(args.username, args.oauth, verbose=args.verbose,
+                              host=args.host, port=args.port, metrics=metrics)
+    stream.connect()
+    if not stream.connected:
+        print ("Twitch did not accept the username-oauth combination")
+        return 1
+    stream.join_channels(args.channel)
+    # the reader loop below reads the answers to the JOINs
+    threading.Thread(target=report_joins, args=(stream, args.channel),
+                     daemon=True).start()
+    reader = build_reader(args, stream, metrics)
+    receiver = None
+    if args.parse_workers > 0:
+        from ParseWorkers import ParallelReceiver
+        # the workers would filter the commands out (e.g. without the
+        # @mention) and keep lines from the archive and the analytics,
+        # which want every message, so with any of them on they only parse
+        only_parse = reader.commands is not None or \
+            reader.archive is not None or reader.analytics is not None
+        receiver = ParallelReceiver(
+            stream, None if only_parse else reader.chat_filter,
+            args.parse_workers)
+        reader.stream = receiver
+    exporters = []
+    if metrics is not None:
+        metrics.watch_stream(stream)
+        metrics.watch_speech(reader.speech)
+        if reader.duplicates is not None:
+            metrics.watch_duplicates(reader.duplicates)
+        if reader.analytics is not None:
+            metrics.watch_analytics(reader.analytics)
+        if args.metrics_port is not None:
+            exporters.append(MetricsServer(metrics, args.metrics_port,
+                                           analytics=reader.analytics).start())
+        if args.metrics_dump:
+            exporters.append(MetricsDump(metrics, args.metrics_dump,
+                                         args.metrics_interval).start())
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stopped.set())
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    print ("Reading %s" % ", ".join(args.channel))
+    try:
+        reader.run(stopped)
+    finally:
+        for exporter in exporters:
+            exporter.stop()
+        reader.speech.stop()
+        if reader.archive is not None:
+            reader.archive.close()
+        if receiver is not None:
+            receiver.close()
+        stream.close()
+    if reader.analytics is not None:
+        from ChatAnalytics import format_snapshot
+        for line in format_snapshot(reader.analytics.snapshot(top=5)):
+            print (line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,873 @@
+# -*- coding: utf-8 -*-
+"""
+Connection to the Twitch chat.
+
+This file contains the python code used to interface with the Twitch
+chat. Twitch chat is IRC-based, so it is basically an IRC-bot, but with
+special features for Twitch, such as congestion control built in.
+
+TwitchChatStream is the original polling client driven by
+twitch_receive_messages; AsyncTwitchChatStream offers the same surface
+on top of asyncio for event-driven reading. TwitchChatPool spreads many
+channels over several TwitchChatStream connections.
+"""
+import asyncio
+import queue
+import random
+import select
+import threading
+import time
+import socket
+try: # Mac user
+    import fcntl
+except: # Windows user, they'll use socket instead
+    pass
+import os
+import errno
+
+from JoinManager import JOIN_ERRORS, JOIN_FAILURES, JoinManager, channel_name
+from RateLimiter import (CHAT_LIMIT, CHAT_PERIOD, JOIN_LIMIT, JOIN_PERIOD,
+                         MODERATOR_CHAT_LIMIT, OutboundScheduler, TokenBucket)
+from TwitchIRC import CAPABILITIES, LineFramer, parse_line
+
+TWITCH_HOST = "irc.twitch.tv"
+TWITCH_PORT = 6667
+
+
+class TwitchChatStream(object):
+    """
+    The TwitchChatStream is used for interfacing with the Twitch chat of
+    a channel. To use this, an oauth-account (of the user chatting)
+    should be created. At the moment of writing, this can be done here:
+    https://twitchapps.com/tmi/
+    :param username: Twitch username
+    :type username: string
+    :param oauth: oauth for logging in (see https://twitchapps.com/tmi/)
+    :type oauth: string
+    :param verbose: show all stream messages on stdout (for debugging)
+    :type verbose: boolean
+    :param moderator: the account is a moderator or the broadcaster of
+        the channels it chats in, which raises the chat limit
+    :type moderator: boolean
+    :param chat_bucket: TokenBucket to share the chat limit with other
+        connections of the same account
+    :param join_bucket: TokenBucket to share the JOIN limit with other
+        connections of the same account
+    :param host: IRC server to connect to
+    :param port: port of the IRC server
+    :param capabilities: IRCv3 capabilities to request, by default the
+        message tags and the Twitch commands
+    :param metrics: optional Metrics to record received lines, parse
+        latency and reconnects in
+    """
+
+    def __init__(self, username, oauth, verbose=False, moderator=False,
+                 chat_bucket=None, join_bucket=None,
+                 host=TWITCH_HOST, port=TWITCH_PORT,
+                 capabilities=CAPABILITIES, metrics=None):
+        """Create a new stream object, and try to connect."""
+        self.username = username
+        self.oauth = oauth
+        self.verbose = verbose
+        self.host = host
+        self.port = port
+        self.capabilities = capabilities
+        self.metrics = metrics
+        self.current_channel = ""
+        self.channels = set()
+        self.joins = JoinManager()
+        self.connected = False
+        self.s = None
+        self.framer = LineFramer()
+        # seconds a full socket buffer may block the sending of a line
+        self.send_timeout = 10.
+        if chat_bucket is None:
+            chat_bucket = TokenBucket(
+                MODERATOR_CHAT_LIMIT if moderator else CHAT_LIMIT, CHAT_PERIOD)
+        self.outbound = OutboundScheduler(self._send_now, chat_bucket,
+                                          join_bucket)
+        self.supervisor = ConnectionSupervisor(self)
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        """Stop sending and reconnecting, and close the connection."""
+        self.supervisor.stop()
+        self.outbound.stop()
+        self.connected = False
+        if self.s is not None:
+            self.s.close()
+
+    @staticmethod
+    def _logged_in_successful(data):
+        """
+        Test the login status from the returned communication of the
+        server.
+        :param data: bytes received from server during login
+        :type data: list of bytes
+        :return boolean, True when you are logged in.
+        """
+        '''
+        if re.match(r'^:(testserver\.local|tmi\.twitch\.tv)'join(self
+                    r' NOTICE \* :'
+                    r'(Login unsuccessful|Error logging in)*$',
+                    data.strip()):
+            return False'''
+        if "Login authentication failed" in data or "Improperly formatted auth" in data:
+            return False
+        else:
+            return True
+
+    def connect(self):
+        """
+        Connect to Twitch
+        """
+
+        # Do not use non-blocking stream, they are not reliably
+        # non-blocking
+        # s.setblocking(False)
+        # s.settimeout(1.0)
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        connect_host = self.host
+        connect_port = self.port
+        try:
+            s.connect((connect_host, connect_port))
+        except (Exception, IOError):
+            print ("Unable to create a socket to %s:%s" % (connect_host,connect_port))
+            s.close()
+            raise  # unexpected, because it is a blocking socket
+
+        received = ''
+        try:
+            # Connected to twitch
+            # Sending our details to twitch...
+            if self.capabilities:
+                s.send(('CAP REQ :%s\r\n' % ' '.join(self.capabilities)).encode('utf-8'))
+            s.send(('PASS %s\r\n' % self.oauth).encode('utf-8'))
+            s.send(('NICK %s\r\n' % self.username).encode('utf-8'))
+            if self.verbose:
+                print ('PASS %s\r\n' % self.oauth)
+                print ('NICK %s\r\n' % self.username)
+
+            s.settimeout(10.)  # don't hang on a server that never answers
+            # the CAP ACK can arrive on its own, so read up to the welcome
+            while ' 001 ' not in received and \
+                    TwitchChatStream._logged_in_successful(received):
+                data = s.recv(1024)
+                if not data:
+                    break
+                received += data.decode('utf-8', 'replace')
+        except socket.timeout:
+            # no welcome in time, the login failed
+            received = ''
+        except (IOError, OSError):
+            s.close()
+            raise
+        if self.verbose:
+            print (received)
+        if not received or not TwitchChatStream._logged_in_successful(received):
+            # ... and they didn't accept our details
+            self.connected=False
+            s.close()
+            return #raise IOError("Twitch did not accept the username-oauth combination")
+        
+        else:
+            self.connected=True
+            # ... and they accepted our details
+            # Connected to twitch.tv!
+            # now make this socket non-blocking on the OS-level
+            s.settimeout(None)  # drop the login timeout again
+            try: # Mac user
+                fcntl.fcntl(s,fcntl.F_SETFL,os.O_NONBLOCK)
+            except: # Windows user
+                s.setblocking(0)
+            self.s = s
+            self.framer.reset()
+            self.outbound.start()
+            self.supervisor.start()
+
+
+    def _send_now(self, message):
+        """
+        Write a line to the socket. Called by the outbound scheduler,
+        which takes care of Twitch overflow control.
+        :param message: the line to send, without line ending
+        """
+        s = self.s
+        data = (message + "\r\n").encode('utf-8')
+        # the socket is non-blocking: sendall() could give up half way,
+        # and the retry would repeat the start of the line
+        sent = 0
+        while sent < len(data):
+            try:
+                sent += s.send(data[sent:])
+                continue
+            except socket.error as e:
+                err = e.args[0]
+                if err != errno.EAGAIN and err != errno.EWOULDBLOCK:
+                    raise
+            if not select.select([], [s], [], self.send_timeout)[1]:
+                if sent:
+                    # the server got a part of the line; only a new
+                    # connection can take the whole line again
+                    self.supervisor.lost(s)
+                raise socket.timeout("Sending to %s timed out" % self.host)
+        if message.startswith('JOIN '):
+            for channel in message[5:].split(','):
+                self.joins.sent(channel.strip().lstrip('#'))
+        if self.verbose:
+            print (message)
+
+    def _send(self, message, lane=OutboundScheduler.CHAT):
+        """
+        Send a message to the IRC stream
+        :param message: the message to be sent.
+        :type message: string
+        :param lane: outbound lane, see OutboundScheduler
+        """
+        if len(message) > 0:
+            self.outbound.put(message, lane)
+
+    def _send_pong(self, server='tmi.twitch.tv'):
+        """
+        Send a pong message, usually in reply to a received ping message
+        :param server: the server name the ping asked us to echo back
+        """
+        self._send("PONG :%s" % server, OutboundScheduler.CONTROL)
+
+    def join_channel(self, channel):
+        """
+        Join a different chat channel on Twitch.
+        Note, this function returns immediately, but the switch might
+        take a moment; the returned ChannelJoin tells when it is done.
+        Joining a channel that is already joined sends nothing.
+        :param channel: name of the channel, in any case, with or without
+            '#'
+        :return: the ChannelJoin of the channel
+        """
+        channel = channel_name(channel)
+        join, needed = self.joins.request(channel)
+        if needed:
+            self._send('JOIN #%s' % channel, OutboundScheduler.JOIN)
+        return join
+
+    def join_channels(self, channels):
+        """
+        Queue JOINs for many channels at once. They are sent as fast as
+        the join limit allows; use joins.wait() or joins.state() to see
+        how they went.
+        :param channels: channel names, in any case, with or without '#'
+        :return: list of the ChannelJoins
+        """
+        return [self.join_channel(channel) for channel in channels]
+
+    def _rejoin(self):
+        """Join every channel again after a reconnect."""
+        self.channels.clear()
+        for channel in self.joins.reset():
+            self._send('JOIN #%s' % channel, OutboundScheduler.JOIN)
+
+    def send_chat_message(self, toChannel, message):
+        """
+        Send a chat message to the server.
+        :param message: String to send (don't use \\n)
+        :param toChannel: lowercase string of channel name to send message to
+        """
+        self._send("PRIVMSG #{0} :{1}".format(toChannel, message))
+
+    def _parse_message(self, data):
+        """
+        Parse a line received from the socket.
+        :param data: a single decoded line received from the socket
+        :return: the IRCMessage when the line is a chat message, None
+            otherwise
+        """
+        msg = parse_line(data)
+        if msg is None:
+            return None
+        if msg.command == 'PRIVMSG':
+            if msg.channel and msg.trailing:
+                return msg
+        elif msg.command == 'PING':
+            self._send_pong(msg.trailing or 'tmi.twitch.tv')
+        elif msg.command == 'JOIN':
+            if msg.channel and msg.username == self.username.lower():
+                self.current_channel = msg.channel[1:]
+                self.channels.add(self.current_channel)
+                self.joins.confirmed(self.current_channel)
+        elif msg.command == 'PART':
+            if msg.channel and msg.username == self.username.lower():
+                self.channels.discard(msg.channel[1:])
+                self.joins.parted(msg.channel[1:])
+        elif msg.command == 'NOTICE':
+            reason = msg.tag('msg-id') or msg.trailing
+            if msg.channel and reason in JOIN_FAILURES:
+                self.joins.failed(msg.channel[1:], reason)
+        elif msg.command == '366':
+            # end of the names list, sent after every successful JOIN
+            if len(msg.params) > 1 and msg.params[1][:1] == '#':
+                self.joins.confirmed(msg.params[1][1:])
+        elif msg.command in JOIN_ERRORS:
+            if len(msg.params) > 1 and msg.params[1][:1] == '#':
+                self.joins.failed(msg.params[1][1:], msg.command)
+        return None
+
+    def twitch_receive_messages(self):
+        """
+        Call this function to process everything received by the socket
+        This needs to be called frequently enough (~10s) Twitch logs off
+        users not replying to ping commands.
+        :return: generator over the chat messages received. Each message
+            is an IRCMessage with the attributes channel, username and
+            message
+        """
+        while self.connected:
+            # process the complete buffer, until no data is left no more
+            s = self.s
+            try:
+                received = self.framer.recv_from(s)  # NON-BLOCKING RECEIVE!
+            except socket.error as e:
+                err = e.args[0]
+                if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
+                    # There is no more data available to read
+                    return
+                else:
+                    # a "real" error occurred, the supervisor reconnects
+                    self.supervisor.lost(s)
+                    return
+            if not received:
+                # the server closed the connection
+                self.supervisor.lost(s)
+                return
+            read_at = time.monotonic()
+            self.supervisor.received()
+            metrics = self.metrics
+            for line in self.framer.lines():
+                if self.verbose:
+                    print (line)
+                message = self._parse_message(line)
+                if metrics is not None:
+                    metrics.lines.inc()
+                    metrics.parse.observe(time.monotonic() - read_at)
+                if message:
+                    message.received = read_at
+                    yield message
+
+
+class ConnectionSupervisor(object):
+    """
+    Keeps a TwitchChatStream connected. It tracks the health of the
+    connection from the traffic it sees: Twitch sends a PING about every
+    five minutes, so when nothing arrived for idle_timeout seconds the
+    supervisor sends its own PING, and a connection that does not answer
+    within pong_timeout is considered lost.
+
+    A lost connection is re-established from a background thread, with
+    exponential backoff and jitter between attempts so a network blip
+    does not turn into a reconnect storm. Outbound lines are held while
+    disconnected; after reconnecting the joined channels are joined
+    again and then the held lines are sent.
+
+    :param stream: the TwitchChatStream to supervise
+    :param idle_timeout: seconds without traffic before checking the
+        connection with a PING
+    :param pong_timeout: seconds to wait for any answer to that PING
+    :param base_delay: delay before the second reconnect attempt
+    :param max_delay: longest delay between reconnect attempts
+    """
+    CONNECTED = 'connected'
+    STALE = 'stale'
+    DISCONNECTED = 'disconnected'
+    STOPPED = 'stopped'
+
+    def __init__(self, stream, idle_timeout=360., pong_timeout=15.,
+                 base_delay=1., max_delay=120.):
+        self.stream = stream
+        self.idle_timeout = idle_timeout
+        self.pong_timeout = pong_timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.state = self.CONNECTED
+        self.last_received = time.monotonic()
+        self.ping_sent = None
+        self.attempts = 0
+        self.next_attempt = 0.
+        self.reconnects = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start watching the connection (once)."""
+        self.received()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self.state = self.STOPPED
+        self._wakeup.set()
+
+    def received(self):
+        """Called by the stream whenever data arrived."""
+        self.last_received = time.monotonic()
+        if self.state == self.STALE:
+            self.state = self.CONNECTED
+
+    def backoff(self, attempts):
+        """
+        :param attempts: number of failed attempts so far
+        :return: seconds to wait before the next attempt
+        """
+        if attempts == 0:
+            return random.uniform(0., self.base_delay)
+        delay = min(self.max_delay, self.base_delay * 2 ** attempts)
+        return random.uniform(delay / 2., delay)
+
+    def lost(self, s=None):
+        """
+        Mark the connection as lost and let the supervisor thread
+        reconnect.
+        :param s: the socket that failed; ignored when it has already
+            been replaced
+        """
+        with self._lock:
+            if self.state in (self.DISCONNECTED, self.STOPPED):
+                return
+            if s is not None and s is not self.stream.s:
+                return
+            self.state = self.DISCONNECTED
+            self.stream.connected = False
+            self.stream.outbound.pause()
+            try:
+                self.stream.s.close()
+            except (IOError, OSError, AttributeError):
+                pass
+            self.attempts = 0
+            self.next_attempt = time.monotonic() + self.backoff(0)
+        print ("Connection to %s lost, reconnecting" % self.stream.host)
+        self._wakeup.set()
+
+    def check(self):
+        """Advance the health state machine; called about every second."""
+        now = time.monotonic()
+        if self.state == self.CONNECTED and \
+                now - self.last_received > self.idle_timeout:
+            self.state = self.STALE
+            self.ping_sent = now
+            self.stream._send('PING :tmi.twitch.tv', OutboundScheduler.CONTROL)
+        elif self.state == self.STALE and \
+                now - self.ping_sent > self.pong_timeout:
+            self.lost()
+        if self.state == self.DISCONNECTED and now >= self.next_attempt:
+            self._reconnect()
+        self.stream.joins.expire()
+
+    def _reconnect(self):
+        try:
+            self.stream.connect()
+        except (IOError, OSError):
+            pass
+        metrics = self.stream.metrics
+        if metrics is not None:
+            metrics.reconnects.inc('ok' if self.stream.connected else 'failed')
+        with self._lock:
+            if self.state == self.STOPPED:
+                return
+            if self.stream.connected:
+                self.state = self.CONNECTED
+                self.attempts = 0
+                self.reconnects += 1
+                self.stream._rejoin()
+                self.stream.outbound.resume()
+                print ("Reconnected to %s" % self.stream.host)
+            else:
+                self.attempts += 1
+                self.next_attempt = time.monotonic() + \
+                    self.backoff(self.attempts)
+
+    def _run(self):
+        while self.state != self.STOPPED:
+            self._wakeup.wait(1.)
+            self._wakeup.clear()
+            if self.state != self.STOPPED:
+                self.check()
+
+
+class AsyncTwitchChatStream(object):
+    """
+    asyncio counterpart of TwitchChatStream. Reads are event-driven, so
+    a message is handed to the consumer as soon as it arrives instead
+    of on the next poll, and an idle chat costs no wakeups. A single
+    event loop can drive any number of these streams, each of which may
+    have joined several channels.
+
+        async with AsyncTwitchChatStream(nick, oauth) as stream:
+            await stream.join_channel('tsm_dyrus')
+            async for message in stream:
+                print(message.channel, message.username, message.message)
+
+    :param username: Twitch username
+    :type username: string
+    :param oauth: oauth for logging in (see https://twitchapps.com/tmi/)
+    :type oauth: string
+    :param verbose: show all stream messages on stdout (for debugging)
+    :type verbose: boolean
+    :param moderator: the account is a moderator or the broadcaster of
+        the channels it chats in, which raises the chat limit
+    :type moderator: boolean
+    :param host: IRC server to connect to
+    :param port: port of the IRC server
+    :param capabilities: IRCv3 capabilities to request, by default the
+        message tags and the Twitch commands
+    """
+
+    def __init__(self, username, oauth, verbose=False, moderator=False,
+                 host=TWITCH_HOST, port=TWITCH_PORT,
+                 capabilities=CAPABILITIES):
+        self.username = username
+        self.oauth = oauth
+        self.verbose = verbose
+        self.host = host
+        self.port = port
+        self.capabilities = capabilities
+        self.chat_bucket = TokenBucket(
+            MODERATOR_CHAT_LIMIT if moderator else CHAT_LIMIT, CHAT_PERIOD)
+        self.join_bucket = TokenBucket(JOIN_LIMIT, JOIN_PERIOD)
+        self.current_channel = ""
+        self.channels = set()
+        self.connected = False
+        self._reader = None
+        self._writer = None
+        self._outbound = None
+        # chat messages sent before connect(), queued once logged in
+        self._pending = []
+        self._sender = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    async def connect(self):
+        """
+        Connect and log in to Twitch.
+        :return: True when the login was accepted
+        """
+        self._reader, self._writer = await asyncio.open_connection(self.host,
+                                                                   self.port)
+        if self.capabilities:
+            self._write('CAP REQ :%s' % ' '.join(self.capabilities))
+        self._write('PASS %s' % self.oauth)
+        self._write('NICK %s' % self.username)
+        await self._writer.drain()
+
+        # Twitch answers a login with either the 001 welcome numeric or
+        # a NOTICE explaining why it failed.
+        self.connected = False
+        while True:
+            line = await self._readline()
+            if line is None:
+                break
+            if not TwitchChatStream._logged_in_successful(line):
+                break
+            msg = parse_line(line)
+            if msg is not None and msg.command == '001':
+                self.connected = True
+                break
+        if not self.connected:
+            self._writer.close()
+            return False
+
+        self._outbound = asyncio.Queue()
+        for line in self._pending:
+            self._outbound.put_nowait(line)
+        self._pending = []
+        self._sender = asyncio.ensure_future(self._send_from_queue())
+        return True
+
+    async def close(self):
+        """Stop sending and close the connection."""
+        self.connected = False
+        if self._sender is not None:
+            self._sender.cancel()
+            self._sender = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _write(self, line):
+        """Write a single line to the server right away."""
+        if self.verbose:
+            print (line)
+        self._writer.write((line + '\r\n').encode('utf-8'))
+
+    async def _readline(self):
+        """
+        Wait for the next complete line from the server.
+        :return: the decoded line without terminator, None on EOF
+        """
+        data = await self._reader.readline()
+        if not data:
+            return None
+        line = data.decode('utf-8', 'replace').rstrip('\r\n')
+        if self.verbose:
+            print (line)
+        return line
+
+    async def _send_from_queue(self):
+        """Push queued chat messages within the chat limit."""
+        while True:
+            line = await self._outbound.get()
+            while not self.chat_bucket.try_acquire():
+                await asyncio.sleep(self.chat_bucket.delay())
+            self._write(line)
+            await self._writer.drain()
+
+    async def join_channel(self, channel):
+        """
+        Join a chat channel on Twitch. Several channels can be joined on
+        the same connection; the switch might take a moment.
+        :param channel: name of the channel (without #)
+        """
+        while not self.join_bucket.try_acquire():
+            await asyncio.sleep(self.join_bucket.delay())
+        self._write('JOIN #%s' % channel)
+        await self._writer.drain()
+
+    def send_chat_message(self, toChannel, message):
+        """
+        Queue a chat message to be sent to the server. Before connect()
+        the message waits until the login succeeded.
+        :param message: String to send (don't use \\n)
+        :param toChannel: lowercase string of channel name to send message to
+        """
+        if len(message) > 0:
+            line = "PRIVMSG #{0} :{1}".format(toChannel, message)
+            if self._outbound is None:
+                self._pending.append(line)
+            else:
+                self._outbound.put_nowait(line)
+
+    def _handle(self, msg):
+        """
+        React to protocol lines.
+        :return: the IRCMessage when it is a chat message, None otherwise
+        """
+        if msg.command == 'PRIVMSG':
+            if msg.channel and msg.trailing:
+                return msg
+        elif msg.command == 'PING':
+            # answered right away, never queued behind chat messages
+            self._write('PONG :%s' % (msg.trailing or 'tmi.twitch.tv'))
+        elif msg.command == 'JOIN':
+            if msg.channel and msg.username == self.username.lower():
+                self.current_channel = msg.channel[1:]
+                self.channels.add(self.current_channel)
+        elif msg.command == 'PART':
+            if msg.channel and msg.username == self.username.lower():
+                self.channels.discard(msg.channel[1:])
+        return None
+
+    def __aiter__(self):
+        return self.messages()
+
+    async def messages(self):
+        """
+        Asynchronously iterate over the chat messages of all joined
+        channels, as IRCMessage objects. Ends when the server closes the
+        connection.
+        """
+        while True:
+            line = await self._readline()
+            if line is None:
+                self.connected = False
+                return
+            msg = parse_line(line)
+            if msg is None:
+                continue
+            msg = self._handle(msg)
+            if msg is not None:
+                yield msg
+
+
+class TwitchChatPool(object):
+    """
+    Reads many channels at once by spreading them over several
+    TwitchChatStream connections. Every connection gets its own reader
+    thread, and the chat messages of all channels end up in one queue;
+    each message carries its channel.
+
+        pool = TwitchChatPool(nick, oauth, connections=4)
+        pool.join_channels(['chan_a', 'chan_b', 'chan_c'])
+        for message in pool.messages():
+            print(message.channel, message.username, message.message)
+
+    :param username: Twitch username
+    :type username: string
+    :param oauth: oauth for logging in (see https://twitchapps.com/tmi/)
+    :type oauth: string
+    :param connections: maximum number of IRC connections to open
+    :type connections: int
+    :param joins_per_connection: maximum number of channels joined on a
+        single connection
+    :type joins_per_connection: int
+    :param verbose: show all stream messages on stdout (for debugging)
+    :type verbose: boolean
+    :param moderator: the account is a moderator or the broadcaster of
+        the channels it chats in, which raises the chat limit
+    :type moderator: boolean
+    :param host: IRC server to connect to
+    :param port: port of the IRC server
+    """
+
+    def __init__(self, username, oauth, connections=4,
+                 joins_per_connection=50, verbose=False, moderator=False,
+                 host=TWITCH_HOST, port=TWITCH_PORT):
+        self.username = username
+        self.oauth = oauth
+        self.moderator = moderator
+        self.host = host
+        self.port = port
+        self.max_connections = connections
+        self.joins_per_connection = joins_per_connection
+        self.verbose = verbose
+        self.streams = []
+        self.channel_stream = {}
+        # Twitch counts its limits per account, not per connection
+        self.chat_bucket = TokenBucket(
+            MODERATOR_CHAT_LIMIT if moderator else CHAT_LIMIT, CHAT_PERIOD)
+        self.join_bucket = TokenBucket(JOIN_LIMIT, JOIN_PERIOD)
+        self.message_queue = queue.Queue()
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _open_stream(self):
+        """Open, log in and start reading one more connection."""
+        stream = TwitchChatStream(self.username, self.oauth,
+                                  verbose=self.verbose,
+                                  moderator=self.moderator,
+                                  chat_bucket=self.chat_bucket,
+                                  join_bucket=self.join_bucket,
+                                  host=self.host, port=self.port)
+        stream.connect()
+        if not stream.connected:
+            raise IOError("Twitch did not accept the username-oauth combination")
+        self.streams.append(stream)
+        thread = threading.Thread(target=self._read_loop, args=(stream,))
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+        return stream
+
+    def _stream_for_new_channel(self):
+        """
+        Pick the connection a new channel is joined on. New connections
+        are opened until the configured number is reached, after that the
+        least loaded connection with room left is used.
+        """
+        if len(self.streams) < self.max_connections:
+            return self._open_stream()
+        load = dict((id(stream), 0) for stream in self.streams)
+        for stream in self.channel_stream.values():
+            load[id(stream)] += 1
+        stream = min(self.streams, key=lambda s: load[id(s)])
+        if load[id(stream)] >= self.joins_per_connection:
+            raise ValueError("All %d connections already joined %d channels"
+                             % (self.max_connections,
+                                self.joins_per_connection))
+        return stream
+
+    def join_channel(self, channel):
+        """
+        Join a channel on one of the pooled connections.
+        :param channel: name of the channel (without #)
+        """
+        channel = channel_name(channel)
+        with self._lock:
+            if channel in self.channel_stream:
+                return
+            stream = self._stream_for_new_channel()
+            self.channel_stream[channel] = stream
+        stream.join_channel(channel)
+
+    def join_channels(self, channels):
+        """
+        Join several channels, spread over the pooled connections.
+        :param channels: channel names (without #)
+        """
+        for channel in channels:
+            self.join_channel(channel)
+
+    def send_chat_message(self, toChannel, message):
+        """
+        Send a chat message through the connection that joined the channel.
+        :param message: String to send (don't use \\n)
+        :param toChannel: name of a joined channel to send message to
+        """
+        toChannel = channel_name(toChannel)
+        stream = self.channel_stream.get(toChannel)
+        if stream is None:
+            raise ValueError("Channel #%s was not joined in this pool"
+                             % toChannel)
+        stream.send_chat_message(toChannel, message)
+
+    def _read_loop(self, stream):
+        """Reader thread: wait for data, parse it and queue the messages."""
+        while not self._stop.is_set():
+            try:
+                select.select([stream.s], [], [], 1.)
+            except (OSError, ValueError):
+                # the socket was replaced by a reconnect or closed
+                if self._stop.is_set():
+                    return
+                time.sleep(1.)
+            for message in stream.twitch_receive_messages():
+                self.message_queue.put(message)
+
+    def get_message(self, timeout=None):
+        """
+        Wait for the next chat message of any channel.
+        :param timeout: seconds to wait, None to wait forever
+        :return: an IRCMessage, or None when the timeout expired
+        """
+        try:
+            return self.message_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def messages(self, timeout=None):
+        """
+        Iterate over the chat messages of all channels, until the pool is
+        closed or no message arrived for timeout seconds.
+        """
+        while not self._stop.is_set():
+            # wake up once a second to notice close()
+            message = self.get_message(1. if timeout is None else timeout)
+            if message is None:
+                if timeout is not None:
+                    return
+                continue
+            yield message
+
+    def close(self):
+        """Stop the reader threads and close every connection."""
+        self._stop.set()
+        for stream in self.streams:
+            stream.close()
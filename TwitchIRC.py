@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+Low level helpers for the Twitch IRC protocol.
+
+Every line the server sends has the shape
+
+    [@tags] [:prefix] COMMAND [param ...] [:trailing]
+
+and is parsed here in a single pass with plain string slicing, instead
+of running a cascade of regular expressions over the same line.
+
+The IRCv3 tags (requested with CAPABILITIES) are not split up front:
+the message keeps the raw line and looks a tag up only when it is read,
+so lines whose tags nobody looks at cost nothing extra.
+"""
+
+# capabilities requested from Twitch: message tags (ids, timestamps,
+# badges, emotes) and the Twitch specific commands (CLEARCHAT, ...)
+CAPABILITIES = ('twitch.tv/tags', 'twitch.tv/commands')
+
+_TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+
+def _unescape_tag(value):
+    """Undo the IRCv3 escaping of a tag value."""
+    if '\\' not in value:
+        return value
+    out = []
+    i = 0
+    while i < len(value):
+        char = value[i]
+        if char == '\\' and i + 1 < len(value):
+            out.append(_TAG_ESCAPES.get(value[i + 1], value[i + 1]))
+            i += 2
+        else:
+            if char != '\\':
+                out.append(char)
+            i += 1
+    return ''.join(out)
+
+
+class IRCMessage(object):
+    """
+    A single parsed IRC line.
+    :param prefix: the part after the leading ':' (nick!user@host), or None
+    :param command: the IRC command or numeric reply, e.g. 'PRIVMSG'
+    :param params: list of the middle parameters
+    :param trailing: the text after ' :', or None
+    :param line: the raw line, when it starts with IRCv3 tags
+    :param tags_end: index of the space ending the tags in line
+
+    The stream sets received to the time.monotonic() at which the line
+    was read from the socket.
+    """
+    __slots__ = ('prefix', 'command', 'params', 'trailing', 'received',
+                 '_line', '_tags_end', '_tags')
+
+    def __init__(self, prefix, command, params, trailing, line=None,
+                 tags_end=0):
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+        self.trailing = trailing
+        self.received = None
+        self._line = line
+        self._tags_end = tags_end
+        self._tags = None
+
+    def __repr__(self):
+        return "IRCMessage(%r, %r, %r, %r)" % (
+            self.prefix, self.command, self.params, self.trailing)
+
+    def fields(self):
+        """
+        What builds the message again, e.g. in another process, without
+        parsing the line twice: IRCMessage(*message.fields()).
+        """
+        return (self.prefix, self.command, self.params, self.trailing,
+                self._line, self._tags_end)
+
+    @property
+    def username(self):
+        """Nick of the sender, taken from the prefix."""
+        if self.prefix is None:
+            return None
+        bang = self.prefix.find('!')
+        return self.prefix if bang < 0 else self.prefix[:bang]
+
+    @property
+    def channel(self):
+        """Channel the line was sent to, including the '#', or None."""
+        if self.params and self.params[0][:1] == '#':
+            return self.params[0]
+        return None
+
+    @property
+    def message(self):
+        """The chat text of a PRIVMSG."""
+        return self.trailing
+
+    @property
+    def has_tags(self):
+        return self._line is not None
+
+    @property
+    def raw_tags(self):
+        """The tag block as sent (without the '@'), '' for untagged lines."""
+        if self._line is None:
+            return ''
+        return self._line[1:self._tags_end]
+
+    def tag(self, name, default=None):
+        """
+        Look up a single tag without parsing the others.
+        :param name: tag name, e.g. 'display-name'
+        :return: the unescaped value, '' for a tag without value, or
+            default when the line does not carry the tag
+        """
+        if self._tags is not None:
+            return self._tags.get(name, default)
+        line = self._line
+        if line is None:
+            return default
+        end = self._tags_end
+        length = len(name)
+        # tags start at 1 (after the '@') or right after a ';'
+        start = 1
+        while True:
+            if line.startswith(name, start, end) and \
+                    (start + length == end or line[start + length] in '=;'):
+                break
+            start = line.find(';' + name, start, end)
+            if start < 0:
+                return default
+            start += 1
+        start += length
+        if start == end or line[start] == ';':
+            return ''
+        stop = line.find(';', start, end)
+        if stop < 0:
+            stop = end
+        return _unescape_tag(line[start + 1:stop])
+
+    @property
+    def tags(self):
+        """All tags as a dict, parsed on first use."""
+        if self._tags is None:
+            self._tags = {}
+            if self._line is not None:
+                for item in self._line[1:self._tags_end].split(';'):
+                    key, _, value = item.partition('=')
+                    self._tags[key] = _unescape_tag(value)
+        return self._tags
+
+    @property
+    def message_id(self):
+        return self.tag('id')
+
+    @property
+    def timestamp(self):
+        """Server time the message was sent, in seconds since the epoch."""
+        sent = self.tag('tmi-sent-ts')
+        return int(sent) / 1000. if sent else None
+
+    @property
+    def display_name(self):
+        return self.tag('display-name') or self.username
+
+    @property
+    def badges(self):
+        """dict of badge name to version, e.g. {'subscriber': '12'}."""
+        badges = {}
+        for badge in (self.tag('badges') or '').split(','):
+            if badge:
+                name, _, version = badge.partition('/')
+                badges[name] = version
+        return badges
+
+    @property
+    def is_moderator(self):
+        """Sent by a moderator or the broadcaster."""
+        if self.tag('mod') == '1':
+            return True
+        return 'broadcaster/' in (self.tag('badges') or '')
+
+    @property
+    def is_subscriber(self):
+        return self.tag('subscriber') == '1' or \
+            'subscriber/' in (self.tag('badges') or '')
+
+    @property
+    def emote_ranges(self):
+        """
+        Positions of the emotes in the message, from the 'emotes' tag.
+        :return: sorted list of (start, end, emote id), end exclusive;
+            None when the line carries no emote information
+        """
+        emotes = self.tag('emotes')
+        if emotes is None:
+            return None
+        ranges = []
+        for emote in emotes.split('/'):
+            if not emote:
+                continue
+            emote_id, _, positions = emote.partition(':')
+            for position in positions.split(','):
+                first, _, last = position.partition('-')
+                ranges.append((int(first), int(last) + 1, emote_id))
+        ranges.sort()
+        return ranges
+
+    def is_emote_only(self):
+        """
+        :return: True when the message is only emotes and spaces, None
+            when the line carries no emote information
+        """
+        if self.tag('emote-only') == '1':
+            return True
+        ranges = self.emote_ranges
+        if ranges is None:
+            return None
+        text = self.trailing or ''
+        position = 0
+        for start, end, _ in ranges:
+            if text[position:start].strip():
+                return False
+            position = end
+        return not text[position:].strip()
+
+    def text_without_emotes(self, replacement=''):
+        """
+        The message with every emote replaced, using the emote ranges
+        instead of scanning the text.
+        :param replacement: what to put in place of each emote
+        """
+        ranges = self.emote_ranges
+        text = self.trailing or ''
+        if not ranges:
+            return text
+        pieces = []
+        position = 0
+        for start, end, _ in ranges:
+            pieces.append(text[position:start])
+            pieces.append(replacement)
+            position = end
+        pieces.append(text[position:])
+        return ' '.join(''.join(pieces).split())
+
+
+def parse_line(line):
+    """
+    Parse one IRC line (without the line terminator).
+    :param line: the decoded line received from the server
+    :type line: string
+    :return: an IRCMessage, or None when the line is empty or malformed
+    """
+    if not line:
+        return None
+    tags_end = 0
+    start = 0
+    if line[0] == '@':
+        tags_end = line.find(' ')
+        if tags_end < 0 or tags_end + 1 == len(line):
+            return None
+        start = tags_end + 1
+    prefix = None
+    if line[start] == ':':
+        space = line.find(' ', start)
+        if space < 0:
+            return None
+        prefix = line[start + 1:space]
+        start = space + 1
+    split = line.find(' :', start)
+    if split < 0:
+        params = line[start:].split()
+        trailing = None
+    else:
+        params = line[start:split].split()
+        trailing = line[split + 2:]
+    if not params:
+        return None
+    command = params.pop(0)
+    if tags_end:
+        return IRCMessage(prefix, command, params, trailing, line, tags_end)
+    return IRCMessage(prefix, command, params, trailing)
+
+
+class LineFramer(object):
+    """
+    Incremental splitter turning a byte stream into complete lines.
+    Bytes are read with recv_into into one reusable buffer; a line that
+    is cut off at the end of a read (possibly in the middle of a
+    multibyte UTF-8 character) is kept until the rest of it arrives.
+    :param bufsize: size of the receive buffer
+    :type bufsize: int
+    """
+
+    def __init__(self, bufsize=4096):
+        self._recv_buffer = bytearray(bufsize)
+        self._recv_view = memoryview(self._recv_buffer)
+        self._pending = bytearray()
+
+    def reset(self):
+        """Forget any partial line, e.g. after reconnecting."""
+        del self._pending[:]
+
+    def recv_from(self, sock):
+        """
+        Read once from the socket into the framer.
+        :param sock: a connected socket
+        :return: number of bytes read, 0 when the peer closed the
+            connection. Socket errors are passed on to the caller.
+        """
+        count = sock.recv_into(self._recv_buffer)
+        self._pending += self._recv_view[:count]
+        return count
+
+    def feed(self, data):
+        """
+        Add received bytes to the framer.
+        :param data: bytes received from the server
+        """
+        self._pending += data
+
+    def lines(self):
+        """
+        Yield every complete line received so far, decoded and without
+        the line terminator. Incomplete trailing bytes stay buffered.
+        """
+        pending = self._pending
+        start = 0
+        try:
+            while True:
+                end = pending.find(b'\n', start)
+                if end < 0:
+                    return
+                line_end = end
+                if line_end > start and pending[line_end - 1] == 13:  # \r
+                    line_end -= 1
+                line_start = start
+                start = end + 1
+                if line_end > line_start:
+                    yield pending[line_start:line_end].decode('utf-8',
+                                                              'replace')
+        finally:
+            del pending[:start]